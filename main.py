@@ -1,8 +1,14 @@
 import argparse
 from ipaddress import ip_address
 
-from net import PeerRoot, PeerClient
+from net import PeerRoot, PeerClient, Packet
+from net.peer import TRANSPORTS, TRANSPORT_THREADED
+from net.peer_client import REUNION_MODES, REUNION_MODE_PATH, CLIENT_REUNION_SEND_DELAY, CLIENT_REUNION_JITTER
+from net.peer_root import GRAPHS, GRAPH_OBJECT, REUNION_DEPTH_SCALE, REUNION_CAPACITY
+from tools.NetworkGraph import MAX_CHILDREN, PLACEMENTS, PLACEMENT_SHALLOWEST
 from tools import Node
+from tools.log import setup_logging, LOG_LEVELS, DEFAULT_LOG_LEVEL
+from tools.Node import CONNECT_TIMEOUT, MAX_QUEUE_BYTES, MAX_QUEUE_PACKETS, QUEUE_POLICIES, QUEUE_BLOCK
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Create a peer')
@@ -13,19 +19,75 @@ if __name__ == "__main__":
     
     parser.add_argument('--root-ip', help='ip of root peer', type=ip_address, dest='root_ip')
     parser.add_argument('--root-port', help='port of root peer', type=int, dest='root_port')
+
+    parser.add_argument('--send-mode', help='wait for an ACK after every packet or pipeline packets',
+                        choices=('pipelined', 'ack'), default='pipelined', dest='send_mode')
+    parser.add_argument('--transport', help='threaded sockets or one asyncio event loop for all connections',
+                        choices=tuple(TRANSPORTS), default=TRANSPORT_THREADED)
+    parser.add_argument('--log-level', help='show log records of this level and above; per-packet records are debug',
+                        choices=LOG_LEVELS, default=DEFAULT_LOG_LEVEL, dest='log_level')
+    parser.add_argument('--connect-timeout', help='seconds a connection to another peer may take before it is given up',
+                        type=float, default=CONNECT_TIMEOUT, dest='connect_timeout')
+    parser.add_argument('--queue-bytes', help='limit of the send queue of every neighbour in bytes',
+                        type=int, default=MAX_QUEUE_BYTES, dest='max_queue_bytes')
+    parser.add_argument('--queue-packets', help='limit of the send queue of every neighbour in packets',
+                        type=int, default=MAX_QUEUE_PACKETS, dest='max_queue_packets')
+    parser.add_argument('--queue-policy', help='what to do with a packet for a neighbour whose send queue is full',
+                        choices=QUEUE_POLICIES, default=QUEUE_BLOCK, dest='queue_policy')
+    parser.add_argument('--protocol-version', help='packet version of the requests this peer makes',
+                        type=int, choices=Packet.VERSIONS, default=Packet.VERSION_2, dest='protocol_version')
+    parser.add_argument('--reunion-mode', help='send own Reunion Hellos or one Summary of the sub-tree per interval',
+                        choices=REUNION_MODES, default=REUNION_MODE_PATH, dest='reunion_mode')
+    parser.add_argument('--graph', help='network graph of the root; compact needs much less memory for large networks',
+                        choices=tuple(GRAPHS), default=GRAPH_OBJECT)
+    parser.add_argument('--fan-out', help='maximum children of a peer in the network tree (root only)',
+                        type=int, default=MAX_CHILDREN, dest='max_children')
+    parser.add_argument('--max-depth', help='do not place peers deeper than this in the network tree (root only)',
+                        type=int, default=None, dest='max_depth')
+    parser.add_argument('--placement', help='shallowest free slot or the smallest sub-tree first (root only)',
+                        choices=PLACEMENTS, default=PLACEMENT_SHALLOWEST)
+    parser.add_argument('--reunion-interval', help='seconds between Reunion Hellos; the root asks its children for '
+                                                   'it, a client uses it unless the root asks for a longer one',
+                        type=float, default=CLIENT_REUNION_SEND_DELAY, dest='reunion_interval')
+    parser.add_argument('--reunion-jitter', help='random fraction every reunion interval is stretched or shortened by '
+                                                 '(client only)',
+                        type=float, default=CLIENT_REUNION_JITTER, dest='reunion_jitter')
+    parser.add_argument('--reunion-depth-scale', help='how much longer the interval of every deeper level is (root only)',
+                        type=float, default=REUNION_DEPTH_SCALE, dest='reunion_depth_scale')
+    parser.add_argument('--reunion-capacity', help='reunion entries per second the root serves before it asks for '
+                                                   'longer intervals (root only)',
+                        type=float, default=REUNION_CAPACITY, dest='reunion_capacity')
     
     args = parser.parse_args()
 
+    log_listener = setup_logging(args.log_level)
+
     address = Node.parse_address((str(args.ip), args.port))
 
+    peer_options = {
+        'pipelined_send': args.send_mode == 'pipelined',
+        'transport': args.transport,
+        'protocol_version': args.protocol_version,
+        'connect_timeout': args.connect_timeout,
+        'max_queue_bytes': args.max_queue_bytes,
+        'max_queue_packets': args.max_queue_packets,
+        'queue_policy': args.queue_policy,
+    }
+
     if args.is_root:
-        peer = PeerRoot(address)
+        peer = PeerRoot(address, graph=args.graph, max_children=args.max_children, max_depth=args.max_depth,
+                        placement=args.placement, reunion_interval=args.reunion_interval,
+                        reunion_depth_scale=args.reunion_depth_scale, reunion_capacity=args.reunion_capacity,
+                        **peer_options)
     else:
         if args.root_port is None or args.root_ip is None:
             print("Error: you should specify root-ip and root-port")
             exit(1)
 
         root_address = Node.parse_address((str(args.root_ip), args.root_port))
-        peer = PeerClient(address, root_address)
+        peer = PeerClient(address, root_address, reunion_mode=args.reunion_mode,
+                          reunion_interval=args.reunion_interval, reunion_jitter=args.reunion_jitter, **peer_options)
 
     peer.run()
+
+    log_listener.stop()
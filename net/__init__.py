@@ -1,4 +1,5 @@
-from .packet import Packet, PacketFactory, ReunionParser
+from .packet import Packet, PacketFactory, PacketDecoder, MessageParser, RegisterParser, AdvertiseParser, \
+    ReunionParser
 from .user_interface import UserInterface
 from .peer import Peer
 from .peer_root import PeerRoot
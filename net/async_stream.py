@@ -0,0 +1,252 @@
+import asyncio
+import logging
+import threading
+
+from net.packet import PacketDecoder
+from net.stream import Stream, SERVER_RECEIVE_BYTES
+from tools.Node import Node, CONNECT_TIMEOUT, MAX_QUEUE_BYTES, MAX_QUEUE_PACKETS, QUEUE_BLOCK
+
+"""
+    asyncio transport for our Stream.
+
+    All the sockets of a peer are served by one event loop which runs in a separate thread; inbound connections get a
+    StreamReader/StreamWriter pair from asyncio.start_server and every Node writes to its own StreamWriter.
+    The Peer main loop keeps using the Stream API and only hands buffers over to the event loop.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+MAXIMUM_CONNECTIONS = 1024
+WRITE_BUFFER_LIMIT = 256 * 1024  # bytes in the transport of a client from which its Node keeps packets in out_buff
+SHUTDOWN_TIMEOUT = 1  # seconds
+
+
+class AsyncClient:
+    def __init__(self, loop, ip, port, connect_timeout=CONNECT_TIMEOUT, on_connect=None):
+        """
+        Client side of a connection to a Node TCPServer.
+
+        The connection is opened in the background; the client is pending until it is established and whenever its
+        transport holds more than WRITE_BUFFER_LIMIT bytes, so the bounded out_buff of its Node takes the backlog.
+        ACKs of the server are read and discarded.
+
+        :param loop: The event loop of our Stream.
+        :param ip: Node TCPServer IP in the socket format.
+        :param port: Node TCPServer port.
+        :param connect_timeout: Seconds the connection may take.
+        :param on_connect: Called when the connection is made or has failed.
+        """
+        self._loop = loop
+        self._writer = None
+        self._pending = []
+        self.connect_error = None
+        self.closed = False
+        self.sent_count = 0
+        self.response_bytes = 0
+
+        asyncio.run_coroutine_threadsafe(self._connect(ip, port, connect_timeout, on_connect), loop)
+
+    async def _connect(self, ip, port, connect_timeout, on_connect):
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), connect_timeout)
+        except asyncio.TimeoutError:
+            self.connect_error = TimeoutError("timed out")
+        except OSError as e:
+            self.connect_error = e
+
+        if self.connect_error is not None:
+            self._pending = []
+            if on_connect:
+                on_connect()
+            return
+
+        if self.closed:
+            writer.close()
+            return
+
+        self._writer = writer
+        writer.writelines(self._pending)
+        self._pending = []
+
+        if on_connect:
+            on_connect()
+
+        try:
+            while True:
+                response = await reader.read(SERVER_RECEIVE_BYTES)
+                if not response:
+                    break
+                self.response_bytes += len(response)
+        except ConnectionError:
+            pass
+        finally:
+            self.closed = True
+            writer.close()
+
+    @property
+    def pending(self):
+        if self._writer is None:
+            return self.connect_error is None and not self.closed
+
+        return self._writer.transport.get_write_buffer_size() > WRITE_BUFFER_LIMIT
+
+    def _write(self, data):
+        if self.closed:
+            return
+
+        if self._writer is None:
+            self._pending.append(data)
+        else:
+            self._writer.write(data)
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+    def send(self, data):
+        """
+        Hand data over to the event loop; it never blocks.
+
+        :param data: The packet buffer.
+        :type data: bytes
+        """
+        self.sent_count += 1
+        self._loop.call_soon_threadsafe(self._write, data)
+
+    def _write_many(self, buffers):
+        if self.closed:
+            return
+
+        if self._writer is None:
+            self._pending.extend(buffers)
+        else:
+            self._writer.writelines(buffers)
+
+    def send_many(self, buffers):
+        """
+        Hand a batch of buffers over to the event loop at once.
+
+        :param buffers: The packet buffers.
+        :type buffers: list
+        """
+        self.sent_count += len(buffers)
+        self._loop.call_soon_threadsafe(self._write_many, buffers)
+
+    def close(self):
+        self.closed = True
+
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._close)
+
+
+class AsyncNode(Node):
+    def __init__(self, server_address, loop, set_root=False, set_register=False, connect_timeout=CONNECT_TIMEOUT,
+                 on_connect=None, **queue_options):
+        """
+        A Node which sends its out_buff through the event loop of an AsyncStream.
+
+        :param server_address:
+        :param loop: The event loop of our Stream.
+        :param set_root:
+        :param set_register:
+        :param connect_timeout: Seconds the connection may take.
+        :param on_connect: Called from the event loop when the connection is made or has failed.
+        :param queue_options: Limits and policy of out_buff, see Node.
+        """
+        self._loop = loop
+        super(AsyncNode, self).__init__(server_address, set_root=set_root, set_register=set_register,
+                                        connect_timeout=connect_timeout, on_connect=on_connect, **queue_options)
+
+    def _create_client(self, server_real_address, pipelined, connect_timeout, on_connect):
+        return AsyncClient(self._loop, *server_real_address, connect_timeout=connect_timeout, on_connect=on_connect)
+
+
+class AsyncStream(Stream):
+
+    def __init__(self, address: tuple, pipelined_send=True, wakeup=None, connect_timeout=CONNECT_TIMEOUT,
+                 max_queue_bytes=MAX_QUEUE_BYTES, max_queue_packets=MAX_QUEUE_PACKETS, queue_policy=QUEUE_BLOCK):
+        """
+        A Stream that serves all its connections from one asyncio event loop.
+
+        Sending is always pipelined here, so pipelined_send has no effect.
+
+        :param address: (ip, port) 15 characters for ip + 5 characters for port
+        :param pipelined_send: Unused, kept for the same constructor as Stream.
+        :param wakeup: threading.Event which is set whenever a new packet is received or a new connection is ready.
+        :param connect_timeout: Seconds a new connection may take; a node which fails to connect is removed.
+        :param max_queue_bytes: Limit of the out buffer of every node in bytes.
+        :param max_queue_packets: Limit of the out buffer of every node in packets.
+        :param queue_policy: What to do when the out buffer of a node is full; one of tools.Node.QUEUE_POLICIES.
+        """
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._loop_thread.start()
+        self._connections = set()  # StreamWriters of the inbound connections
+
+        super(AsyncStream, self).__init__(address, pipelined_send=True, wakeup=wakeup, connect_timeout=connect_timeout,
+                                          max_queue_bytes=max_queue_bytes, max_queue_packets=max_queue_packets,
+                                          queue_policy=queue_policy)
+
+    def _start_server(self, real_address):
+        coroutine = asyncio.start_server(self._handle_connection, *real_address, backlog=MAXIMUM_CONNECTIONS)
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    async def _handle_connection(self, reader, writer):
+        decoder = PacketDecoder()
+        self._connections.add(writer)
+
+        try:
+            while True:
+                data = await reader.read(SERVER_RECEIVE_BYTES)
+                if not data:
+                    break
+
+                try:
+                    count = self._handle_received_data(decoder, data)
+                except ValueError as e:
+                    logger.warning("Dropping the connection from %s: %s", writer.get_extra_info('peername'), e)
+                    break
+
+                if count:
+                    writer.write(bytes('ACK', 'utf8') * count)
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    def _create_node(self, server_address, set_register_connection):
+        return AsyncNode(server_address, self._loop, set_register=set_register_connection,
+                         connect_timeout=self.connect_timeout, on_connect=self._on_connect, **self.queue_options)
+
+    async def _close_connections(self):
+        """
+        Stop accepting and end every connection task, so none of them is left pending when the loop stops.
+
+        Closed connections end their tasks by themselves; only the connections which are still being opened are
+        cancelled.
+        """
+        self._server.close()
+        for writer in list(self._connections):
+            writer.close()
+
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=SHUTDOWN_TIMEOUT)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        await self._server.wait_closed()
+
+    def shutdown(self):
+        for c in self._get_all_nodes():  # type: Node
+            c.close()
+
+        asyncio.run_coroutine_threadsafe(self._close_connections(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join(SHUTDOWN_TIMEOUT)
+        self._loop.close()
+        self._server = None
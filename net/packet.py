@@ -18,7 +18,8 @@
     |__________________________________________________________________________________________________________________|
 
     Version:
-        For now version is 1
+        1 or 2; they only differ in how addresses are written in Register, Advertise and Reunion bodies
+        (see 'Version 2' at the end). A response is made with the version of its request.
     
     Type:
         1: Register
@@ -33,6 +34,10 @@
     Server IP/Port:
         We need this field for response packet in non-blocking mode.
 
+    Framing:
+        Packets are written back to back on a TCP connection, so a single read may hold a part of a packet or several
+        packets. The receiver uses the Length field of the 20 bytes header to split the stream (see PacketDecoder).
+
 
 
     ***** For example: ******
@@ -116,10 +121,23 @@
         Message:
                                 ** Body Format **
                  ________________________________________________
-                |             Message (#Length Chars)            |
+                |             Origin IP (15 Chars)               |
+                |------------------------------------------------|
+                |             Origin Port (5 Chars)              |
+                |------------------------------------------------|
+                |           Sequence Number (8 Chars)            |
+                |------------------------------------------------|
+                |           Message (#Length - 28 Chars)         |
                 |________________________________________________|
 
             The message that want to broadcast to whole network. Right now this type only includes a plain text.
+            Origin IP/Port and Sequence Number make the Message ID; the origin peer numbers its messages and every
+            other peer forwards the ID untouched, so a peer can drop a message it has already seen. The sequence
+            is written modulo 10^8 and starts at a random number, so a restarted peer doesn't repeat recent IDs.
+
+            The Message ID was added to the body without a new version number; the Message body of both versions
+            carries it. A peer which predates it sends the plain text only and such a body is dropped as invalid
+            unless the text happens to start with a valid ID; it shows the ID of our messages as part of the text.
         
         Reunion:
             Hello:
@@ -174,12 +192,57 @@
 
                 Root in an answer to the Reunion Hello message will send this packet to the target node.
                 In this packet, all the nodes (IP, port) exist in order by path traversal to target.
+
+                The root may append a Reunion Interval (6 Chars) after the last entry: the milliseconds it wants the
+                target to wait between its Reunion Hellos, e.g. '004000'. Peers forward it untouched.
+
+
+            Summary:
+
+                                    ** Body Format **
+                 ________________________________________________
+                |                  SUM (3 Chars)                 |
+                |------------------------------------------------|
+                |                 IP0 (15 Chars)                 |
+                |------------------------------------------------|
+                |                Port0 (5 Chars)                 |
+                |------------------------------------------------|
+                |                     ...                        |
+                |________________________________________________|
+
+                In the aggregated reunion mode a peer sends one Summary to its parent in every interval instead of
+                forwarding every Hello; Entry 0 is the peer itself and the others are the entries of the Summaries
+                its children sent since the last one. There is no Number of Entries field, it follows from Length.
+
+            Summary Ack:
+
+                Same body as Summary with SAK instead of SUM. The root answers every Summary of its child with the
+                entries it knows and every peer splits an arrived Summary Ack into one Summary Ack per child, holding
+                the entries that child has reported. It may end with a Reunion Interval like Hello Back, for all of
+                its entries; its size is not a multiple of the entry size, so it is found from Length.
+
+    Version 2:
+
+        Every (IP, Port) of the Register Request, Advertise Response and Reunion bodies is 6 bytes instead of 20
+        characters; 4 bytes for IP and 2 bytes for Port, in network byte order. The Number of Entries field of the
+        Reunion bodies is 1 byte, so at most 255 entries fit in a Reunion packet. The Reunion Interval is 4 bytes.
+        
+        e.g: Reunion Hello from 127.0.0.1:31315
+        
+                    b'REQ\x01\x7f\x00\x00\x01zS'
+        
+        REQ/RES/ACK markers, Join and Message bodies are the same as in version 1.
             
     
 """
 from struct import *
 from tools.Node import Node
-from tools.time import print_time
+
+HEADER_FORMAT = "!HHIHHHHI"
+HEADER_SIZE = calcsize(HEADER_FORMAT)
+
+MESSAGE_SEQUENCE_LIMIT = 10 ** 8
+MAX_PACKET_LENGTH = 1024 * 1024  # bytes of body; a longer header is taken as garbage
 
 
 class Packet:
@@ -192,6 +255,12 @@ class Packet:
     RESPONSE = 'RES'
     REQUEST = 'REQ'
     ACK = 'ACK'
+    SUMMARY = 'SUM'
+    SUMMARY_ACK = 'SAK'
+
+    VERSION_1 = 1
+    VERSION_2 = 2
+    VERSIONS = (VERSION_1, VERSION_2)
 
     verbose_map = {
         TYPE_REGISTER: 'register',
@@ -201,19 +270,29 @@ class Packet:
         TYPE_REUNION: 'reunion'
     }
 
-    def __init__(self, version: int, _type: int, source_server_ip: str, source_server_port: str, body: str):
+    __slots__ = ('version', '_type', '_ip_parts', '_port', '_body', '_body_bytes', '_buf')
+
+    def __init__(self, version: int, _type: int, source_server_ip: str, source_server_port: str, body):
         self.version = version
         self._type = _type
-        self.source_server_ip = source_server_ip
-        self.source_server_port = source_server_port
-        self.body = body
-        self._ip_parts = list(map(int, source_server_ip.split('.')))
+        self._ip_parts = tuple(map(int, source_server_ip.split('.')))
+        self._port = int(source_server_port)
+
+        if isinstance(body, str):
+            self._body = body
+            self._body_bytes = body.encode()
+        else:
+            # Version 2 bodies are binary, they are decoded by the parsers.
+            self._body = None
+            self._body_bytes = bytes(body)
+
+        self._buf = None
 
         if len(self._ip_parts) != 4:
             raise ValueError("invalid ip")
 
     def get_type(self):
-        """en(body)
+        """
         :return: Packet type
         :rtype: int
         """
@@ -225,30 +304,69 @@ class Packet:
         :return: Packet length
         :rtype: int
         """
-        return len(self.body)
+        return len(self._body_bytes)
 
     def get_body(self):
         """
+        The body of a parsed packet is decoded on the first call.
+
         :return: Packet body
         :rtype: str
         """
-        return self.body
+        if self._body is None:
+            self._body = str(self._body_bytes, 'utf-8')
+
+        return self._body
+
+    @property
+    def body(self):
+        return self.get_body()
+
+    def get_body_bytes(self):
+        """
+        :return: Packet body without decoding; a memoryview over the received buffer for parsed packets.
+        :rtype: bytes | memoryview
+        """
+        return self._body_bytes
 
     def get_buf(self):
         """
         In this function, we will make our final buffer that represents the Packet with the Struct class methods.
 
+        The buffer is built once; later calls return the same object, and packets parsed from a buffer return it.
+
         :return The parsed packet to the network format.
-        :rtype: bytearray
+        :rtype: bytes
+        """
+        if self._buf is None:
+            self._buf = pack(
+                HEADER_FORMAT,
+                self.version,
+                self._type,
+                self.get_length(),
+                *self._ip_parts,
+                self._port,
+            ) + self._body_bytes
+
+        return self._buf
+
+    def get_buf_with_source(self, source_server_address):
+        """
+        The same packet on the wire with only the Source Server IP/Port header fields replaced; used for forwarding
+        without encoding the body again.
+
+        :param source_server_address: Server address of the new packet sender.
+        :type source_server_address: tuple
+
+        :return: The new buffer.
+        :rtype: bytes
         """
-        return pack(
-            "!HHIHHHHI",
-            self.version,
-            self._type,
-            self.get_length(),
-            *self._ip_parts,
-            int(self.source_server_port),
-        ) + self.body.encode()
+        buf = self.get_buf()
+
+        header = bytearray(buf[:HEADER_SIZE])
+        write_source_server_address(header, source_server_address)
+
+        return b"".join((header, memoryview(buf)[HEADER_SIZE:]))
 
     def get_source_server_ip(self):
         """
@@ -256,14 +374,14 @@ class Packet:
         :return: Server IP address for the sender of the packet.
         :rtype: str
         """
-        return Node.parse_ip(self.source_server_ip)
+        return '%03d.%03d.%03d.%03d' % self._ip_parts
 
     def get_source_server_port(self):
         """
         :return: Server Port address for the sender of the packet.
         :rtype: str
         """
-        return Node.parse_port(self.source_server_port)
+        return '%05d' % self._port
 
     def get_source_server_address(self):
         """
@@ -274,28 +392,110 @@ class Packet:
 
     @classmethod
     def new_packet(cls, buf: bytes):
-        if len(buf) < 20:
+        """
+        Make a Packet over buf without copying it; only the header is unpacked here, the body is decoded when it is
+        asked for.
+
+        :param buf: A whole packet.
+        :type buf: bytes
+
+        :return: The packet.
+        :rtype: Packet
+        """
+        if len(buf) < HEADER_SIZE:
             raise ValueError("invalid buf")
 
-        header_buf = buf[:20]
-        body_buf = buf[20:]
+        version, _type, length, *ip_parts, port = unpack_from(HEADER_FORMAT, buf)
+
+        if length != len(buf) - HEADER_SIZE:
+            raise ValueError("invalid packet length %d != %d" % (length, len(buf) - HEADER_SIZE))
 
-        header = unpack("!HHIHHHHI", header_buf)
+        packet = cls.__new__(cls)
+        packet.version = version
+        packet._type = _type
+        packet._ip_parts = tuple(ip_parts)
+        packet._port = port
+        packet._body = None
+        packet._body_bytes = memoryview(buf)[HEADER_SIZE:]
+        packet._buf = buf
 
-        if header[2] != len(body_buf):
-            raise ValueError("invalid packet length %d != %d" % (header[2], len(body_buf)))
+        return packet
 
-        ip = "%d.%d.%d.%d" % header[3:7]
-        port = header[7]
+    def __str__(self):
+        try:
+            body = self.get_body()
+        except UnicodeDecodeError:
+            # Binary body of a version 2 packet.
+            body = bytes(self._body_bytes)
 
-        return Packet(header[0], header[1], ip, port, body_buf.decode())
+        return "version: %d, type: %s, length: %d, source: %s:%s, body: %s" % (
+            self.version, self.verbose_map.get(self._type, self._type), self.get_length(),
+            self.get_source_server_ip(), self.get_source_server_port(), body
+        )
 
     def print(self):
-        print_time()
-        print("version: %d, type: %s, length: %d" % (self.version, self.verbose_map[self._type], self.get_length()))
-        print("source: %s:%s" % (self.get_source_server_ip(), self.get_source_server_port()))
-        print(self.body)
-        print('-----------------------------------')
+        print(self)
+
+
+class PacketDecoder:
+    """
+    Reassembles packets from the byte stream of one TCP connection.
+
+    Every call to 'feed' appends the received chunk to an internal buffer and returns all the packets that are
+    complete by now; a partial packet remains in the buffer until the rest of it arrives.
+
+    The Length field is not trusted blindly; a header which announces more than max_length bytes makes 'feed' raise
+    ValueError, and the connection should be dropped since the rest of its stream can't be framed any more.
+    """
+
+    HEADER_SIZE = HEADER_SIZE
+
+    def __init__(self, max_length=MAX_PACKET_LENGTH):
+        """
+        :param max_length: The longest body which is accepted, in bytes.
+        """
+        self._buf = bytearray()
+        self.max_length = max_length
+
+    def feed(self, data: bytes) -> list:
+        """
+        :param data: The chunk received from the socket.
+
+        :return: Buffers of the completed packets in order of arrival.
+        :rtype: list
+
+        :raise ValueError: If a packet is longer than max_length.
+        """
+        self._buf += data
+
+        packets = []
+        offset = 0
+        available = len(self._buf)
+
+        while available - offset >= self.HEADER_SIZE:
+            length = unpack_from("!I", self._buf, offset + 4)[0]
+            if length > self.max_length:
+                raise ValueError("packet length %d exceeds %d" % (length, self.max_length))
+
+            end = offset + self.HEADER_SIZE + length
+
+            if end > available:
+                break
+
+            packets.append(bytes(self._buf[offset:end]))
+            offset = end
+
+        if offset:
+            del self._buf[:offset]
+
+        return packets
+
+    def pending(self) -> int:
+        """
+        :return: Number of buffered bytes which do not make a complete packet yet.
+        :rtype: int
+        """
+        return len(self._buf)
 
 
 class PacketFactory:
@@ -317,15 +517,18 @@ class PacketFactory:
         return Packet.new_packet(buffer)
 
     @staticmethod
-    def new_reunion_packet(type, source_address, nodes_array: list):
+    def new_reunion_packet(type, source_address, nodes_array: list, version=Packet.VERSION_1, interval=None):
         """
         :param type: Reunion Hello (REQ) or Reunion Hello Back (RES)
         :param source_address: IP/Port address of the packet sender.
         :param nodes_array: [(ip0, port0), (ip1, port1), ...] It is the path to the 'destination'.
+        :param version: Protocol version of the body.
+        :param interval: Reunion Interval the root asks the destination for, in seconds; only for Hello Back.
 
         :type type: str
         :type source_address: tuple
         :type nodes_array: list
+        :type version: int
 
         :return New reunion packet.
         :rtype Packet
@@ -334,29 +537,134 @@ class PacketFactory:
         if type not in (Packet.REQUEST, Packet.RESPONSE):
             raise ValueError("invalid type")
 
-        if len(nodes_array) > 99:
+        if len(nodes_array) > MAX_REUNION_ENTRIES[version]:
             raise ValueError("too long nodes_array")
 
-        entities = []
+        if interval is not None and type != Packet.RESPONSE:
+            raise ValueError("only Hello Back has a reunion interval")
+
+        body = type.encode() + encode_entries_count(len(nodes_array), version) + b''.join(
+            encode_address(address, version) for address in nodes_array
+        )
+
+        if interval is not None:
+            body += encode_reunion_interval(interval, version)
+
+        return Packet(version, Packet.TYPE_REUNION, *source_address, body_for_version(body, version))
+
+    @staticmethod
+    def new_reunion_summary_packet(type, source_address, addresses: list, version=Packet.VERSION_1, interval=None):
+        """
+        :param type: Reunion Summary (SUM) or Reunion Summary Ack (SAK)
+        :param source_address: IP/Port address of the packet sender.
+        :param addresses: [(ip0, port0), (ip1, port1), ...] The live peers of a sub-tree.
+        :param version: Protocol version of the body.
+        :param interval: Reunion Interval the root asks the peers for, in seconds; only for Summary Ack.
+
+        :type type: str
+        :type source_address: tuple
+        :type addresses: list
+        :type version: int
+
+        :return New reunion packet.
+        :rtype Packet
+        """
+        if type not in (Packet.SUMMARY, Packet.SUMMARY_ACK):
+            raise ValueError("invalid type")
+
+        if interval is not None and type != Packet.SUMMARY_ACK:
+            raise ValueError("only Summary Ack has a reunion interval")
+
+        body = type.encode() + b''.join(encode_address(address, version) for address in addresses)
+
+        if interval is not None:
+            body += encode_reunion_interval(interval, version)
+
+        return Packet(version, Packet.TYPE_REUNION, *source_address, body_for_version(body, version))
+
+    @staticmethod
+    def append_reunion_entry(packet, source_server_address, address):
+        """
+        Forward a Reunion Hello with address appended to its path.
+
+        Only the header, the request type and the Number of Entries are checked; the entries are copied as they
+        are, so the cost does not grow with re-formatting the whole path at every hop.
+
+        :param packet: The arrived Reunion Hello packet.
+        :param source_server_address: Server address of the new packet sender.
+        :param address: The entry to append; e.g. address of the forwarding peer.
+
+        :return: New reunion packet or None if packet is not a valid Reunion Hello or its path is full.
+        :rtype: Packet
+        """
+        count = reunion_entries_count(packet, Packet.REQUEST)
+        version = packet.version
 
-        for ip, port in nodes_array:
-            entities.append(Node.parse_ip(ip))
-            entities.append(Node.parse_port(port))
+        if count is None or count >= MAX_REUNION_ENTRIES[version]:
+            return None
 
-        body = type + str(len(nodes_array)).zfill(2) + ''.join(entities)
+        buf = bytearray(packet.get_buf())
+        buf += encode_address(address, version)
+        buf[HEADER_SIZE + 3:HEADER_SIZE + 3 + ENTRIES_COUNT_SIZE[version]] = encode_entries_count(count + 1, version)
+        pack_into("!I", buf, 4, len(buf) - HEADER_SIZE)
+        write_source_server_address(buf, source_server_address)
 
-        return Packet(1, Packet.TYPE_REUNION, *source_address, body)
+        return Packet.new_packet(bytes(buf))
 
     @staticmethod
-    def new_advertise_packet(type, source_server_address, neighbour: tuple=None):
+    def strip_reunion_entry(packet, source_server_address, address):
+        """
+        Forward a Reunion Hello Back without its first entry, which must be address.
+
+        :param packet: The arrived Reunion Hello Back packet.
+        :param source_server_address: Server address of the new packet sender.
+        :param address: The expected first entry; e.g. address of the forwarding peer.
+
+        :return: None if packet is not a valid Reunion Hello Back for address, otherwise (next_address, new_packet);
+                 both are None if address was the last entry.
+        :rtype: tuple
+        """
+        count = reunion_entries_count(packet, Packet.RESPONSE)
+        version = packet.version
+
+        if count is None:
+            return None
+
+        body = packet.get_body_bytes()
+        entries_start = 3 + ENTRIES_COUNT_SIZE[version]
+        address_size = ADDRESS_SIZE[version]
+        rest_start = entries_start + address_size
+
+        if body[entries_start:rest_start] != encode_address(address, version):
+            return None
+
+        if count == 1:
+            return None, None
+
+        next_address = decode_address(body[rest_start:rest_start + address_size], version)
+        if next_address is None:
+            return None
+
+        buf = bytearray(packet.get_buf()[:HEADER_SIZE + 3])
+        buf += encode_entries_count(count - 1, version)
+        buf += body[rest_start:]
+        pack_into("!I", buf, 4, len(buf) - HEADER_SIZE)
+        write_source_server_address(buf, source_server_address)
+
+        return next_address, Packet.new_packet(bytes(buf))
+
+    @staticmethod
+    def new_advertise_packet(type, source_server_address, neighbour: tuple=None, version=Packet.VERSION_1):
         """
         :param type: Type of Advertise packet
         :param source_server_address Server address of the packet sender.
         :param neighbour: The neighbour for advertise response packet; The format is like ('192.168.001.001', '05335').
+        :param version: Protocol version of the body.
 
         :type type: str
         :type source_server_address: tuple
         :type neighbour: tuple
+        :type version: int
 
         :return New advertise packet.
         :rtype Packet
@@ -366,14 +674,14 @@ class PacketFactory:
             raise ValueError("invalid type")
 
         if type == Packet.REQUEST:
-            body = Packet.REQUEST
+            body = Packet.REQUEST.encode()
         else:
             if not neighbour:
                 raise ValueError("neighbour should provided for response")
 
-            body = Packet.RESPONSE + Node.parse_ip(neighbour[0]) + Node.parse_port(neighbour[1])
+            body = Packet.RESPONSE.encode() + encode_address(neighbour, version)
 
-        return Packet(1, Packet.TYPE_ADVERTISE, *source_server_address, body)
+        return Packet(version, Packet.TYPE_ADVERTISE, *source_server_address, body_for_version(body, version))
 
     @staticmethod
     def new_join_packet(source_server_address) -> Packet:
@@ -389,15 +697,17 @@ class PacketFactory:
         return Packet(1, Packet.TYPE_JOIN, *source_server_address, 'JOIN')
 
     @staticmethod
-    def new_register_packet(type, source_server_address, address=(None, None)) -> Packet:
+    def new_register_packet(type, source_server_address, address=(None, None), version=Packet.VERSION_1) -> Packet:
         """
         :param type: Type of Register packet
         :param source_server_address: Server address of the packet sender.
         :param address: If 'type' is 'request' we need an address; The format is like ('192.168.001.001', '05335').
+        :param version: Protocol version of the body.
 
         :type type: str
         :type source_server_address: tuple
         :type address: tuple
+        :type version: int
 
         :return New Register packet.
         :rtype Packet
@@ -409,34 +719,115 @@ class PacketFactory:
             if not address:
                 raise ValueError("address must be set in request")
 
-            body = Packet.REQUEST + Node.parse_ip(address[0]) + Node.parse_port(address[1])
+            body = Packet.REQUEST.encode() + encode_address(address, version)
 
         else:
-            body = Packet.RESPONSE + Packet.ACK
+            body = (Packet.RESPONSE + Packet.ACK).encode()
 
-        return Packet(1, Packet.TYPE_REGISTER, *source_server_address, body)
+        return Packet(version, Packet.TYPE_REGISTER, *source_server_address, body_for_version(body, version))
 
     @staticmethod
-    def new_message_packet(message, source_server_address):
+    def new_message_packet(message, source_server_address, message_id):
         """
         Packet for sending a broadcast message to the whole network.
 
         :param message: Our message
         :param source_server_address: Server address of the packet sender.
+        :param message_id: (origin_address, sequence); origin_address is the address of the peer which made the message.
 
         :type message: str
         :type source_server_address: tuple
+        :type message_id: tuple
 
         :return: New Message packet.
         :rtype: Packet
         """
+        (origin_ip, origin_port), sequence = message_id
+        body = Node.parse_ip(origin_ip) + Node.parse_port(origin_port) + str(sequence % MESSAGE_SEQUENCE_LIMIT).zfill(8)
 
-        return Packet(1, Packet.TYPE_MESSAGE, *source_server_address, message)
+        return Packet(1, Packet.TYPE_MESSAGE, *source_server_address, body + message)
 
 
 class Parser:
     def __init__(self, packet):
         self._packet = packet
+        self.request_type = None
+
+    def parse_request_type(self):
+        """
+        REQ or RES at the beginning of the body; it is ASCII in every version.
+        """
+        self.request_type = bytes(self._packet.get_body_bytes()[:3]).decode('ascii', 'replace')
+        return self.request_type
+
+
+class RegisterParser(Parser):
+
+    def __init__(self, packet):
+        super(RegisterParser, self).__init__(packet)
+
+        self.address = None
+
+    def is_valid(self):
+        body = self._packet.get_body_bytes()
+        version = self._packet.version
+
+        if self.parse_request_type() == Packet.REQUEST:
+            if len(body) != 3 + ADDRESS_SIZE[version]:
+                return False
+
+            self.address = decode_address(body[3:], version)
+            return self.address is not None
+
+        return self.request_type == Packet.RESPONSE and bytes(body[3:]) == Packet.ACK.encode()
+
+
+class AdvertiseParser(Parser):
+
+    def __init__(self, packet):
+        super(AdvertiseParser, self).__init__(packet)
+
+        self.neighbour = None
+
+    def is_valid(self):
+        body = self._packet.get_body_bytes()
+        version = self._packet.version
+
+        if self.parse_request_type() == Packet.RESPONSE:
+            if len(body) != 3 + ADDRESS_SIZE[version]:
+                return False
+
+            self.neighbour = decode_address(body[3:], version)
+            return self.neighbour is not None
+
+        return self.request_type == Packet.REQUEST and len(body) == 3
+
+
+class MessageParser(Parser):
+
+    ID_LENGTH = 28
+
+    def __init__(self, packet):
+        super(MessageParser, self).__init__(packet)
+
+        self.message_id = None
+        self.origin_address = None
+        self.message = None
+
+    def is_valid(self):
+        body = self._packet.get_body()
+
+        if len(body) < self.ID_LENGTH or not body[20:self.ID_LENGTH].isdigit():
+            return False
+
+        self.origin_address = parse_address(body[:20])
+        if self.origin_address is None:
+            return False
+
+        self.message_id = body[:self.ID_LENGTH]
+        self.message = body[self.ID_LENGTH:]
+
+        return True
 
 
 class ReunionParser(Parser):
@@ -444,36 +835,248 @@ class ReunionParser(Parser):
     def __init__(self, packet):
         super(ReunionParser, self).__init__(packet)
 
-        self.request_type = None
         self.entries = None
+        self.interval = None
 
     def is_valid(self):
-        body = self._packet.get_body()
+        body = self._packet.get_body_bytes()
+        version = self._packet.version
+
+        if version not in Packet.VERSIONS:
+            return False
+
+        request_type = self.parse_request_type()
+        address_size = ADDRESS_SIZE[version]
+
+        if request_type in (Packet.SUMMARY, Packet.SUMMARY_ACK):
+            entries_end = len(body)
+
+            if request_type == Packet.SUMMARY_ACK and (len(body) - 3) % address_size == REUNION_INTERVAL_SIZE[version]:
+                entries_end -= REUNION_INTERVAL_SIZE[version]
+
+            if not self._parse_interval(body[entries_end:], version):
+                return False
 
-        self.request_type = body[:3]
+            self.entries = decode_addresses(body[3:entries_end], version)
+            return bool(self.entries)
 
-        if len(body) <= 5 or (len(body) - 5) % 20 != 0:
+        count_size = ENTRIES_COUNT_SIZE[version]
+
+        if len(body) <= 3 + count_size:
             return False
 
-        try:
-            number_of_entries = int(body[3:5])
-        except ValueError:
+        number_of_entries = decode_entries_count(body[3:3 + count_size], version)
+        if number_of_entries is None:
             return False
 
-        if len(body) != 5 + 20 * number_of_entries:
+        entries_end = 3 + count_size + address_size * number_of_entries
+        if len(body) != entries_end and not (
+                request_type == Packet.RESPONSE and len(body) == entries_end + REUNION_INTERVAL_SIZE[version]
+        ):
             return False
 
-        self.entries = []
+        if not self._parse_interval(body[entries_end:], version):
+            return False
 
-        for i in range(number_of_entries):
-            address = parse_address(body[5 + 20 * i: 5 + 20 * (i + 1)])
-            if address is None:
-                return False
+        self.entries = decode_addresses(body[3 + count_size:entries_end], version)
 
-            self.entries.append(address)
+        return self.entries is not None
 
-        return True
+    def _parse_interval(self, buf, version):
+        if not buf:
+            return True
+
+        self.interval = decode_reunion_interval(buf, version)
+        return self.interval is not None
+
+
+ADDRESS_SIZE = {
+    Packet.VERSION_1: 20,  # 15 characters for ip + 5 characters for port
+    Packet.VERSION_2: 6,  # 4 bytes for ip + 2 bytes for port
+}
+ENTRIES_COUNT_SIZE = {
+    Packet.VERSION_1: 2,
+    Packet.VERSION_2: 1,
+}
+MAX_REUNION_ENTRIES = {
+    Packet.VERSION_1: 99,
+    Packet.VERSION_2: 255,
+}
+REUNION_INTERVAL_SIZE = {
+    Packet.VERSION_1: 6,  # milliseconds in 6 characters
+    Packet.VERSION_2: 4,  # milliseconds in 4 bytes
+}
+MAX_REUNION_INTERVAL = 999.999  # seconds, it fits both versions
+BINARY_ADDRESS = Struct("!4BH")
+
+
+def write_source_server_address(buf: bytearray, source_server_address: tuple):
+    """
+    Overwrite Source Server IP/Port of the packet header in buf.
+    """
+    ip, port = source_server_address
+    pack_into("!HHHHI", buf, 8, *map(int, ip.split('.')), int(port))
+
+
+def reunion_entries_count(packet, request_type):
+    """
+    Check the layout of a Reunion body without parsing its entries.
+
+    :param packet: Reunion packet.
+    :param request_type: Expected request type; REQ or RES.
+
+    :return: Number of Entries or None if the body does not match it.
+    :rtype: int
+    """
+    version = packet.version
+    body = packet.get_body_bytes()
+
+    if packet.get_type() != Packet.TYPE_REUNION or version not in Packet.VERSIONS:
+        return None
+
+    if body[:3] != request_type.encode():
+        return None
+
+    count_size = ENTRIES_COUNT_SIZE[version]
+    if len(body) <= 3 + count_size:
+        return None
+
+    count = decode_entries_count(body[3:3 + count_size], version)
+    if not count:
+        return None
+
+    # A Hello Back may end with the Reunion Interval.
+    extra = len(body) - (3 + count_size + ADDRESS_SIZE[version] * count)
+    if extra != 0 and not (request_type == Packet.RESPONSE and extra == REUNION_INTERVAL_SIZE[version]):
+        return None
+
+    return count
+
+
+def body_for_version(body: bytes, version):
+    """
+    Version 1 bodies are text, keep them as str so that they are decoded only once.
+    """
+    return body.decode() if version == Packet.VERSION_1 else body
+
+
+def encode_address(address: tuple, version) -> bytes:
+    """
+    :param address: The format is like ('192.168.001.001', '05335').
+    :param version: Protocol version of the body.
+
+    :return: The address as it is written in the packet body.
+    :rtype: bytes
+    """
+    ip, port = address
+
+    if version == Packet.VERSION_2:
+        return BINARY_ADDRESS.pack(*map(int, ip.split('.')), int(port))
+
+    return (Node.parse_ip(ip) + Node.parse_port(port)).encode()
+
+
+def decode_address(buf, version) -> tuple:
+    """
+    :param buf: Exactly one address.
+    :param version: Protocol version of the body.
+
+    :return: The address tuple or None if it is not a valid address.
+    """
+    addresses = decode_addresses(buf, version)
+
+    if not addresses or len(addresses) != 1:
+        return None
+
+    return addresses[0]
+
+
+def decode_addresses(buf, version) -> list:
+    """
+    :param buf: Consecutive addresses of a packet body.
+    :param version: Protocol version of the body.
+
+    :return: List of the address tuples or None if any of them is not valid.
+    """
+    if len(buf) % ADDRESS_SIZE[version] != 0:
+        return None
+
+    if version == Packet.VERSION_2:
+        return [('%03d.%03d.%03d.%03d' % entry[:4], '%05d' % entry[4]) for entry in BINARY_ADDRESS.iter_unpack(buf)]
+
+    try:
+        text = bytes(buf).decode('ascii')
+    except UnicodeDecodeError:
+        return None
+
+    addresses = []
+
+    for i in range(0, len(text), 20):
+        address = parse_address(text[i:i + 20])
+        if address is None:
+            return None
+
+        addresses.append(address)
+
+    return addresses
+
+
+def encode_entries_count(count, version) -> bytes:
+    if version == Packet.VERSION_2:
+        return bytes((count,))
+
+    return str(count).zfill(2).encode()
+
+
+def decode_entries_count(buf, version):
+    if version == Packet.VERSION_2:
+        return buf[0]
+
+    buf = bytes(buf)
+
+    if not buf.isdigit():
+        return None
+
+    return int(buf)
+
+
+def encode_reunion_interval(interval, version) -> bytes:
+    """
+    :param interval: Seconds; it is sent in milliseconds and limited to MAX_REUNION_INTERVAL.
+    :param version: Protocol version of the body.
+    """
+    milliseconds = int(round(min(max(interval, 0), MAX_REUNION_INTERVAL) * 1000))
+
+    if version == Packet.VERSION_2:
+        return pack("!I", milliseconds)
+
+    return str(milliseconds).zfill(REUNION_INTERVAL_SIZE[version]).encode()
+
+
+def decode_reunion_interval(buf, version):
+    """
+    :return: The interval in seconds or None if buf is not a valid Reunion Interval.
+    """
+    if len(buf) != REUNION_INTERVAL_SIZE[version]:
+        return None
+
+    if version == Packet.VERSION_2:
+        return unpack("!I", buf)[0] / 1000
+
+    buf = bytes(buf)
+
+    if not buf.isdigit():
+        return None
+
+    return int(buf) / 1000
 
 
 def parse_address(address: str) -> tuple:
-    return Node.parse_ip(address[:15]), Node.parse_port(address[15:])
+    """
+    :param address: 15 characters for ip + 5 characters for port
+    :return: The address tuple or None if it is not a valid address.
+    """
+    try:
+        return Node.parse_ip(address[:15]), Node.parse_port(address[15:])
+    except ValueError:
+        return None
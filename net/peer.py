@@ -1,8 +1,14 @@
+import logging
+import random
+import threading
 import time
 
-from net.packet import Packet, PacketFactory
+from net.async_stream import AsyncStream
+from net.packet import Packet, PacketFactory, MessageParser, MESSAGE_SEQUENCE_LIMIT
 from net.stream import Stream
+from tools.Node import CONNECT_TIMEOUT, MAX_QUEUE_BYTES, MAX_QUEUE_PACKETS, QUEUE_BLOCK
 from net.user_interface import UserInterface
+from tools.SeenCache import SeenCache
 
 """
     Peer is our main object in this project.
@@ -11,11 +17,24 @@ from net.user_interface import UserInterface
     
 """
 
-TIME_STEP = 2
+logger = logging.getLogger(__name__)
+
+TIME_STEP = 2  # the longest time main loop waits when nothing happens
+MAX_PACKETS_PER_UPDATE = 1024  # a burst is handled over several updates, so sends and timers keep running
+
+TRANSPORT_THREADED = 'threaded'
+TRANSPORT_ASYNCIO = 'asyncio'
+
+TRANSPORTS = {
+    TRANSPORT_THREADED: Stream,
+    TRANSPORT_ASYNCIO: AsyncStream,
+}
 
 
 class Peer:
-    def __init__(self, address: tuple):
+    def __init__(self, address: tuple, pipelined_send=True, transport=TRANSPORT_THREADED,
+                 protocol_version=Packet.VERSION_2, connect_timeout=CONNECT_TIMEOUT, max_queue_bytes=MAX_QUEUE_BYTES,
+                 max_queue_packets=MAX_QUEUE_PACKETS, queue_policy=QUEUE_BLOCK):
         """
         The Peer object constructor.
 
@@ -30,19 +49,36 @@ class Peer:
             2. In root Peer, start reunion daemon as soon as possible.
             3. In client Peer, we need to connect to the root of the network, Don't forget to set this connection
                as a register_connection.
+
+        :param address: Server address of this peer.
+        :param pipelined_send: Send packets to other peers without waiting for an ACK per packet.
+        :param transport: Which Stream implementation to use; one of TRANSPORTS keys.
+        :param protocol_version: Packet version of the requests we make; responses use the version of the request.
+        :param connect_timeout: Seconds a connection to another peer may take; it is made in the background.
+        :param max_queue_bytes: Limit of the send queue of every neighbour in bytes.
+        :param max_queue_packets: Limit of the send queue of every neighbour in packets.
+        :param queue_policy: What to do when the send queue of a neighbour is full; one of tools.Node.QUEUE_POLICIES.
         """
 
         self.address = address
+        self.protocol_version = protocol_version
         self._alive = True
+        self._wakeup = threading.Event()
 
-        self.stream = Stream(self.address)
+        self.stream = TRANSPORTS[transport](self.address, pipelined_send=pipelined_send, wakeup=self._wakeup,
+                                            connect_timeout=connect_timeout, max_queue_bytes=max_queue_bytes,
+                                            max_queue_packets=max_queue_packets, queue_policy=queue_policy)
         self._last_update = time.time()
 
-        self.user_interface = UserInterface(self.address)
+        self.user_interface = UserInterface(self.address, wakeup=self._wakeup)
         self.user_interface.start()
 
         self.reunion_active = False
 
+        # Start at a random point so that a restarted peer doesn't reuse the IDs which the others still remember.
+        self._message_sequence = random.randrange(MESSAGE_SEQUENCE_LIMIT)
+        self.seen_messages = SeenCache()
+
     @property
     def is_root(self):
         return False
@@ -59,25 +95,36 @@ class Peer:
             return True
 
         elif command == UserInterface.CMD_MESSAGE:
-            packet = PacketFactory.new_message_packet(args[0], self.address)
+            self._message_sequence += 1
+            packet = PacketFactory.new_message_packet(args[0], self.address, (self.address, self._message_sequence))
+
+            # Our own message may come back through a loop, don't forward it again.
+            parser = MessageParser(packet)
+            parser.is_valid()
+            self.seen_messages.add(parser.message_id)
+
             self.send_broadcast_packet(packet)
             return True
 
     def run(self):
         """
         update loop handler
-        * sleep for at most 2 seconds
+        * wake up as soon as a packet or a user command arrives
+        * otherwise wake up for the next timer deadline, waiting for at most 2 seconds
         """
         while self._alive:
+            # Clear before reading the buffers; anything arriving during update sets it again.
+            self._wakeup.clear()
+
             now_time = time.time()
             delta = now_time - self._last_update
             self._last_update = now_time
 
             self.update(delta)
 
-            sleep_time = TIME_STEP - (time.time() - now_time)
-            if sleep_time > 0.0001:
-                time.sleep(sleep_time)
+            timeout = min(TIME_STEP, self.get_next_timer_deadline() - time.time())
+            if timeout > 0.0001:
+                self._wakeup.wait(timeout)
 
     def update(self, delta: float):
         """
@@ -97,9 +144,17 @@ class Peer:
         :return:
         """
         # Handling in buffer
-        for buf in self.stream.read_and_clear_in_buf():
-            print(buf)
-            packet = PacketFactory.parse_buffer(buf)
+        for buf in self.stream.read_and_clear_in_buf(MAX_PACKETS_PER_UPDATE):
+            logger.debug("Received %r", buf)
+            try:
+                packet = PacketFactory.parse_buffer(buf)
+                if packet.get_type() == Packet.TYPE_MESSAGE:
+                    # Message bodies are text in every version and decoded lazily; reject a malformed one here.
+                    packet.get_body()
+            except ValueError as e:
+                logger.warning("Ignoring invalid packet: %s", e)
+                continue
+
             self.handle_packet(packet)
 
         # Handling user interface
@@ -112,9 +167,20 @@ class Peer:
         if self.reunion_active:
             self.update_reunion()
 
+        if self.stream.get_in_buf_depth():
+            # Don't wait before handling the rest of the burst.
+            self._wakeup.set()
+
     def update_reunion(self):
         pass
 
+    def get_next_timer_deadline(self) -> float:
+        """
+        :return: The time when timer driven work like update_reunion should run again.
+        :rtype: float
+        """
+        return time.time() + TIME_STEP
+
     def run_reunion_daemon(self):
         """
 
@@ -154,8 +220,10 @@ class Peer:
 
         :return:
         """
+        buf = packet.get_buf()
+
         for node in self.stream.get_nodes(ignore_register=True):
-            node.add_message_to_out_buff(packet.get_buf())
+            self._add_message_to_node(node, buf)
 
     def handle_packet(self, packet: Packet):
         """
@@ -173,8 +241,11 @@ class Peer:
 
         _type = packet.get_type()
 
-        print("Packet received")
-        packet.print()
+        logger.debug("Packet received: %s", packet)
+
+        if packet.version not in Packet.VERSIONS:
+            logger.warning("Ignoring packet of unsupported version: %s", packet.version)
+            return
 
         if _type == packet.TYPE_REGISTER:
             self._handle_register_packet(packet)
@@ -192,7 +263,7 @@ class Peer:
             self._handle_reunion_packet(packet)
 
         else:
-            print("Ignoring invalid packet of type: %s" % _type)
+            logger.warning("Ignoring invalid packet of type: %s", _type)
 
     def _handle_advertise_packet(self, packet):
         """
@@ -288,6 +359,7 @@ class Peer:
         Warnings:
             1. Do not forget to ignore messages from unknown sources.
             2. Make sure that you are not sending a message to a register_connection.
+            3. Ignore messages which are already seen; while the network is changing it may not be a tree.
 
         :param packet: Arrived message packet
 
@@ -297,18 +369,32 @@ class Peer:
         """
 
         sender_address = packet.get_source_server_address()
-        message = packet.get_body()
-        print("Message from %s: `%s`" % (sender_address, message))
 
-        if self.is_neighbour(sender_address):
-            for node in self.stream.get_nodes(ignore_register=True):
-                if node.get_server_address() == sender_address:
-                    continue
+        if not self.is_neighbour(sender_address):
+            logger.info("Ignoring message packet from unknown peer %s", sender_address)
+            return
 
-                packet = PacketFactory.new_message_packet(message, self.address)
-                node.add_message_to_out_buff(packet.get_buf())
-        else:
-            print("Ignoring unknown message packet")
+        parser = MessageParser(packet)
+        if not parser.is_valid():
+            logger.warning("Ignoring invalid message packet")
+            return
+
+        if not self.seen_messages.add(parser.message_id):
+            logger.debug("Ignoring duplicate message %s (%d suppressed so far)", parser.message_id,
+                         self.seen_messages.suppressed)
+            return
+
+        message = parser.message
+        print("Message from %s: `%s`" % (parser.origin_address, message))
+
+        # Only the source address changes, every neighbour gets the same buffer.
+        buf = packet.get_buf_with_source(self.address)
+
+        for node in self.stream.get_nodes(ignore_register=True):
+            if node.get_server_address() == sender_address:
+                continue
+
+            self._add_message_to_node(node, buf)
 
     def is_neighbour(self, address):
         """
@@ -326,8 +412,29 @@ class Peer:
     def shutdown(self):
         self._alive = False
         self.reunion_active = False
+        self._wakeup.set()
         self.stream .shutdown()
 
     def send_packet(self, address: tuple, packet: Packet, register_connection=False):
-        node = self.stream.get_or_create_node_to_server(address, register_connection)
-        return node.add_message_to_out_buff(packet.get_buf())
+        try:
+            node = self.stream.get_or_create_node_to_server(address, register_connection)
+        except OSError as e:
+            logger.warning("Creating a connection to %s failed: %s", address, e)
+            return
+
+        self._add_message_to_node(node, packet.get_buf())
+
+    def _add_message_to_node(self, node, buf):
+        """
+        Queue buf to node under the queue policy of our Stream.
+        """
+        self.stream.add_message_to_node(node, buf)
+
+    def print_queue_metrics(self):
+        print("Received packets waiting: %d" % self.stream.get_in_buf_depth())
+        print("Send queues:")
+        for address, metrics in self.stream.get_queue_metrics().items():
+            print("  %s: %d packets / %d bytes queued (peak %d bytes), %d sent, %d dropped" % (
+                str(address), metrics['queued_packets'], metrics['queued_bytes'], metrics['peak_bytes'],
+                metrics['sent_packets'], metrics['dropped_packets']
+            ))
@@ -1,9 +1,25 @@
+import logging
+import random
 import time
 
-from . import UserInterface, Peer, PacketFactory, Packet, ReunionParser
+from . import UserInterface, Peer, PacketFactory, Packet, RegisterParser, AdvertiseParser, ReunionParser
+
+logger = logging.getLogger(__name__)
 
 CLIENT_REUNION_SEND_DELAY = 4
 CLIENT_REUNION_CONNECTIVITY_DEADLINE = 45
+CLIENT_REUNION_JITTER = 0.2  # every interval is up to 20% shorter or longer, so peers don't send together
+
+# Both grow with the interval the root asks for.
+CLIENT_REUNION_RETRY_INTERVALS = 2  # resend a Reunion Hello which is not answered
+CLIENT_REUNION_CONNECTIVITY_INTERVALS = CLIENT_REUNION_CONNECTIVITY_DEADLINE / CLIENT_REUNION_SEND_DELAY
+
+CLIENT_REUNION_RTT_FACTOR = 4  # a Hello is not sent again before this many round trips
+CLIENT_REUNION_RTT_SMOOTHING = 0.125
+
+REUNION_MODE_PATH = 'path'  # every peer sends its own Hello to the root
+REUNION_MODE_AGGREGATED = 'aggregated'  # every peer sends one Summary of its sub-tree to its parent
+REUNION_MODES = (REUNION_MODE_PATH, REUNION_MODE_AGGREGATED)
 
 
 class PeerStatus:
@@ -49,8 +65,16 @@ class PeerStatus:
 
 
 class PeerClient(Peer):
-    def __init__(self, address: tuple, root_address: tuple):
-        super(PeerClient, self).__init__(address)
+    def __init__(self, address: tuple, root_address: tuple, reunion_mode=REUNION_MODE_PATH,
+                 reunion_interval=CLIENT_REUNION_SEND_DELAY, reunion_jitter=CLIENT_REUNION_JITTER, **kwargs):
+        """
+        :param address: (ip, port) of this peer.
+        :param root_address: (ip, port) of the root.
+        :param reunion_mode: One of REUNION_MODES.
+        :param reunion_interval: Seconds between Reunion Hellos; the root may ask for a longer one.
+        :param reunion_jitter: Every interval is randomly stretched or shortened by up to this fraction.
+        """
+        super(PeerClient, self).__init__(address, **kwargs)
 
         self.root_address = root_address
         self.parent_address = None
@@ -59,6 +83,17 @@ class PeerClient(Peer):
         self.last_reunion_request_sent = -1
         self.reunion_sent = False
 
+        self.reunion_mode = reunion_mode
+        self._pending_summaries = {}  # key: child address, value: entries of its last Summary not sent to parent yet
+        self._summary_routes = {}  # key: descendant address, value: the child which reported it
+
+        self.reunion_interval = reunion_interval
+        self.reunion_jitter = reunion_jitter
+        self._root_reunion_interval = None  # asked for in the last Hello Back or Summary Ack
+        self._next_reunion_send = -1
+        self._reunion_retried = False
+        self._reunion_rtt = None  # smoothed seconds from a Hello to its Hello Back
+
     def handle_user_interface_command(self, command, *args):
         if super(PeerClient, self).handle_user_interface_command(command, *args):
             return True
@@ -68,7 +103,8 @@ class PeerClient(Peer):
                 print("Ignoring command because this node is already registered.")
                 return True
 
-            packet = PacketFactory.new_register_packet(Packet.REQUEST, self.address, self.root_address)
+            packet = PacketFactory.new_register_packet(Packet.REQUEST, self.address, self.root_address,
+                                                       version=self.protocol_version)
             self.send_packet(self.root_address, packet, register_connection=True)
 
             return True
@@ -82,6 +118,13 @@ class PeerClient(Peer):
             print("Children: ")
             for node in self.stream.get_nodes(True):
                 print("  " + str(node.get_server_address()))
+            print("Messages: %d accepted, %d duplicates suppressed" % (
+                self.seen_messages.accepted, self.seen_messages.suppressed
+            ))
+            print("Reunion interval: %.1fs, round trip: %s" % (
+                self.get_reunion_interval(), "%.3fs" % self._reunion_rtt if self._reunion_rtt is not None else "-"
+            ))
+            self.print_queue_metrics()
             print("=====================================")
 
             return True
@@ -96,62 +139,94 @@ class PeerClient(Peer):
             print("Ignoring command because this node is already joined.")
             return True
 
-        packet = PacketFactory.new_advertise_packet(Packet.REQUEST, self.address)
+        packet = PacketFactory.new_advertise_packet(Packet.REQUEST, self.address, version=self.protocol_version)
         self.send_packet(self.root_address, packet)
 
         return True
 
     def _handle_register_packet(self, packet: Packet):
-        _type = packet.get_body()[0:3]
+        parser = RegisterParser(packet)
+
+        if not parser.is_valid():
+            logger.warning("Ignoring invalid register packet")
+            return
+
+        _type = parser.request_type
 
         if _type == Packet.REQUEST:
-            print("Ignoring register request packet for client")
+            logger.info("Ignoring register request packet for client")
 
         elif _type == Packet.RESPONSE:
             if self.status.is_registered:
-                print("Ignoring register response packet, because is already registered!")
+                logger.info("Ignoring register response packet, because is already registered!")
 
             else:
                 self.status.set_registered()
-                print("Successfully registered")
+                logger.info("Successfully registered")
 
         else:
-            print("Ignoring invalid register packet")
+            logger.warning("Ignoring invalid register packet")
 
     def _handle_advertise_packet(self, packet: Packet):
-        _type = packet.get_body()[0:3]
+        parser = AdvertiseParser(packet)
+
+        if not parser.is_valid():
+            logger.warning("Ignoring invalid advertise packet")
+            return
+
+        _type = parser.request_type
 
-        print("Requesting for parent")
+        logger.debug("Requesting for parent")
 
         if _type == Packet.REQUEST:
-            print("Ignoring advertise request packet for client")
+            logger.info("Ignoring advertise request packet for client")
 
         elif _type == Packet.RESPONSE:
             if self.status.is_joined:
-                print("Ignoring advertise response packet, because is already joined!")
+                self._move_to_new_parent(packet, parser.neighbour)
 
             else:
-                parent_ip = packet.get_body()[3:18]
-                parent_port = packet.get_body()[18:23]
-
-                if not parent_ip or not parent_port:
-                    print("invalid advertise packet")
-                    return
-
+                parent_ip, parent_port = parser.neighbour
                 self.parent_address = (parent_ip, parent_port)
 
                 self.status.set_advertised()
 
-                print("Sending join message")
-                packet = PacketFactory.new_join_packet((parent_ip, parent_port))
+                logger.info("Sending join message")
+                packet = PacketFactory.new_join_packet(self.address)
                 self.send_packet(self.parent_address, packet)
 
-                print("Starting reunion daemon")
+                logger.info("Starting reunion daemon")
                 self.status.set_joined()
 
                 self.run_reunion_daemon()
         else:
-            print("Ignoring invalid advertise packet")
+            logger.warning("Ignoring invalid advertise packet")
+
+    def _move_to_new_parent(self, packet: Packet, parent_address: tuple):
+        """
+        The root has moved us with our sub-tree because our parent is gone; join the new parent and start reunion
+        again right away. Our children stay connected to us.
+        """
+        if packet.get_source_server_address() != self.root_address:
+            logger.info("Ignoring advertise response packet from non root peer, because is already joined!")
+            return
+
+        if parent_address == self.parent_address:
+            logger.info("Ignoring advertise response packet, because is already joined to this parent!")
+            return
+
+        old_parent = self.stream.get_node_by_server(self.parent_address)
+        if old_parent:
+            self.stream.release_node(old_parent)
+
+        logger.info("Moving from parent %s to %s", self.parent_address, parent_address)
+        self.parent_address = parent_address
+
+        logger.info("Sending join message")
+        self.send_packet(self.parent_address, PacketFactory.new_join_packet(self.address))
+
+        self.run_reunion_daemon()
+        self._next_reunion_send = time.time()
 
     def is_my_child(self, address):
         """
@@ -163,18 +238,19 @@ class PeerClient(Peer):
 
     def _handle_reunion_packet(self, packet):
         if not (self.status.is_joined and self.reunion_active):
-            print("ignoring reunion packet because this peer is not joined or reunion_active")
+            logger.info("Ignoring reunion packet because this peer is not joined or reunion_active")
             return
 
-        parser = ReunionParser(packet)
+        sender_address = packet.get_source_server_address()
+        request_type = ReunionParser(packet).parse_request_type()
 
-        if not parser.is_valid():
-            print("Ignoring invalid reunion packet")
-            return
+        if request_type == Packet.SUMMARY:
+            self._handle_reunion_summary(packet)
 
-        sender_address = packet.get_source_server_address()
+        elif request_type == Packet.SUMMARY_ACK:
+            self._handle_reunion_summary_ack(packet)
 
-        if parser.request_type == Packet.REQUEST:
+        elif request_type == Packet.REQUEST:
             # send request packet to parent
 
             # TODO: handle this later
@@ -182,77 +258,233 @@ class PeerClient(Peer):
             #     print("Ignoring non neighbor reunion request packet")
             #     return
 
-            new_entries = [*parser.entries, self.address]
-            new_packet = PacketFactory.new_reunion_packet(Packet.REQUEST, self.address, new_entries)
+            new_packet = PacketFactory.append_reunion_entry(packet, self.address, self.address)
+            if new_packet is None:
+                logger.warning("Ignoring invalid reunion packet")
+                return
+
             self.send_packet(self.parent_address, new_packet)
 
         else:
             # send response packet to child
             if sender_address != self.parent_address:
-                print("Ignoring reunion response packet from non parent peer")
+                logger.info("Ignoring reunion response packet from non parent peer %s", sender_address)
                 return
 
-            entries = parser.entries
-            if entries[0] != self.address:
-                print("Ignoring invalid reunion packet, it does not sent by me")
+            stripped = PacketFactory.strip_reunion_entry(packet, self.address, self.address)
+            if stripped is None:
+                logger.warning("Ignoring invalid reunion packet, it does not sent by me")
                 return
 
-            print("Hooray... a reunion response received!")
-            self.last_reunion_response_received = time.time()
-            self.reunion_sent = False
+            logger.debug("Hooray... a reunion response received!")
+            child_address, new_packet = stripped
 
-            new_entries = entries[1:]
-            if new_entries:
-                child_address = new_entries[0]
+            if child_address is None:
+                parser = ReunionParser(packet)
+                self._handle_reunion_response(parser.interval if parser.is_valid() else None)
+            else:
+                # The Hello Back of a descendant passed through us, our parent is alive.
+                self.last_reunion_response_received = time.time()
+                self.reunion_sent = False
+
+            if child_address:
                 if not self.is_my_child(child_address):
-                    print("Propagating reunion response packet to bottom failed because the address is not my child")
+                    logger.info("Propagating reunion response packet to %s failed because the address is not my child",
+                                child_address)
                     return
 
-                new_packet = PacketFactory.new_reunion_packet(Packet.RESPONSE, child_address, new_entries)
                 self.send_packet(child_address, new_packet)
 
+    def _handle_reunion_summary(self, packet):
+        """
+        A child has sent the live peers of its sub-tree; remember which child reported them for routing the Summary
+        Ack. In the aggregated mode they are sent to the parent with our next Summary, in the path mode right away.
+        """
+        parser = ReunionParser(packet)
+
+        if not parser.is_valid():
+            logger.warning("Ignoring invalid reunion summary packet")
+            return
+
+        child_address = packet.get_source_server_address()
+
+        if not self.is_my_child(child_address):
+            logger.info("Ignoring reunion summary packet from non child peer %s", child_address)
+            return
+
+        for address, route in list(self._summary_routes.items()):
+            if route == child_address:
+                del self._summary_routes[address]
+
+        for address in parser.entries:
+            self._summary_routes[address] = child_address
+
+        if self.reunion_mode == REUNION_MODE_AGGREGATED:
+            self._pending_summaries[child_address] = parser.entries
+        else:
+            self.send_packet(self.parent_address, Packet.new_packet(packet.get_buf_with_source(self.address)))
+
+    def _handle_reunion_summary_ack(self, packet):
+        """
+        The root has seen the entries of this packet; take it as our reunion response if we are one of them and
+        hand every child the entries it has reported.
+        """
+        if packet.get_source_server_address() != self.parent_address:
+            logger.info("Ignoring reunion summary ack packet from non parent peer")
+            return
+
+        parser = ReunionParser(packet)
+
+        if not parser.is_valid():
+            logger.warning("Ignoring invalid reunion summary ack packet")
+            return
+
+        children_entries = {}
+
+        for address in parser.entries:
+            if address == self.address:
+                logger.debug("Hooray... a reunion summary ack received!")
+                self._handle_reunion_response(parser.interval)
+                continue
+
+            child_address = self._summary_routes.get(address)
+            if child_address:
+                children_entries.setdefault(child_address, []).append(address)
+
+        for child_address, entries in children_entries.items():
+            new_packet = PacketFactory.new_reunion_summary_packet(Packet.SUMMARY_ACK, self.address, entries,
+                                                                  version=packet.version, interval=parser.interval)
+            self.send_packet(child_address, new_packet)
+
+    def _handle_reunion_response(self, interval):
+        """
+        Our own Reunion Hello or Summary is answered.
+
+        :param interval: The interval the root asks for; None if it has not sent one.
+        """
+        now = time.time()
+
+        # Karn's algorithm; after a retry we don't know which Hello is answered.
+        if self.reunion_sent and not self._reunion_retried:
+            rtt = now - self.last_reunion_request_sent
+
+            if self._reunion_rtt is None:
+                self._reunion_rtt = rtt
+            else:
+                self._reunion_rtt += CLIENT_REUNION_RTT_SMOOTHING * (rtt - self._reunion_rtt)
+
+        if interval is not None:
+            self._root_reunion_interval = interval
+
+        self.last_reunion_response_received = now
+        self.reunion_sent = False
+
+    def get_reunion_interval(self):
+        """
+        :return: The configured interval or the one the root has asked for, whichever is longer.
+        """
+        if self._root_reunion_interval is None:
+            return self.reunion_interval
+
+        return max(self.reunion_interval, self._root_reunion_interval)
+
+    def _get_retry_delay(self):
+        delay = CLIENT_REUNION_RETRY_INTERVALS * self.get_reunion_interval()
+
+        if self._reunion_rtt is not None:
+            delay = max(delay, CLIENT_REUNION_RTT_FACTOR * self._reunion_rtt)
+
+        return delay
+
+    def _get_connectivity_deadline(self):
+        return max(CLIENT_REUNION_CONNECTIVITY_DEADLINE,
+                   CLIENT_REUNION_CONNECTIVITY_INTERVALS * self.get_reunion_interval())
+
+    def _schedule_next_reunion(self, now):
+        jitter = random.uniform(-self.reunion_jitter, self.reunion_jitter)
+        self._next_reunion_send = now + self.get_reunion_interval() * (1 + jitter)
+
     def run_reunion_daemon(self):
         super(PeerClient, self).run_reunion_daemon()
-        self.last_reunion_response_received = time.time()
+        now = time.time()
+        self.last_reunion_response_received = now
         self.reunion_sent = False
 
+        # Peers which join together should not send together.
+        self._next_reunion_send = now + random.uniform(0, self.reunion_jitter) * self.get_reunion_interval()
+
     def handle_disconnection(self):
         if not self.status.disconnect():
-            print("Disconnecting failed!")
+            logger.warning("Disconnecting failed!")
             return
 
+        parent = self.stream.get_node_by_server(self.parent_address)
+        if parent:
+            # Kept open in the idle pool; we may be advertised to the same parent again.
+            self.stream.release_node(parent)
+
         self.reunion_active = False
         self.parent_address = None
+        self._pending_summaries = {}
+        self._summary_routes = {}
 
-        print("Peer disconnected from network")
+        logger.warning("Peer disconnected from network")
 
-        print("Sending new advertise packet!")
+        logger.info("Sending new advertise packet!")
         self.send_advertise_packet()
 
     def send_new_reunion_packet(self):
         if not (self.status.is_joined and self.parent_address and self.reunion_active):
-            print("Sending reunion packet failed because peer is not active for sending reunion packet")
-            print("joined: %s, parent_address: %s, reunion_active: %s" % (
-                self.status.is_joined, self.parent_address, self.reunion_active
-            ))
-            print("disabling reunion sending")
+            logger.warning("Sending reunion packet failed because peer is not active for sending reunion packet "
+                           "(joined: %s, parent_address: %s, reunion_active: %s); disabling reunion sending",
+                           self.status.is_joined, self.parent_address, self.reunion_active)
             self.reunion_active = False
             return
 
-        print("Sending new reunion packet")
-        packet = PacketFactory.new_reunion_packet(Packet.REQUEST, self.address, [self.address])
+        if self.reunion_mode == REUNION_MODE_AGGREGATED:
+            logger.debug("Sending new reunion summary packet")
+            entries = [self.address]
+            for child_entries in self._pending_summaries.values():
+                entries.extend(child_entries)
+            self._pending_summaries = {}
+
+            packet = PacketFactory.new_reunion_summary_packet(Packet.SUMMARY, self.address, entries,
+                                                              version=self.protocol_version)
+        else:
+            logger.debug("Sending new reunion packet")
+            packet = PacketFactory.new_reunion_packet(Packet.REQUEST, self.address, [self.address],
+                                                      version=self.protocol_version)
+
+        now = time.time()
         self.send_packet(self.parent_address, packet)
+        self._reunion_retried = self.reunion_sent
         self.reunion_sent = True
+        self.last_reunion_request_sent = now
+        self._schedule_next_reunion(now)
 
     def update_reunion(self):
         now = time.time()
 
-        if now - self.last_reunion_response_received > CLIENT_REUNION_CONNECTIVITY_DEADLINE:
+        if now - self.last_reunion_response_received > self._get_connectivity_deadline():
             self.handle_disconnection()
             return
 
-        if not self.reunion_sent and (
-                self.last_reunion_request_sent < 0 or
-                (now - self.last_reunion_request_sent) > CLIENT_REUNION_SEND_DELAY
-        ):
+        # A Summary carries the sub-tree too, so it is sent every interval even while our own ack is pending.
+        # A Hello may be lost while our sub-tree is moved, so it is sent again after the retry delay.
+        waiting = (self.reunion_sent and self.reunion_mode != REUNION_MODE_AGGREGATED and
+                   now - self.last_reunion_request_sent <= self._get_retry_delay())
+
+        if not waiting and now >= self._next_reunion_send:
             self.send_new_reunion_packet()
+
+    def get_next_timer_deadline(self):
+        if not self.reunion_active:
+            return super(PeerClient, self).get_next_timer_deadline()
+
+        deadline = self.last_reunion_response_received + self._get_connectivity_deadline()
+        next_send = self._next_reunion_send
+
+        if self.reunion_sent and self.reunion_mode != REUNION_MODE_AGGREGATED:
+            next_send = max(next_send, self.last_reunion_request_sent + self._get_retry_delay())
+
+        return min(deadline, next_send)
@@ -1,18 +1,70 @@
+import logging
 import time
 
 from net import UserInterface
-from . import Peer, Packet, PacketFactory, ReunionParser
-from tools.NetworkGraph import NetworkGraph
+from . import Peer, Packet, PacketFactory, RegisterParser, AdvertiseParser, ReunionParser
+from .packet import MAX_REUNION_INTERVAL
+from tools.CompactNetworkGraph import CompactNetworkGraph
+from tools.NetworkGraph import NetworkGraph, MAX_CHILDREN, PLACEMENT_SHALLOWEST
 
+logger = logging.getLogger(__name__)
 
 CLIENT_DISCONNECTION_DEADLINE = 30
+REUNION_CHECK_INTERVAL = 1
+# An expired client whose parent is not seen for about as long waits for its parent; the parent is probably gone.
+PARENT_SILENCE_FRACTION = 0.5  # of the disconnection deadline
+
+REUNION_INTERVAL = 4  # seconds between the Reunion Hellos of a child of the root
+REUNION_DEPTH_SCALE = 0.1  # every level deeper asks for a 10% longer interval
+REUNION_CAPACITY = 1000  # reunion entries per second before the root asks for longer intervals
+REUNION_LOAD_SMOOTHING = 0.2
+# The deadline grows with the longest interval the root has asked for.
+DISCONNECTION_INTERVALS = CLIENT_DISCONNECTION_DEADLINE / REUNION_INTERVAL
+
+GRAPH_OBJECT = 'object'
+GRAPH_COMPACT = 'compact'
+
+GRAPHS = {
+    GRAPH_OBJECT: NetworkGraph,
+    GRAPH_COMPACT: CompactNetworkGraph,
+}
 
 
 class PeerRoot(Peer):
-    def __init__(self, address: tuple):
-        super(PeerRoot, self).__init__(address)
+    def __init__(self, address: tuple, graph=GRAPH_OBJECT, max_children=MAX_CHILDREN, max_depth=None,
+                 placement=PLACEMENT_SHALLOWEST, reunion_interval=REUNION_INTERVAL,
+                 reunion_depth_scale=REUNION_DEPTH_SCALE, reunion_capacity=REUNION_CAPACITY, **kwargs):
+        """
+        :param address: (ip, port) of the root.
+        :param graph: Which NetworkGraph implementation to use; one of GRAPHS keys. The compact one needs much less
+                      memory for very large networks.
+        :param max_children: Fan-out of the network tree.
+        :param max_depth: Peers are not placed deeper than it; advertise requests are left unanswered when the tree
+                          is full. None means no limit.
+        :param placement: How a parent is chosen for a new peer; one of tools.NetworkGraph.PLACEMENTS.
+        :param reunion_interval: Seconds between Reunion Hellos the root asks its children for in Hello Back and
+                                 Summary Ack.
+        :param reunion_depth_scale: Deeper peers are asked for a longer interval; their Hellos take more hops.
+        :param reunion_capacity: Reunion entries per second the root serves; above it every interval is stretched.
+        """
+        super(PeerRoot, self).__init__(address, **kwargs)
 
-        self.graph = NetworkGraph(address)
+        self.graph = GRAPHS[graph](address, max_children=max_children, max_depth=max_depth, placement=placement)
+        self._next_reunion_check = -1
+        self._moved_clients = {}  # key: address of a moved child, value: its last_seen when it was moved
+
+        self.reunion_interval = reunion_interval
+        self.reunion_depth_scale = reunion_depth_scale
+        self.reunion_capacity = reunion_capacity
+        self._reunion_load = 0  # reunion entries since the last load update
+        self._reunion_demand = 0  # smoothed reunion entries per second with the base interval
+        self._reunion_load_factor = 1
+        self._last_load_update = time.time()
+
+        # The longest intervals asked for in the current and in the previous deadline.
+        self._longest_interval = reunion_interval
+        self._previous_longest_interval = reunion_interval
+        self._interval_window_end = -1
         self.run_reunion_daemon()
 
     @property
@@ -27,23 +79,39 @@ class PeerRoot(Peer):
             print("=====================================")
             print("Node Graph")
             self.graph.print()
+            print("Messages: %d accepted, %d duplicates suppressed" % (
+                self.seen_messages.accepted, self.seen_messages.suppressed
+            ))
+            print("Reunion: interval %.1fs, load factor %.2f, disconnection deadline %.0fs" % (
+                self.reunion_interval * self._reunion_load_factor, self._reunion_load_factor,
+                self.get_disconnection_deadline()
+            ))
+            self.print_queue_metrics()
             return True
 
     def _handle_register_packet(self, packet: Packet):
-        _type = packet.get_body()[0:3]
+        parser = RegisterParser(packet)
+
+        if not parser.is_valid():
+            logger.warning("Ignoring invalid register packet")
+            return
 
-        if _type == Packet.REQUEST:
+        if parser.request_type == Packet.REQUEST:
             sender_address = packet.get_source_server_address()
-            resp_packet = PacketFactory.new_register_packet(Packet.RESPONSE, self.address)
+            resp_packet = PacketFactory.new_register_packet(Packet.RESPONSE, self.address, version=packet.version)
 
             self.send_packet(sender_address, resp_packet, register_connection=True)
         else:
-            print("Ignoring register response packet for root")
+            logger.info("Ignoring register response packet for root")
 
     def _handle_advertise_packet(self, packet: Packet):
-        _type = packet.get_body()[0:3]
+        parser = AdvertiseParser(packet)
+
+        if not parser.is_valid():
+            logger.warning("Ignoring invalid advertise packet")
+            return
 
-        if _type == Packet.REQUEST:
+        if parser.request_type == Packet.REQUEST:
             sender_address = packet.get_source_server_address()
             # check if sender is already in graph
             node = self.graph.find_node(sender_address)
@@ -53,24 +121,34 @@ class PeerRoot(Peer):
             else:
                 parent_address = node.parent.address
 
-            resp_packet = PacketFactory.new_advertise_packet(Packet.RESPONSE, self.address, parent_address)
+            if parent_address is None:
+                logger.warning("Ignoring advertise request of %s, the network is full at depth %d", sender_address,
+                               self.graph.max_depth)
+                return
+
+            resp_packet = PacketFactory.new_advertise_packet(Packet.RESPONSE, self.address, parent_address,
+                                                             version=packet.version)
             self.send_packet(sender_address, resp_packet)
 
         else:
-            print("Ignoring advertise response packet for root")
+            logger.info("Ignoring advertise response packet for root")
 
     def _handle_reunion_packet(self, packet: Packet):
         # TODO: don't accept reunion from disconnected peers and its children
         parser = ReunionParser(packet)
 
         if not parser.is_valid():
-            print("Ignoring invalid reunion packet")
+            logger.warning("Ignoring invalid reunion packet")
+            return
+
+        if parser.request_type == Packet.SUMMARY:
+            self._handle_reunion_summary(packet, parser)
             return
 
         neighbor = parser.entries[-1]
 
         if not self.is_neighbour(neighbor):
-            print("Ignoring reunion packet received from non neighbor")
+            logger.info("Ignoring reunion packet received from non neighbor %s", neighbor)
             return
 
         if parser.request_type == Packet.REQUEST:
@@ -79,15 +157,140 @@ class PeerRoot(Peer):
                 if node:
                     node.update_last_seen()
 
-            resp_packet = PacketFactory.new_reunion_packet(Packet.RESPONSE, self.address, list(reversed(parser.entries)))
+            self._reunion_load += 1
+            origin = self.graph.find_node(parser.entries[0])
+            interval = self._ask_reunion_interval(origin.depth if origin else 1)
+
+            resp_packet = PacketFactory.new_reunion_packet(Packet.RESPONSE, self.address, list(reversed(parser.entries)),
+                                                           version=packet.version, interval=interval)
             self.send_packet(neighbor, resp_packet)
 
         else:
-            print("Ignoring reunion response packet")
+            logger.info("Ignoring reunion response packet")
+
+    def _handle_reunion_summary(self, packet: Packet, parser: ReunionParser):
+        """
+        One Summary holds all the live peers under a child of the root; answer it like their Reunion Hellos with a
+        single Summary Ack.
+        """
+        child_address = packet.get_source_server_address()
+
+        if not self.is_neighbour(child_address):
+            logger.info("Ignoring reunion summary packet received from non neighbor %s", child_address)
+            return
+
+        for address in parser.entries:
+            node = self.graph.find_node(address)
+            if node:
+                node.update_last_seen()
+
+        # One interval for the whole sub-tree; a Summary is one packet per link whatever the depth.
+        self._reunion_load += len(parser.entries)
+        resp_packet = PacketFactory.new_reunion_summary_packet(Packet.SUMMARY_ACK, self.address, parser.entries,
+                                                               version=packet.version,
+                                                               interval=self._ask_reunion_interval(1))
+        self.send_packet(child_address, resp_packet)
 
     def update_reunion(self):
-        active_threshold = time.time() - CLIENT_DISCONNECTION_DEADLINE
+        now = time.time()
+
+        # The main loop wakes up for every packet, expiry doesn't need to run that often.
+        if now < self._next_reunion_check:
+            return
+
+        self._next_reunion_check = now + REUNION_CHECK_INTERVAL
+        self._update_reunion_load(now)
+        self._rotate_interval_window(now)
+
+        deadline = self.get_disconnection_deadline()
+        active_threshold = now - deadline
+
+        # Parents first; their children are moved and seen again before they are checked.
+        inactive_clients = sorted(self.graph.get_inactive_nodes(active_threshold), key=lambda node: node.depth)
+
+        for client in inactive_clients:
+            if not client.alive or client.last_seen >= active_threshold:
+                # Already removed with the sub-tree of its ancestor, or moved.
+                continue
+
+            parent = client.parent
+            if client.depth > 1 and parent.last_seen < client.last_seen + deadline * PARENT_SILENCE_FRACTION:
+                continue
+
+            if self._moved_clients.pop(client.address, None) == client.last_seen:
+                logger.info("Removing client %s with its sub-tree, it is not seen since it was moved", client.address)
+                self._remove_client(client)
+                continue
+
+            logger.info("Removing client %s because of late reunion", client.address)
+            self._remove_client(client, keep_children=True)
+
+    def _remove_client(self, client, keep_children=False):
+        """
+        Remove client from the graph; with keep_children its children keep their sub-trees under new parents.
+
+        A moved child gets a new Advertise Response and its sub-tree gets one more disconnection deadline for its
+        Reunion Hellos to arrive through the new parent; if the child is not seen by then, it is removed with its
+        sub-tree.
+        """
+        subtree = list(client.iter_subtree())
+        moved_children = self.graph.remove_node(client, keep_children=keep_children)
+
+        for node in subtree:
+            if not node.alive:
+                self._moved_clients.pop(node.address, None)
+
+        for child in moved_children:
+            parent_address = child.parent.address
+            logger.info("Moving client %s under %s", child.address, parent_address)
+
+            for node in child.iter_subtree():
+                node.update_last_seen()
+
+            self._moved_clients[child.address] = child.last_seen
+
+            resp_packet = PacketFactory.new_advertise_packet(Packet.RESPONSE, self.address, parent_address,
+                                                             version=self.protocol_version)
+            self.send_packet(child.address, resp_packet)
+
+    def _ask_reunion_interval(self, depth):
+        """
+        :param depth: Depth of the peer which the interval is for.
+        :return: Seconds between Reunion Hellos the peer should wait; longer for deeper peers and while the root is
+                 loaded.
+        """
+        interval = self.reunion_interval * self._reunion_load_factor * (1 + self.reunion_depth_scale * (depth - 1))
+        interval = min(interval, MAX_REUNION_INTERVAL)
+        self._longest_interval = max(self._longest_interval, interval)
+
+        return interval
+
+    def _update_reunion_load(self, now):
+        elapsed = now - self._last_load_update
+        if elapsed <= 0:
+            return
+
+        # What the peers would send with the base interval; the current load is lowered by the current factor.
+        demand = self._reunion_load * self._reunion_load_factor / elapsed
+        self._reunion_demand += REUNION_LOAD_SMOOTHING * (demand - self._reunion_demand)
+        self._reunion_load_factor = max(1, self._reunion_demand / self.reunion_capacity)
+
+        self._reunion_load = 0
+        self._last_load_update = now
+
+    def get_disconnection_deadline(self):
+        """
+        A peer may still wait for the longest interval it was asked for in the previous deadline, so both windows
+        count.
+        """
+        return max(CLIENT_DISCONNECTION_DEADLINE,
+                   DISCONNECTION_INTERVALS * max(self._longest_interval, self._previous_longest_interval))
+
+    def _rotate_interval_window(self, now):
+        if now >= self._interval_window_end:
+            self._previous_longest_interval = self._longest_interval
+            self._longest_interval = self.reunion_interval
+            self._interval_window_end = now + self.get_disconnection_deadline()
 
-        for client in self.graph.get_inactive_nodes(active_threshold):
-            print("Removing client %s because of late reunion" % str(client.address))
-            self.graph.remove_node(client)
+    def get_next_timer_deadline(self):
+        return self._next_reunion_check
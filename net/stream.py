@@ -1,12 +1,24 @@
+import logging
+from collections import OrderedDict
+
 from tools.simpletcp.tcpserver import TCPServer
 
-from tools.Node import Node
+from net.packet import PacketDecoder
+from tools.Handoff import Handoff
+from tools.Node import Node, CONNECT_TIMEOUT, MAX_QUEUE_BYTES, MAX_QUEUE_PACKETS, QUEUE_BLOCK, QUEUE_DISCONNECT
 import threading
 
+logger = logging.getLogger(__name__)
+
+SERVER_RECEIVE_BYTES = 256 * 1024
+MAX_IDLE_NODES = 16  # released connections kept open for reuse
+
 
 class Stream:
 
-    def __init__(self, address: tuple):
+    def __init__(self, address: tuple, pipelined_send=True, wakeup=None, connect_timeout=CONNECT_TIMEOUT,
+                 max_queue_bytes=MAX_QUEUE_BYTES, max_queue_packets=MAX_QUEUE_PACKETS, queue_policy=QUEUE_BLOCK,
+                 sender_threads=True):
         """
         The Stream object constructor.
 
@@ -14,28 +26,97 @@ class Stream:
             1. Make a separate Thread for your TCPServer and start immediately.
 
         :param address: (ip, port) 15 characters for ip + 5 characters for port
+        :param pipelined_send: If set, nodes don't wait for an ACK after every packet they send.
+        :param wakeup: threading.Event which is set whenever a new packet is received or a new connection is ready.
+        :param connect_timeout: Seconds a new connection may take; a node which fails to connect is removed.
+        :param max_queue_bytes: Limit of the out buffer of every node in bytes.
+        :param max_queue_packets: Limit of the out buffer of every node in packets.
+        :param queue_policy: What to do when the out buffer of a node is full; one of tools.Node.QUEUE_POLICIES.
+        :param sender_threads: Every node sends its out buffer from its own thread, so a slow peer doesn't hold the
+                               main loop back.
         """
 
         self.address = address
+        self.pipelined_send = pipelined_send
+        self.connect_timeout = connect_timeout
+        self.sender_threads = sender_threads
+        self.queue_options = {
+            'max_queue_bytes': max_queue_bytes,
+            'max_queue_packets': max_queue_packets,
+            'queue_policy': queue_policy,
+        }
+        self._wakeup = wakeup
+
+        # Filled by the server thread, drained by the main loop.
+        self._server_in_buf = Handoff(wakeup)
+        # One connection per peer; the register connection and the neighbour connection to a peer are channels of
+        # the same Node, see Node.channels.
+        self._nodes = {}  # key: server_address, value: Node
+        self._idle_nodes = OrderedDict()  # key: server_address, value: released Node, oldest first
+        self._decoders = {}  # key: connection address, value: PacketDecoder
+
+        real_address = Node.real_address(address)
+        self._server = self._start_server(real_address)
 
-        self._server_in_buf = []
-        self._nodes = {}  # key: (server_address, registered), value: Node
+    def _start_server(self, real_address):
+        """
+        Start receiving packets on our server address.
+
+        :param real_address: Our server address in the socket format; e.g. ('127.0.0.1', 7000).
+
+        :return: The server object which is closed on shutdown.
+        """
 
         def callback(address, queue, data):
             """
             The callback function will run when a new data received from server_buffer.
 
+            The data is only a chunk of the connection stream; it is reassembled into whole packets and every
+            completed packet is acknowledged separately.
+
             :param address: Source address.
             :param queue: Response queue.
             :param data: The data received from the socket.
             :return:
+
+            :raise ConnectionError: If the stream can't be reassembled; the server drops the connection.
             """
-            queue.put(bytes('ACK', 'utf8'))
-            self._server_in_buf.append(data)
+            decoder = self._decoders.get(address)
+            if decoder is None:
+                decoder = self._decoders[address] = PacketDecoder()
 
-        real_address = Node.real_address(address)
-        self._server = Server(*real_address, callback)
-        self._server.start()
+            try:
+                count = self._handle_received_data(decoder, data)
+            except ValueError as e:
+                logger.warning("Dropping the connection from %s: %s", address, e)
+                raise ConnectionError(e)
+
+            for _ in range(count):
+                queue.put(bytes('ACK', 'utf8'))
+
+        def close_callback(address):
+            self._decoders.pop(address, None)
+
+        server = Server(*real_address, callback, close_callback)
+        server.start()
+
+        return server
+
+    def _handle_received_data(self, decoder, data) -> int:
+        """
+        Put the packets completed by data into our in buffer.
+
+        :param decoder: PacketDecoder of the connection which data is received from.
+        :param data: The data received from the socket.
+
+        :return: Number of completed packets.
+        :rtype: int
+        """
+        packets = decoder.feed(data)
+
+        self._server_in_buf.put_many(packets)
+
+        return len(packets)
 
     def get_server_address(self):
         """
@@ -49,6 +130,9 @@ class Stream:
         """
         Will add new a node to our Stream.
 
+        If there is a connection to server_address already, it is shared; a released one is taken back from the idle
+        pool. Only a peer which we have no connection to gets a new one.
+
         :param server_address: New node TCPServer address.
         :param set_register_connection: Shows that is this connection a register_connection or not.
 
@@ -57,12 +141,28 @@ class Stream:
 
         :return:
         """
+        node = self._nodes.get(server_address) or self._idle_nodes.pop(server_address, None)
+
+        if node is None:
+            node = self._create_node(server_address, set_register_connection)
 
-        node = Node(server_address, set_register=set_register_connection)
-        self._nodes[server_address, set_register_connection] = node
+        node.channels.add(set_register_connection)
+        self._nodes[server_address] = node
 
         return node
 
+    def _create_node(self, server_address, set_register_connection) -> Node:
+        return Node(server_address, set_register=set_register_connection, pipelined=self.pipelined_send,
+                    connect_timeout=self.connect_timeout, on_connect=self._on_connect,
+                    sender_thread=self.sender_threads, **self.queue_options)
+
+    def _on_connect(self):
+        """
+        A node has connected or failed to connect or send; wake the main loop up to flush or remove it.
+        """
+        if self._wakeup:
+            self._wakeup.set()
+
     def remove_node(self, node):
         """
         Remove the node from our Stream.
@@ -75,15 +175,41 @@ class Stream:
 
         :return:
         """
-        key = None
-        for _key, value in self._nodes.items():
-            if value == node:
-                key = _key
-                break
+        address = node.get_server_address()
+
+        if self._nodes.get(address) is node:
+            del self._nodes[address]
+        elif self._idle_nodes.get(address) is node:
+            del self._idle_nodes[address]
+        else:
+            return
+
+        node.channels.clear()
+        node.close()
+
+    def release_node(self, node, register_connection=False):
+        """
+        We don't use the node for register_connection anymore; when none of its channels is left, its connection is
+        kept open in the idle pool, so talking to the peer again, e.g. after a rejoin, needs no new connection.
+
+        :param node: The node we want to release.
+        :param register_connection: The channel to release.
+        """
+        address = node.get_server_address()
 
-        if key:
-            del self._nodes[key]
-            node.close()
+        if self._nodes.get(address) is not node:
+            return
+
+        node.channels.discard(register_connection)
+        if node.channels:
+            return
+
+        del self._nodes[address]
+        self._idle_nodes[address] = node
+
+        while len(self._idle_nodes) > MAX_IDLE_NODES:
+            _, oldest = self._idle_nodes.popitem(last=False)
+            oldest.close()
 
     def get_node_by_server(self, address: tuple, register_connection=False) -> Node:
         """
@@ -96,10 +222,15 @@ class Stream:
         :param address: input address (IP, Port) tuple
         :param register_connection:
 
-        :return: The node that input address.
+        :return: The node that input address if it is used for register_connection.
         :rtype: Node
         """
-        return self._nodes.get((address, register_connection))
+        node = self._nodes.get(address)
+
+        if node is not None and register_connection in node.channels:
+            return node
+
+        return None
 
     def get_or_create_node_to_server(self, address: tuple, register_connection=False) -> Node:
         """
@@ -114,19 +245,107 @@ class Stream:
 
         return node
 
-    def read_and_clear_in_buf(self) -> list:
-        in_bufs = self._server_in_buf
-        self._server_in_buf = []
-        return in_bufs
+    def read_and_clear_in_buf(self, max_packets=None) -> list:
+        """
+        :param max_packets: Take at most this many packets; the rest stay for the next call.
+
+        :return: The received packets, oldest first.
+        :rtype: list
+        """
+        return self._server_in_buf.drain(max_packets)
+
+    def get_in_buf_depth(self) -> int:
+        """
+        :return: Number of received packets which are not read yet.
+        """
+        return len(self._server_in_buf)
 
     def send_out_buf_messages(self):
         """
         In this function, we will send whole out buffers to their own clients.
 
+        A node which is still connecting keeps its buffer; one which failed to connect or lost its connection is
+        removed, so the others are not held back by it.
+
         :return:
         """
-        for node in self._nodes.values():  # type: Node
-            node.send_message()
+        # Packets may be queued to a node before it is released.
+        for node in self._get_all_nodes():  # type: Node
+            self.send_node_messages(node)
+
+    def add_message_to_node(self, node, message) -> bool:
+        """
+        Queue message to node under its queue policy.
+
+        When out buffer of the node is full, QUEUE_BLOCK sends its packets first and waits at most
+        tools.Node.BLOCK_TIMEOUT for room before message is dropped, and QUEUE_DISCONNECT removes the slow neighbour;
+        the drop policies are applied by the node. Under QUEUE_BLOCK a node which has reached its high-water mark is
+        flushed right away, so a burst can't pile up in memory until the end of the update.
+
+        :param node: The node we want to send message to.
+        :param message: The packet buffer.
+
+        :return: Whether message is queued.
+        :rtype: bool
+        """
+        # An oversized message is dropped by the node; it is no reason to wait for or remove the node.
+        if not node.has_room_for(message) and not node.is_oversized(message):
+            if node.queue_policy == QUEUE_BLOCK:
+                # A node which can't make room in time, e.g. one still connecting or a slow one, drops message.
+                if not self.send_node_messages(node, room_for=message):
+                    return False
+
+            elif node.queue_policy == QUEUE_DISCONNECT:
+                logger.warning("Out buffer of %s is full; removing the slow neighbour", node.get_server_address())
+                self.remove_node(node)
+                return False
+
+        if not node.add_message_to_out_buff(message):
+            return False
+
+        if node.queue_policy == QUEUE_BLOCK and node.is_over_high_water():
+            self.send_node_messages(node)
+
+        return True
+
+    def send_node_messages(self, node, room_for=None):
+        """
+        Send the out buffer of one node; the node is removed if its connection fails.
+
+        :param node: The node we want to flush.
+        :param room_for: Wait a little for the sender thread of the node to make room for this packet.
+        :type node: Node
+
+        :return: Whether the node is still usable.
+        :rtype: bool
+        """
+        try:
+            node.send_message(room_for)
+        except OSError as e:
+            logger.warning("Sending to %s failed: %s; removing the node", node.get_server_address(), e)
+            self.remove_node(node)
+            return False
+
+        return True
+
+    def _get_all_nodes(self) -> list:
+        return list(self._nodes.values()) + list(self._idle_nodes.values())
+
+    def get_queue_metrics(self) -> dict:
+        """
+        :return: Out buffer metrics of every connection; key: server address.
+        :rtype: dict
+        """
+        return {
+            address: {
+                'queued_packets': len(node.out_buff),
+                'queued_bytes': node.out_buff_bytes,
+                'peak_bytes': node.peak_out_buff_bytes,
+                'sent_packets': node.sent_packets,
+                'dropped_packets': node.dropped_packets,
+            }
+            for address, node in list(self._nodes.items()) + list(self._idle_nodes.items())
+        }
 
     def get_nodes(self, ignore_register=False) -> list:
         if not ignore_register:
@@ -134,8 +353,8 @@ class Stream:
 
         nodes = []
 
-        for (_, registered), node in self._nodes.items():
-            if not registered:
+        for node in self._nodes.values():
+            if False in node.channels:
                 nodes.append(node)
 
         return nodes
@@ -145,20 +364,18 @@ class Stream:
         self._server.join(1)
         self._server = None
 
-        for c in self._nodes.values():  # type: Node
+        for c in self._get_all_nodes():  # type: Node
             c.close()
 
 
 class Server(threading.Thread):
 
-    def __init__(self, ip, port, read_callback, *args, **kwargs):
+    def __init__(self, ip, port, read_callback, close_callback=None, *args, **kwargs):
         super(Server, self).__init__(*args, **kwargs)
-        self.tcp_server = TCPServer(ip, port, read_callback, maximum_connections=1024)
-        self.shutdown = False
-
+        self.tcp_server = TCPServer(ip, port, read_callback, maximum_connections=1024,
+                                    receive_bytes=SERVER_RECEIVE_BYTES, close_callback=close_callback)
     def run(self):
-        while not self.shutdown:
-            self.tcp_server.run()
+        self.tcp_server.run()
 
     def close(self):
-        self.shutdown = True
+        self.tcp_server.close()
@@ -1,6 +1,8 @@
 import threading
 import shlex
 
+from tools.Handoff import Handoff
+
 
 class UserInterface(threading.Thread):
 
@@ -12,9 +14,14 @@ class UserInterface(threading.Thread):
 
     VALID_COMMANDS = (CMD_EXIT, CMD_REGISTER, CMD_ADVERTISE, CMD_MESSAGE, CMD_STATUS)
 
-    def __init__(self, address, is_root=False, *args, **kwargs):
+    def __init__(self, address, is_root=False, wakeup=None, *args, **kwargs):
+        """
+        :param address: Address of our peer, shown in the prompt.
+        :param is_root: Whether our peer is the root or not.
+        :param wakeup: threading.Event which is set whenever a new command is buffered.
+        """
         super(UserInterface, self).__init__(*args, **kwargs)
-        self._buffer = []
+        self._buffer = Handoff(wakeup)
         self._address = address
         self._is_root = is_root
 
@@ -49,7 +56,7 @@ class UserInterface(threading.Thread):
                 continue
 
             if cmd in self.VALID_COMMANDS:
-                self._buffer.append(command_parts)
+                self._buffer.put(command_parts)
 
                 if cmd == self.CMD_EXIT:
                     break
@@ -57,6 +64,4 @@ class UserInterface(threading.Thread):
         print("Goodbye")
 
     def read_and_clear_buffer(self):
-        buffer = self._buffer
-        self._buffer = []
-        return buffer
+        return self._buffer.drain()
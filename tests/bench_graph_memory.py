@@ -0,0 +1,42 @@
+import sys
+import time
+import tracemalloc
+
+from tools.CompactNetworkGraph import CompactNetworkGraph
+from tools.NetworkGraph import NetworkGraph
+
+"""
+    Memory of the object NetworkGraph and the array-backed CompactNetworkGraph for a large network.
+
+    Usage: PYTHONPATH=. python tests/bench_graph_memory.py [nodes]
+"""
+
+
+def address(i):
+    return "10.%03d.%03d.%03d" % ((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff), "%05d" % (5000 + (i >> 24))
+
+
+def run(graph_class, count):
+    tracemalloc.start()
+
+    start = time.time()
+    graph = graph_class(address(0))
+    for i in range(1, count + 1):
+        graph.insert_node(address(i))
+    elapsed = time.time() - start
+
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print("%-20s %7d nodes: %7.1f MB (%5.0f bytes/node), peak %7.1f MB, built in %.2fs" % (
+        graph_class.__name__, count, current / 2 ** 20, current / count, peak / 2 ** 20, elapsed
+    ))
+
+    return graph
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    run(NetworkGraph, count)
+    run(CompactNetworkGraph, count)
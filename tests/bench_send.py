@@ -0,0 +1,59 @@
+import sys
+import time
+
+from net import PacketFactory
+from net.stream import Stream
+from tools.Node import Node
+
+"""
+    Throughput of Node.send_message with and without pipelining.
+
+    Usage: PYTHONPATH=. python tests/bench_send.py [packets] [body size]
+"""
+
+server = ("127.000.000.001", "17100")
+sender = ("127.000.000.001", "17101")
+
+
+def wait_for(stream, count, timeout=30):
+    received = 0
+    deadline = time.time() + timeout
+
+    while received < count and time.time() < deadline:
+        received += len(stream.read_and_clear_in_buf())
+        time.sleep(0.001)
+
+    return received
+
+
+def run(stream, pipelined, count, size):
+    buf = PacketFactory.new_message_packet("x" * size, sender, (sender, 1)).get_buf()
+    node = Node(server, pipelined=pipelined, max_queue_packets=count, max_queue_bytes=count * len(buf))
+
+    start = time.time()
+    for _ in range(count):
+        node.add_message_to_out_buff(buf)
+    # The node connects in the background; its packets wait until then.
+    while node.out_buff:
+        node.send_message()
+    received = wait_for(stream, count)
+    elapsed = time.time() - start
+
+    node.close()
+
+    print("%-10s %6d/%d packets in %.3fs -> %10.0f packets/s" % (
+        "pipelined" if pipelined else "ack", received, count, elapsed, received / elapsed
+    ))
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+
+    stream = Stream(server)
+    time.sleep(0.2)
+
+    run(stream, False, count, size)
+    run(stream, True, count, size)
+
+    stream.shutdown()
@@ -0,0 +1,94 @@
+import socket
+import sys
+import threading
+import time
+
+from net import PacketFactory
+from net.stream import Stream
+from tools.Node import Node, QUEUE_BLOCK, QUEUE_DROP_OLDEST
+
+"""
+    Main loop latency of a Stream whose neighbours include slow receivers, with and without sender threads, under
+    the default block policy and under drop-oldest.
+
+    Every tick queues one broadcast to all neighbours and flushes the out buffers, like Peer.update does; the slow
+    receivers read a little and sleep, so their sockets fill up.
+
+    Usage: PYTHONPATH=. python tests/bench_slow_receivers.py [ticks] [slow receivers] [fast receivers]
+"""
+
+BASE_PORT = 17200
+SLOW_READ_BYTES = 4096
+SLOW_READ_DELAY = 0.05
+QUEUE_BYTES = 256 * 1024  # small enough for the out buffers of the slow receivers to fill up
+
+
+def address(port):
+    return Node.parse_address(("127.0.0.1", port))
+
+
+def slow_receiver(port, stop):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SLOW_READ_BYTES)
+    server.bind(("127.0.0.1", port))
+    server.listen(1)
+    connection, _ = server.accept()
+
+    while not stop.is_set():
+        if not connection.recv(SLOW_READ_BYTES):
+            break
+        time.sleep(SLOW_READ_DELAY)
+
+    connection.close()
+    server.close()
+
+
+def run(sender_threads, queue_policy, ticks, slow_count, fast_count, base_port):
+    stop = threading.Event()
+    fast_streams = [Stream(address(base_port + 1 + i)) for i in range(fast_count)]
+    slow_ports = [base_port + 1 + fast_count + i for i in range(slow_count)]
+    for port in slow_ports:
+        threading.Thread(target=slow_receiver, args=(port, stop), daemon=True).start()
+    time.sleep(0.2)
+
+    stream = Stream(address(base_port), max_queue_bytes=QUEUE_BYTES, queue_policy=queue_policy,
+                    sender_threads=sender_threads)
+    nodes = [stream.add_node(fast.get_server_address()) for fast in fast_streams]
+    nodes += [stream.add_node(address(port)) for port in slow_ports]
+
+    buf = PacketFactory.new_message_packet("x" * 1024, stream.address, (stream.address, 1)).get_buf()
+    latencies = []
+
+    for _ in range(ticks):
+        start = time.time()
+        for node in nodes:
+            stream.add_message_to_node(node, buf)
+        stream.send_out_buf_messages()
+        latencies.append(time.time() - start)
+
+    received = sum(len(fast.read_and_clear_in_buf()) for fast in fast_streams)
+    dropped = sum(metrics['dropped_packets'] for metrics in stream.get_queue_metrics().values())
+    latencies.sort()
+
+    print("%-12s %-16s ticks: median %7.3fms, p99 %8.3fms, max %8.3fms; %d packets at the fast receivers, "
+          "%d dropped" % (
+              queue_policy, "sender threads" if sender_threads else "main loop",
+              latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000,
+              latencies[-1] * 1000, received, dropped
+          ))
+
+    stop.set()
+    stream.shutdown()
+    for fast in fast_streams:
+        fast.shutdown()
+
+
+if __name__ == '__main__':
+    ticks = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    slow_count = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    fast_count = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+    for i, queue_policy in enumerate((QUEUE_BLOCK, QUEUE_DROP_OLDEST)):
+        run(False, queue_policy, ticks, slow_count, fast_count, BASE_PORT + 100 * i)
+        run(True, queue_policy, ticks, slow_count, fast_count, BASE_PORT + 100 * i + 50)
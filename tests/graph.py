@@ -0,0 +1,192 @@
+import random
+
+import tools.CompactNetworkGraph as CompactNetworkGraphModule
+import tools.NetworkGraph as NetworkGraphModule
+from tools.CompactNetworkGraph import CompactNetworkGraph
+from tools.NetworkGraph import NetworkGraph, PLACEMENT_SHALLOWEST, PLACEMENT_BALANCED, PLACEMENTS
+
+
+class Clock:
+    now = 0
+
+    def time(self):
+        return self.now
+
+
+def address(i):
+    return "127.000.000.001", str(i).zfill(5)
+
+
+def bfs(graph):
+    nodes = []
+    to_visit_nodes = [graph.root]
+
+    while to_visit_nodes:
+        node = to_visit_nodes.pop(0)
+        nodes.append(node)
+        to_visit_nodes.extend(node.children)
+
+    return nodes
+
+
+def check_invariants(graph, removed_nodes):
+    """
+    Compare the incrementally maintained state of graph with a rebuild from its tree.
+    """
+    nodes = bfs(graph)
+
+    assert graph.address_to_node_map == {node.address: node for node in nodes}
+    assert all(graph.address_to_node_map[node.address] == node for node in nodes)
+
+    for node in nodes:
+        assert node.alive
+        assert len(node.children) <= graph.max_children
+        assert node.depth == (node.parent.depth + 1 if node.parent else 0)
+        assert node.subtree_size == len(list(node.iter_subtree()))
+
+        if graph.max_depth is not None:
+            assert node.depth <= graph.max_depth
+
+        for child in node.children:
+            assert child.parent == node
+
+    # Indices of the compact graph are reused, so its old handles may point to new nodes.
+    if isinstance(graph, NetworkGraph):
+        for node in removed_nodes:
+            assert not node.alive
+
+    for address in {node.address for node in removed_nodes} - {node.address for node in nodes}:
+        assert address not in graph.address_to_node_map
+
+
+def best_depth(graph):
+    return min(node.depth for node in bfs(graph) if len(node.children) < graph.max_children)
+
+
+if __name__ == '__main__':
+    for graph_class in (NetworkGraph, CompactNetworkGraph):
+        for max_children in (1, 2, 5):
+            random.seed(12)
+            graph = graph_class(address(0), max_children=max_children)
+
+            # Parent of a new node is always one of the shallowest nodes with an open slot.
+            for i in range(1, 300):
+                depth = best_depth(graph)
+                parent_address = graph.insert_node(address(i))
+                parent = next(node for node in bfs(graph) if node.address == parent_address)
+                assert parent.depth == depth
+
+                if i % 7 == 0:
+                    nodes = bfs(graph)[1:]
+                    graph.remove_node(random.choice(nodes))
+
+        # Balanced placement keeps the branches of the root within one node of each other.
+        graph = graph_class(address(0), max_children=3, placement=PLACEMENT_BALANCED)
+        for i in range(1, 300):
+            graph.insert_node(address(i))
+
+            sizes = [child.subtree_size for child in graph.root.children]
+            assert max(sizes) - min(sizes) <= 1
+
+        # The depth cap is never passed; a full graph doesn't accept new nodes.
+        for placement in (PLACEMENT_SHALLOWEST, PLACEMENT_BALANCED):
+            graph = graph_class(address(0), max_children=3, max_depth=2, placement=placement)
+            parents = [graph.insert_node(address(i)) for i in range(1, 14)]
+
+            assert None not in parents[:12]
+            assert parents[12] is None
+            assert graph.find_node(address(13)) is None
+            check_invariants(graph, [])
+
+            graph.remove_node(graph.root.children[0])
+            assert graph.insert_node(address(13)) is not None
+
+        # Children of a removed node keep their sub-trees under new parents.
+        graph = graph_class(address(0))
+        for i in range(1, 32):
+            graph.insert_node(address(i))
+
+        node = graph.root.children[0]
+        children = {child.address for child in node.children}
+        kept = {kept.address for child in node.children for kept in child.iter_subtree()}
+        moved_children = graph.remove_node(node, keep_children=True)
+
+        assert {child.address for child in moved_children} == children
+        assert all(graph.find_node(address) for address in kept)
+        assert graph.find_node(node.address) is None
+        assert graph.root.subtree_size == 31
+        check_invariants(graph, [])
+
+        # Nothing in the removed sub-tree becomes a new parent; the children move under the other branch.
+        for max_depth in (3, None):
+            for placement in PLACEMENTS:
+                graph = graph_class(address(0), max_children=2, max_depth=max_depth, placement=placement)
+                for i in range(1, 7):
+                    graph.insert_node(address(i))
+
+                node, other = graph.root.children
+                children = {child.address for child in node.children}
+                other_children = {child.address for child in other.children}
+                moved_children = graph.remove_node(node, keep_children=True)
+
+                assert {child.address for child in moved_children} == children
+                assert all(child.parent.address in other_children and child.depth == 3 for child in moved_children)
+                check_invariants(graph, [])
+
+        # Random inserts, removals and reparents keep the graph consistent.
+        for seed in range(20):
+            random.seed(seed)
+            graph = graph_class(address(0), max_children=random.randint(1, 4), max_depth=random.choice((None, 4)),
+                                placement=random.choice((PLACEMENT_SHALLOWEST, PLACEMENT_BALANCED)))
+            removed_nodes = []
+
+            for _ in range(300):
+                operation = random.random()
+                nodes = bfs(graph)
+
+                if operation < 0.6 or len(nodes) == 1:
+                    graph.insert_node(address(random.randint(1, 120)))
+
+                elif operation < 0.75:
+                    node = random.choice(nodes[1:])
+                    subtree = list(node.iter_subtree())
+                    moved_children = graph.remove_node(node, keep_children=random.random() < 0.5)
+
+                    for child in moved_children:
+                        assert child.alive and child.parent.alive and child.parent != node
+
+                    removed_nodes.extend(removed for removed in subtree if not removed.alive)
+
+                else:
+                    node = random.choice(nodes[1:])
+                    parents = [parent for parent in nodes
+                               if len(parent.children) < graph.max_children and not parent.is_in_subtree_of(node) and
+                               (graph.max_depth is None or parent.depth + node.subtree_size < graph.max_depth)]
+                    if parents:
+                        graph.reparent(node, random.choice(parents))
+
+                check_invariants(graph, removed_nodes)
+
+        # Inactive nodes match a walk over the tree.
+        clock = Clock()
+        NetworkGraphModule.time = clock
+        CompactNetworkGraphModule.time = clock
+
+        graph = graph_class(address(0))
+        for i in range(1, 200):
+            graph.insert_node(address(i))
+
+        nodes = bfs(graph)[1:]
+        for now in range(1, 100):
+            clock.now = now
+            for node in random.sample(nodes, 5):
+                node.update_last_seen()
+
+            if now % 10 == 0:
+                threshold = now - random.randint(0, 30)
+                expected = {node.address for node in bfs(graph)[1:] if node.last_seen < threshold}
+                inactive = graph.get_inactive_nodes(threshold)
+                assert {node.address for node in inactive} == expected
+
+                if inactive:
+                    graph.remove_node(random.choice(inactive))
@@ -0,0 +1,49 @@
+import threading
+
+from tools.Handoff import Handoff
+
+PRODUCERS = 4
+ITEMS_PER_PRODUCER = 50000
+
+if __name__ == '__main__':
+    wakeup = threading.Event()
+    handoff = Handoff(wakeup)
+
+    assert handoff.drain() == [] and not wakeup.is_set()
+    handoff.put_many([])
+    assert not wakeup.is_set()
+
+    handoff.put(0)
+    assert wakeup.is_set()
+    handoff.put_many(range(1, 10))
+    assert len(handoff) == 10
+
+    # Oldest first, at most max_items at a time.
+    assert handoff.drain(3) == [0, 1, 2]
+    assert handoff.drain(0) == []
+    assert handoff.drain(4) == [3, 4, 5, 6]
+    assert handoff.drain(5) == [7, 8, 9]
+    assert handoff.drain() == [] and len(handoff) == 0
+
+    # Producers put while the consumer drains; nothing is lost and every producer's items keep their order.
+    handoff = Handoff()
+
+    def produce(producer):
+        for i in range(0, ITEMS_PER_PRODUCER, 10):
+            handoff.put((producer, i))
+            handoff.put_many((producer, j) for j in range(i + 1, i + 10))
+
+    producers = [threading.Thread(target=produce, args=(producer,)) for producer in range(PRODUCERS)]
+    for thread in producers:
+        thread.start()
+
+    received = []
+    while any(thread.is_alive() for thread in producers) or len(handoff):
+        received.extend(handoff.drain(1000))
+
+    for thread in producers:
+        thread.join()
+
+    assert len(received) == PRODUCERS * ITEMS_PER_PRODUCER
+    for producer in range(PRODUCERS):
+        assert [i for p, i in received if p == producer] == list(range(ITEMS_PER_PRODUCER))
@@ -0,0 +1,289 @@
+import socket
+import threading
+import time
+from struct import pack
+
+from net import PacketFactory
+import net.stream as StreamModule
+from net.async_stream import AsyncStream
+from net.stream import Stream, Server
+from tools.Node import Node, BLOCK_TIMEOUT, QUEUE_BLOCK, QUEUE_DROP_OLDEST, QUEUE_DROP_NEWEST, QUEUE_DISCONNECT
+
+BASE_PORT = 17500
+
+
+def address(port):
+    return Node.parse_address(("127.0.0.1", port))
+
+
+def message(i, size=100):
+    """
+    :return: Buffer of a Message packet of size bytes; i is the sequence of its ID.
+    """
+    sender = address(BASE_PORT)
+    return PacketFactory.new_message_packet("x" * (size - 48), sender, (sender, i)).get_buf()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def receive(stream, count):
+    received = []
+    wait_for(lambda: received.extend(stream.read_and_clear_in_buf()) or len(received) >= count)
+    return received
+
+
+def listen(port, on_accept):
+    """
+    A bare server which hands the accepted connection to on_accept.
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    server.bind(("127.0.0.1", port))
+    server.listen(1)
+
+    def accept():
+        connection, _ = server.accept()
+        on_accept(connection)
+
+    threading.Thread(target=accept, daemon=True).start()
+    return server
+
+
+def reset(connection):
+    # Let the client connect first, its packets fail then.
+    time.sleep(0.2)
+    connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, pack("ii", 1, 0))
+    connection.close()
+
+
+if __name__ == '__main__':
+    receiver = Stream(address(BASE_PORT))
+
+    # Limits of out_buff; nothing is sent while it is only filled.
+    node = Node(address(BASE_PORT), max_queue_bytes=1000, max_queue_packets=5, queue_policy=QUEUE_DROP_NEWEST)
+    assert all(node.add_message_to_out_buff(message(i)) for i in range(5))
+    assert not node.add_message_to_out_buff(message(5))
+    assert list(node.out_buff) == [message(i) for i in range(5)]
+    assert node.out_buff_bytes == 500 and node.dropped_packets == 1
+    node.close()
+
+    node = Node(address(BASE_PORT), max_queue_bytes=1000, max_queue_packets=5, queue_policy=QUEUE_DROP_NEWEST)
+    assert all(node.add_message_to_out_buff(message(i, 300)) for i in range(3))
+    assert not node.add_message_to_out_buff(message(3, 300))
+    assert node.add_message_to_out_buff(message(4))
+    assert node.out_buff_bytes == 1000 and node.peak_out_buff_bytes == 1000
+    node.close()
+
+    # The oldest packets make room; a message bigger than the whole buffer doesn't flush it.
+    node = Node(address(BASE_PORT), max_queue_bytes=1000, max_queue_packets=5, queue_policy=QUEUE_DROP_OLDEST)
+    assert all(node.add_message_to_out_buff(message(i)) for i in range(7))
+    assert list(node.out_buff) == [message(i) for i in range(2, 7)]
+    assert node.add_message_to_out_buff(message(7, 400))
+    assert list(node.out_buff) == [message(i) for i in range(3, 7)] + [message(7, 400)]
+    assert not node.add_message_to_out_buff(message(8, 1001))
+    assert list(node.out_buff) == [message(i) for i in range(3, 7)] + [message(7, 400)]
+    assert node.out_buff_bytes == 800 and node.dropped_packets == 4
+    assert node.sent_packets == 0
+    node.close()
+
+    # Policies applied by the Stream, with the main loop sending.
+    for i, policy in enumerate((QUEUE_BLOCK, QUEUE_DROP_OLDEST, QUEUE_DROP_NEWEST, QUEUE_DISCONNECT)):
+        stream = Stream(address(BASE_PORT + 1 + i), max_queue_packets=3, queue_policy=policy, sender_threads=False)
+        node = stream.add_node(receiver.get_server_address())
+        wait_for(lambda: not node.client.pending)
+
+        queued = [stream.add_message_to_node(node, message(j)) for j in range(4)]
+        metrics = stream.get_queue_metrics()
+
+        if policy == QUEUE_DISCONNECT:
+            assert queued == [True, True, True, False]
+            assert receiver.get_server_address() not in metrics
+            assert receive(receiver, 0) == []
+            stream.shutdown()
+            continue
+
+        stream.send_out_buf_messages()
+        metrics = stream.get_queue_metrics()[receiver.get_server_address()]
+
+        if policy == QUEUE_BLOCK:
+            # The full buffer is sent to make room.
+            assert queued == [True] * 4
+            expected = [message(j) for j in range(4)]
+        elif policy == QUEUE_DROP_OLDEST:
+            assert queued == [True] * 4
+            expected = [message(j) for j in range(1, 4)]
+        else:
+            assert queued == [True, True, True, False]
+            expected = [message(j) for j in range(3)]
+
+        assert receive(receiver, len(expected)) == expected
+        assert metrics == {
+            'queued_packets': 0,
+            'queued_bytes': 0,
+            'peak_bytes': 300,
+            'sent_packets': len(expected),
+            'dropped_packets': 4 - len(expected),
+        }
+
+        stream.shutdown()
+
+    # The sender thread sends in order and stops on close.
+    node = Node(receiver.get_server_address(), pipelined=True, sender_thread=True)
+    for j in range(100):
+        node.add_message_to_out_buff(message(j))
+    node.send_message()
+
+    assert receive(receiver, 100) == [message(j) for j in range(100)]
+    wait_for(lambda: node.sent_packets == 100)
+    node.close()
+    assert not node._sender.is_alive()
+
+    # A failed send is raised to the caller of send_message and the Stream removes the node.
+    reset_address = address(BASE_PORT + 10)
+    server = listen(BASE_PORT + 10, reset)
+    stream = Stream(address(BASE_PORT + 11))
+    node = stream.add_node(reset_address)
+
+    def send():
+        stream.add_message_to_node(node, message(0))
+        stream.send_out_buf_messages()
+        return reset_address not in stream.get_queue_metrics()
+
+    wait_for(send)
+    assert node.client.connect_error is None and isinstance(node.send_error, OSError)
+    try:
+        node.send_message()
+        assert False
+    except OSError:
+        pass
+    assert not node._sender.is_alive()
+    stream.shutdown()
+    server.close()
+
+    # Under QUEUE_BLOCK a neighbour which doesn't read holds the producer back at most once for BLOCK_TIMEOUT; its
+    # packets are dropped then.
+    connections = []
+    server = listen(BASE_PORT + 12, connections.append)
+    stream = Stream(address(BASE_PORT + 13), max_queue_bytes=64 * 1024, queue_policy=QUEUE_BLOCK)
+    node = stream.add_node(address(BASE_PORT + 12))
+
+    for j in range(10000):
+        start = time.time()
+        if not stream.add_message_to_node(node, message(j, 32 * 1024)):
+            break
+    else:
+        assert False
+
+    assert BLOCK_TIMEOUT * 0.5 <= time.time() - start < BLOCK_TIMEOUT * 10
+    start = time.time()
+    assert not any(stream.add_message_to_node(node, message(j, 32 * 1024)) for j in range(100))
+    assert time.time() - start < BLOCK_TIMEOUT
+    assert stream.get_queue_metrics()[address(BASE_PORT + 12)]['dropped_packets'] == 101
+    stream.shutdown()
+    server.close()
+
+    receiver.shutdown()
+
+    # A server closed before its thread runs still stops, and its port is free again.
+    server = Server("127.0.0.1", BASE_PORT, lambda address, queue, data: None)
+    server.close()
+    server.start()
+    server.join(1)
+    assert not server.is_alive()
+    Stream(address(BASE_PORT)).shutdown()
+
+    # The asyncio transport talks to both transports in order and its event loop stops on shutdown.
+    async_stream = AsyncStream(address(BASE_PORT + 20))
+    for other in (AsyncStream(address(BASE_PORT + 21)), Stream(address(BASE_PORT + 22))):
+        for sender, receiver in ((async_stream, other), (other, async_stream)):
+            node = sender.add_node(receiver.get_server_address())
+            for j in range(1000):
+                assert sender.add_message_to_node(node, message(j))
+            sender.send_out_buf_messages()
+
+            assert receive(receiver, 1000) == [message(j) for j in range(1000)]
+            assert sender.get_queue_metrics()[receiver.get_server_address()]['sent_packets'] == 1000
+
+        other.shutdown()
+        if isinstance(other, AsyncStream):
+            assert not other._loop_thread.is_alive()
+
+    # A neighbour which refuses the connection is removed.
+    refused_address = address(BASE_PORT + 23)
+    node = async_stream.add_node(refused_address)
+    async_stream.add_message_to_node(node, message(0))
+    wait_for(lambda: async_stream.send_out_buf_messages() or refused_address not in async_stream.get_queue_metrics())
+    assert isinstance(node.client.connect_error, ConnectionRefusedError) and node.client.closed
+
+    async_stream.shutdown()
+    assert not async_stream._loop_thread.is_alive()
+
+    # Both channels to a peer share one connection; a released one is kept in the idle pool and reused, the least
+    # recently released is closed when the pool is full.
+    StreamModule.MAX_IDLE_NODES = 2
+    servers = []
+    for port in range(BASE_PORT + 30, BASE_PORT + 34):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(("127.0.0.1", port))
+        server.listen(4)
+        servers.append(server)
+
+    stream = Stream(address(BASE_PORT + 35))
+    register_node = stream.add_node(address(BASE_PORT + 30), set_register_connection=True)
+    node = stream.add_node(address(BASE_PORT + 30))
+    assert node is register_node and node.channels == {True, False}
+
+    stream.release_node(node, register_connection=True)
+    assert stream.get_node_by_server(address(BASE_PORT + 30)) is node
+    stream.release_node(node)
+    assert stream.get_node_by_server(address(BASE_PORT + 30)) is None
+    assert stream.add_node(address(BASE_PORT + 30)) is node and not node.client.closed
+
+    nodes = [stream.add_node(address(port)) for port in range(BASE_PORT + 30, BASE_PORT + 34)]
+    stream.release_node(nodes[0])
+    stream.release_node(nodes[1])
+    assert stream.add_node(address(BASE_PORT + 30)) is nodes[0]
+    for node in (nodes[2], nodes[0], nodes[3]):
+        stream.release_node(node)
+
+    # Released in the order 1, 2, 0, 3 into a pool of two.
+    assert [node.client.closed for node in nodes] == [False, True, True, False]
+    assert set(stream.get_queue_metrics()) == {address(BASE_PORT + 30), address(BASE_PORT + 33)}
+    assert stream.add_node(address(BASE_PORT + 31)) is not nodes[1]
+
+    stream.shutdown()
+    for server in servers:
+        server.close()
+
+    # A connection which is refused or takes longer than connect_timeout fails in the background; the Stream removes
+    # the node on its next flush.
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", BASE_PORT + 40))
+    server.listen(0)
+    backlog = []
+    for _ in range(4):
+        connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        connection.setblocking(False)
+        connection.connect_ex(("127.0.0.1", BASE_PORT + 40))
+        backlog.append(connection)
+
+    stream = Stream(address(BASE_PORT + 41), connect_timeout=0.2)
+    for port, error in ((BASE_PORT + 40, socket.timeout), (BASE_PORT + 42, ConnectionRefusedError)):
+        node = stream.add_node(address(port))
+        assert stream.add_message_to_node(node, message(0))
+        wait_for(lambda: not node.client.pending)
+
+        assert isinstance(node.client.connect_error, error)
+        assert address(port) in stream.get_queue_metrics()
+        stream.send_out_buf_messages()
+        assert address(port) not in stream.get_queue_metrics()
+
+    stream.shutdown()
+    server.close()
+    for connection in backlog:
+        connection.close()
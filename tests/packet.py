@@ -1,4 +1,7 @@
-from net import PacketFactory, Packet
+from struct import pack
+
+from net import PacketFactory, PacketDecoder, MessageParser, RegisterParser, AdvertiseParser, ReunionParser, Packet
+from net.packet import encode_reunion_interval, HEADER_SIZE, MESSAGE_SEQUENCE_LIMIT
 
 sender = ("127.000.000.001", 31315)
 root = ("127.000.000.001", 5356)
@@ -26,8 +29,38 @@ if __name__ == '__main__':
     packet = PacketFactory.new_reunion_packet(Packet.RESPONSE, root, [sender])
     assert packet.get_buf() == b'\x00\x01\x00\x05\x00\x00\x00\x19\x00\x7f\x00\x00\x00\x00\x00\x01\x00\x00\x14\xecRES01127.000.000.00131315'
 
-    packet = PacketFactory.new_message_packet("Hi", sender)
-    assert packet.get_buf() == b'\x00\x01\x00\x04\x00\x00\x00\x02\x00\x7f\x00\x00\x00\x00\x00\x01\x00\x00zSHi'
+    packet = PacketFactory.new_message_packet("Hi", sender, (child, 7))
+    assert packet.get_buf() == b'\x00\x01\x00\x04\x00\x00\x00\x1e\x00\x7f\x00\x00\x00\x00\x00\x01\x00\x00zS' \
+                               b'127.000.000.0013131800000007Hi'
+
+    parser = MessageParser(packet)
+    assert parser.is_valid()
+    assert parser.message_id == '127.000.000.0013131800000007'
+    assert parser.origin_address == ('127.000.000.001', '31318')
+    assert parser.message == 'Hi'
+
+    # Message IDs keep 8 digits of the sequence; it wraps at MESSAGE_SEQUENCE_LIMIT.
+    for sequence, digits in ((0, '00000000'), (MESSAGE_SEQUENCE_LIMIT - 1, '99999999'),
+                             (MESSAGE_SEQUENCE_LIMIT, '00000000'), (3 * MESSAGE_SEQUENCE_LIMIT + 42, '00000042')):
+        buf = PacketFactory.new_message_packet("Hi", root, (child, sequence)).get_buf()
+        parser = MessageParser(Packet.new_packet(buf))
+        assert parser.is_valid()
+        assert parser.message_id == '127.000.000.00131318' + digits
+        assert len(parser.message_id) == MessageParser.ID_LENGTH
+        assert parser.origin_address == ('127.000.000.001', '31318') and parser.message == 'Hi'
+
+    # A body without a valid ID, e.g. plain text of a peer which predates the IDs, is not a message.
+    assert not MessageParser(Packet(1, Packet.TYPE_MESSAGE, *sender, 'Hi')).is_valid()
+    assert not MessageParser(Packet(1, Packet.TYPE_MESSAGE, *sender, '127.000.000.00131318 0000007Hi')).is_valid()
+
+    parsed = Packet.new_packet(packet.get_buf())
+    assert parsed.get_buf() is packet.get_buf()
+    assert parsed.get_source_server_address() == ('127.000.000.001', '31315')
+    assert bytes(parsed.get_body_bytes()) == b'127.000.000.0013131800000007Hi'
+    assert parsed.get_body() == '127.000.000.0013131800000007Hi'
+
+    forwarded = Packet.new_packet(packet.get_buf()).get_buf_with_source(root)
+    assert forwarded == PacketFactory.new_message_packet("Hi", root, (child, 7)).get_buf()
 
     # Reunion Hello with 3 peers:
     packet = PacketFactory.new_reunion_packet(Packet.REQUEST, child, [child])
@@ -43,7 +76,104 @@ if __name__ == '__main__':
     packet = PacketFactory.new_reunion_packet(Packet.RESPONSE, sender, [child])
     assert packet.get_buf() == b'\x00\x01\x00\x05\x00\x00\x00\x19\x00\x7f\x00\x00\x00\x00\x00\x01\x00\x00zSRES01127.000.000.00131318'
 
-
-
-
-
+    # Framing: split and coalesced packets
+    first = PacketFactory.new_message_packet("Hi", sender, (sender, 1)).get_buf()
+    second = PacketFactory.new_join_packet(sender).get_buf()
+    stream = first + second
+
+    decoder = PacketDecoder()
+    assert decoder.feed(stream[:7]) == []
+    assert decoder.feed(stream[7:55]) == [first]
+    assert decoder.pending() == 5
+    assert decoder.feed(stream[55:]) == [second]
+    assert decoder.pending() == 0
+
+    decoder = PacketDecoder()
+    assert decoder.feed(stream + stream[:1]) == [first, second]
+    assert decoder.feed(stream[1:]) == [first, second]
+
+    decoder = PacketDecoder(max_length=len(first) - HEADER_SIZE - 1)
+    try:
+        decoder.feed(first[:HEADER_SIZE])
+        assert False
+    except ValueError:
+        pass
+
+    # Version 2 bodies
+    packet = PacketFactory.new_register_packet(Packet.REQUEST, sender, sender, version=2)
+    assert packet.get_buf() == b'\x00\x02\x00\x01\x00\x00\x00\x09\x00\x7f\x00\x00\x00\x00\x00\x01\x00\x00zSREQ\x7f\x00\x00\x01zS'
+    parser = RegisterParser(Packet.new_packet(packet.get_buf()))
+    assert parser.is_valid() and parser.address == ('127.000.000.001', '31315')
+
+    packet = PacketFactory.new_advertise_packet(Packet.RESPONSE, root, root, version=2)
+    parser = AdvertiseParser(Packet.new_packet(packet.get_buf()))
+    assert parser.is_valid() and parser.neighbour == ('127.000.000.001', '05356')
+
+    packet = PacketFactory.new_reunion_packet(Packet.REQUEST, sender, [child, sender], version=2)
+    assert packet.get_buf() == b'\x00\x02\x00\x05\x00\x00\x00\x10\x00\x7f\x00\x00\x00\x00\x00\x01\x00\x00zS' \
+                               b'REQ\x02\x7f\x00\x00\x01zV\x7f\x00\x00\x01zS'
+    parser = ReunionParser(Packet.new_packet(packet.get_buf()))
+    assert parser.is_valid()
+    assert parser.request_type == Packet.REQUEST
+    assert parser.entries == [('127.000.000.001', '31318'), ('127.000.000.001', '31315')]
+
+    # Version 1 is still accepted
+    packet = PacketFactory.new_reunion_packet(Packet.RESPONSE, root, [sender, child])
+    parser = ReunionParser(Packet.new_packet(packet.get_buf()))
+    assert parser.is_valid() and parser.entries == [('127.000.000.001', '31315'), ('127.000.000.001', '31318')]
+
+    # Forwarding Reunion packets in place
+    for version in Packet.VERSIONS:
+        hello = PacketFactory.new_reunion_packet(Packet.REQUEST, child, [child], version=version)
+        forwarded = PacketFactory.append_reunion_entry(Packet.new_packet(hello.get_buf()), sender, sender)
+        expected = PacketFactory.new_reunion_packet(Packet.REQUEST, sender, [child, sender], version=version)
+        assert forwarded.get_buf() == expected.get_buf()
+
+        hello_back = PacketFactory.new_reunion_packet(Packet.RESPONSE, root, [sender, child], version=version)
+        next_address, forwarded = PacketFactory.strip_reunion_entry(Packet.new_packet(hello_back.get_buf()), sender,
+                                                                    sender)
+        expected = PacketFactory.new_reunion_packet(Packet.RESPONSE, sender, [child], version=version)
+        assert next_address == ('127.000.000.001', '31318')
+        assert forwarded.get_buf() == expected.get_buf()
+
+        assert PacketFactory.strip_reunion_entry(forwarded, child, child) == (None, None)
+        assert PacketFactory.strip_reunion_entry(forwarded, sender, sender) is None
+        assert PacketFactory.append_reunion_entry(hello_back, sender, sender) is None
+
+    # Reunion Summary
+    for version in Packet.VERSIONS:
+        packet = PacketFactory.new_reunion_summary_packet(Packet.SUMMARY, sender, [sender, child], version=version)
+        parser = ReunionParser(Packet.new_packet(packet.get_buf()))
+        assert parser.is_valid() and parser.request_type == Packet.SUMMARY
+        assert parser.entries == [('127.000.000.001', '31315'), ('127.000.000.001', '31318')]
+
+    packet = PacketFactory.new_reunion_summary_packet(Packet.SUMMARY_ACK, root, [child])
+    assert packet.get_buf() == b'\x00\x01\x00\x05\x00\x00\x00\x17\x00\x7f\x00\x00\x00\x00\x00\x01\x00\x00\x14\xec' \
+                               b'SAK127.000.000.00131318'
+
+    # Reunion Interval of Hello Back and Summary Ack
+    packet = PacketFactory.new_reunion_packet(Packet.RESPONSE, root, [child], interval=4.5)
+    assert packet.get_body_bytes() == b'RES01127.000.000.00131318004500'
+
+    for version in Packet.VERSIONS:
+        hello_back = PacketFactory.new_reunion_packet(Packet.RESPONSE, root, [sender, child], version=version,
+                                                      interval=6.25)
+        next_address, forwarded = PacketFactory.strip_reunion_entry(Packet.new_packet(hello_back.get_buf()), sender,
+                                                                    sender)
+        parser = ReunionParser(forwarded)
+        assert parser.is_valid() and parser.entries == [('127.000.000.001', '31318')] and parser.interval == 6.25
+        assert PacketFactory.strip_reunion_entry(forwarded, child, child) == (None, None)
+
+        hello = PacketFactory.new_reunion_packet(Packet.REQUEST, child, [child], version=version)
+        parser = ReunionParser(hello)
+        assert parser.is_valid() and parser.interval is None
+
+        summary_ack = PacketFactory.new_reunion_summary_packet(Packet.SUMMARY_ACK, root, [sender, child],
+                                                               version=version, interval=12)
+        parser = ReunionParser(Packet.new_packet(summary_ack.get_buf()))
+        assert parser.is_valid()
+        assert parser.interval == 12 and parser.entries == [('127.000.000.001', '31315'), ('127.000.000.001', '31318')]
+
+        # A Hello must not carry an interval.
+        buf = hello.get_buf() + encode_reunion_interval(1, version)
+        assert not ReunionParser(Packet.new_packet(buf[:4] + pack("!I", len(buf) - 20) + buf[8:])).is_valid()
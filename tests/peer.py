@@ -0,0 +1,66 @@
+import threading
+import time
+
+from net.peer import Peer, TIME_STEP
+
+
+class TimerPeer(Peer):
+    """
+    A Peer without a Stream whose only timer fires interval seconds after every update.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.updates = []
+        self._alive = True
+        self._wakeup = threading.Event()
+        self._last_update = time.time()
+
+    def update(self, delta: float):
+        self.updates.append(time.time())
+
+    def get_next_timer_deadline(self) -> float:
+        return self.updates[-1] + self.interval
+
+    def stop(self):
+        self._alive = False
+        self._wakeup.set()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+if __name__ == '__main__':
+    # The loop waits for the nearest timer, not for a whole TIME_STEP.
+    peer = TimerPeer(0.2)
+    thread = threading.Thread(target=peer.run, daemon=True)
+    thread.start()
+    wait_for(lambda: len(peer.updates) >= 4)
+    peer.stop()
+    thread.join(1)
+    assert not thread.is_alive()
+
+    gaps = [b - a for a, b in zip(peer.updates, peer.updates[1:4])]
+    assert all(0.15 <= gap < 0.5 for gap in gaps), gaps
+
+    # A timer beyond TIME_STEP is waited for in steps of TIME_STEP; setting the wakeup event runs the loop at once.
+    peer = TimerPeer(TIME_STEP * 10)
+    thread = threading.Thread(target=peer.run, daemon=True)
+    thread.start()
+    wait_for(lambda: len(peer.updates) == 1)
+
+    for _ in range(3):
+        count = len(peer.updates)
+        time.sleep(0.05)
+        woken = time.time()
+        peer._wakeup.set()
+        wait_for(lambda: len(peer.updates) > count, TIME_STEP / 4)
+        assert peer.updates[count] - woken < 0.2
+
+    peer.stop()
+    thread.join(1)
+    assert not thread.is_alive()
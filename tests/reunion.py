@@ -0,0 +1,245 @@
+import net.peer as PeerModule
+import net.peer_client as PeerClientModule
+import net.peer_root as PeerRootModule
+import tools.CompactNetworkGraph as CompactNetworkGraphModule
+import tools.NetworkGraph as NetworkGraphModule
+from net import Packet, PacketFactory, ReunionParser, UserInterface
+from net.packet import MAX_REUNION_INTERVAL
+from net.peer_client import PeerClient, REUNION_MODE_AGGREGATED, CLIENT_REUNION_SEND_DELAY, CLIENT_REUNION_JITTER, \
+    CLIENT_REUNION_RETRY_INTERVALS, CLIENT_REUNION_RTT_SMOOTHING
+from net.peer_root import PeerRoot, GRAPHS, REUNION_INTERVAL, REUNION_DEPTH_SCALE
+
+TRANSPORT_MEMORY = 'memory'
+
+root_address = ("127.000.000.001", "06000")
+a, b, c, d = [("127.000.000.001", "0600%d" % i) for i in range(1, 5)]
+
+# Packets queued by every MemoryStream: (source, destination, buf).
+queued = []
+
+
+class Clock:
+    now = 0
+
+    def time(self):
+        return self.now
+
+
+class Random:
+    """
+    uniform(low, high) is always the same fraction of the way from low to high.
+    """
+    fraction = 0
+
+    def uniform(self, low, high):
+        return low + (high - low) * self.fraction
+
+
+class MemoryNode:
+    def __init__(self, address):
+        self.address = address
+        self.channels = set()
+
+    def get_server_address(self):
+        return self.address
+
+
+class MemoryStream:
+    """
+    A Stream without sockets; its packets wait in queued until they are delivered.
+    """
+
+    def __init__(self, address, **kwargs):
+        self.address = address
+        self.nodes = {}
+
+    def add_node(self, server_address, set_register_connection=False):
+        node = self.nodes.setdefault(server_address, MemoryNode(server_address))
+        node.channels.add(set_register_connection)
+        return node
+
+    def release_node(self, node, register_connection=False):
+        node.channels.discard(register_connection)
+
+    def get_node_by_server(self, address, register_connection=False):
+        node = self.nodes.get(address)
+        return node if node is not None and register_connection in node.channels else None
+
+    def get_or_create_node_to_server(self, address, register_connection=False):
+        return self.get_node_by_server(address, register_connection) or self.add_node(address, register_connection)
+
+    def get_nodes(self, ignore_register=False):
+        return [node for node in self.nodes.values() if False in node.channels]
+
+    def add_message_to_node(self, node, buf):
+        queued.append((self.address, node.address, buf))
+        return True
+
+    def shutdown(self):
+        pass
+
+
+class IdleInterface(UserInterface):
+    """
+    Takes no commands; they are handed to the peers directly.
+    """
+
+    def start(self):
+        pass
+
+
+def deliver(peers):
+    """
+    Hand every queued packet to its destination, and the packets they send in turn.
+
+    :return: (source, destination, packet) of the delivered packets, in order.
+    """
+    delivered = []
+
+    while queued:
+        source, destination, buf = queued.pop(0)
+        packet = PacketFactory.parse_buffer(buf)
+        delivered.append((source, destination, packet))
+        peers[destination].handle_packet(packet)
+
+    return delivered
+
+
+def join(peers, address):
+    peer = peers[address]
+    peer.handle_user_interface_command(UserInterface.CMD_REGISTER)
+    deliver(peers)
+    peer.handle_user_interface_command(UserInterface.CMD_ADVERTISE)
+    deliver(peers)
+    assert peer.status.is_joined
+
+
+def summary_acks(delivered):
+    acks = {}
+
+    for source, destination, packet in delivered:
+        parser = ReunionParser(packet)
+        if parser.is_valid() and parser.request_type == Packet.SUMMARY_ACK:
+            acks[(source, destination)] = (sorted(parser.entries), parser.interval)
+
+    return acks
+
+
+if __name__ == '__main__':
+    clock = Clock()
+    for module in (PeerClientModule, PeerRootModule, NetworkGraphModule, CompactNetworkGraphModule):
+        module.time = clock
+
+    rand = Random()
+    PeerClientModule.random = rand
+
+    PeerModule.TRANSPORTS[TRANSPORT_MEMORY] = MemoryStream
+    PeerModule.UserInterface = IdleInterface
+
+    # Aggregated reunion: the root sees the whole tree in the Summaries of its children and its Summary Acks are split
+    # down the tree, every peer gets the entry of its own.
+    for graph in GRAPHS:
+        clock.now = 0
+        peers = {root_address: PeerRoot(root_address, graph=graph, max_children=2, transport=TRANSPORT_MEMORY)}
+        for address in (a, b, c, d):
+            peers[address] = PeerClient(address, root_address, reunion_mode=REUNION_MODE_AGGREGATED,
+                                        transport=TRANSPORT_MEMORY)
+            join(peers, address)
+
+        root = peers[root_address]
+        assert root.graph.find_node(c).parent.address == a and root.graph.find_node(d).parent.address == a
+        assert root.graph.find_node(b).parent.address == root_address
+
+        # Leaves first; a peer sends the Summaries of its children with its own.
+        clock.now = 10
+        for address in (c, d):
+            peers[address].send_new_reunion_packet()
+        deliver(peers)
+        assert all(root.graph.find_node(address).last_seen == 0 for address in (a, b, c, d))
+
+        clock.now = 11
+        for address in (a, b):
+            peers[address].send_new_reunion_packet()
+        delivered = deliver(peers)
+
+        assert all(root.graph.find_node(address).last_seen == 11 for address in (a, b, c, d))
+        assert summary_acks(delivered) == {
+            (root_address, a): (sorted([a, c, d]), REUNION_INTERVAL),
+            (root_address, b): ([b], REUNION_INTERVAL),
+            (a, c): ([c], REUNION_INTERVAL),
+            (a, d): ([d], REUNION_INTERVAL),
+        }
+
+        for address in (a, b, c, d):
+            peer = peers[address]
+            assert peer.last_reunion_response_received == 11 and not peer.reunion_sent
+            assert peer.get_reunion_interval() == REUNION_INTERVAL
+
+
+    # Path reunion: the root asks deeper peers for longer intervals and the jitter keeps every interval within its
+    # bounds; the round trip is only measured for a Hello which was sent once (Karn's algorithm).
+    clock.now = 0
+    rand.fraction = 1
+    peers = {root_address: PeerRoot(root_address, max_children=1, transport=TRANSPORT_MEMORY)}
+    for address in (a, b):
+        peers[address] = PeerClient(address, root_address, transport=TRANSPORT_MEMORY)
+        join(peers, address)
+
+    root, peer, child = peers[root_address], peers[a], peers[b]
+    assert root.graph.find_node(b).parent.address == a
+
+    # Peers which join together start at a random point of their first interval.
+    assert peer._next_reunion_send == CLIENT_REUNION_JITTER * CLIENT_REUNION_SEND_DELAY
+
+    clock.now = 1
+    for client in (peer, child):
+        client.update_reunion()
+    clock.now = 1.5
+    deliver(peers)
+
+    assert peer._reunion_rtt == 0.5 and child._reunion_rtt == 0.5
+    assert peer.get_reunion_interval() == REUNION_INTERVAL
+    assert abs(child.get_reunion_interval() - REUNION_INTERVAL * (1 + REUNION_DEPTH_SCALE)) < 0.001
+
+    for fraction in (0, 0.5, 1):
+        rand.fraction = fraction
+        peer._schedule_next_reunion(clock.now)
+        jitter = (2 * fraction - 1) * CLIENT_REUNION_JITTER
+        assert peer._next_reunion_send == clock.now + REUNION_INTERVAL * (1 + jitter)
+    assert REUNION_INTERVAL * (1 - CLIENT_REUNION_JITTER) <= peer._next_reunion_send - clock.now
+    assert peer._next_reunion_send - clock.now <= REUNION_INTERVAL * (1 + CLIENT_REUNION_JITTER)
+
+    # A lost Hello is sent again after the retry delay, not with the next interval; its answer isn't measured.
+    clock.now = peer._next_reunion_send
+    peer.update_reunion()
+    sent = clock.now
+    queued.clear()
+
+    retry_delay = CLIENT_REUNION_RETRY_INTERVALS * REUNION_INTERVAL
+    assert peer.get_next_timer_deadline() == sent + retry_delay
+    clock.now = sent + retry_delay - 0.1
+    peer.update_reunion()
+    assert not queued
+
+    clock.now = sent + retry_delay + 0.1
+    peer.update_reunion()
+    assert len(queued) == 1
+    clock.now += 3
+    deliver(peers)
+    assert peer._reunion_rtt == 0.5 and not peer.reunion_sent
+
+    clock.now = peer._next_reunion_send
+    peer.update_reunion()
+    clock.now += 1
+    deliver(peers)
+    assert peer._reunion_rtt == 0.5 + CLIENT_REUNION_RTT_SMOOTHING * (1 - 0.5)
+
+    # A loaded root asks for longer intervals, but never for more than fits the packet.
+    root._reunion_load = 10 ** 9
+    clock.now += 1
+    root.update_reunion()
+    peer.send_new_reunion_packet()
+    deliver(peers)
+    assert peer.get_reunion_interval() == MAX_REUNION_INTERVAL
+    peer._schedule_next_reunion(clock.now)
+    assert peer._next_reunion_send - clock.now <= MAX_REUNION_INTERVAL * (1 + CLIENT_REUNION_JITTER)
@@ -0,0 +1,91 @@
+import tools.SeenCache as SeenCacheModule
+from net import PacketFactory
+from net.peer import Peer
+from tools.SeenCache import SeenCache
+
+me = ("127.000.000.001", "05000")
+neighbours = [("127.000.000.001", "05001"), ("127.000.000.001", "05002")]
+origin = ("127.000.000.001", "05003")
+
+
+class Clock:
+    now = 0
+
+    def time(self):
+        return self.now
+
+
+class FakeNode:
+    def __init__(self, address):
+        self.address = address
+
+    def get_server_address(self):
+        return self.address
+
+
+class FakeStream:
+    """
+    Neighbours of a Peer without connections; queued packets are recorded.
+    """
+
+    def __init__(self, addresses):
+        self.nodes = [FakeNode(address) for address in addresses]
+        self.queued = []
+
+    def get_node_by_server(self, address, register_connection=False):
+        return next((node for node in self.nodes if node.address == address), None)
+
+    def get_nodes(self, ignore_register=False):
+        return self.nodes
+
+    def add_message_to_node(self, node, buf):
+        self.queued.append((node.address, buf))
+
+
+if __name__ == '__main__':
+    clock = Clock()
+    SeenCacheModule.time = clock
+
+    # Repeated keys are suppressed and counted.
+    cache = SeenCache(max_size=3, ttl=10)
+    assert cache.add("a") and cache.add("b")
+    assert not cache.add("a") and not cache.add("b") and not cache.add("a")
+    assert (cache.accepted, cache.suppressed, len(cache)) == (2, 3, 2)
+
+    # Keys are forgotten ttl seconds after they were first seen; seeing them again doesn't extend it.
+    clock.now = 9
+    assert not cache.add("a")
+    clock.now = 10
+    assert "a" in cache
+    clock.now = 10.5
+    assert cache.add("c")
+    assert "a" not in cache and "b" not in cache and len(cache) == 1
+    assert cache.add("a")
+
+    # The oldest key makes room for a new one beyond max_size.
+    assert cache.add("d") and cache.add("e")
+    assert "c" not in cache and len(cache) == 3
+    assert not cache.add("a") and not cache.add("d") and not cache.add("e")
+    assert cache.add("c")
+    assert "a" not in cache
+
+    # A Peer shows and forwards a message once, whichever neighbour it comes from.
+    peer = Peer.__new__(Peer)
+    peer.address = me
+    peer.stream = FakeStream(neighbours)
+    peer.seen_messages = SeenCache()
+
+    for sender in neighbours + [neighbours[0]]:
+        peer._handle_message_packet(PacketFactory.new_message_packet("Hi", sender, (origin, 1)))
+
+    assert peer.stream.queued == [(neighbours[1], PacketFactory.new_message_packet("Hi", me, (origin, 1)).get_buf())]
+    assert (peer.seen_messages.accepted, peer.seen_messages.suppressed) == (1, 2)
+
+    # The next sequence of the same origin is a new message.
+    peer._handle_message_packet(PacketFactory.new_message_packet("Hi", neighbours[1], (origin, 2)))
+    assert len(peer.stream.queued) == 2 and peer.stream.queued[1][0] == neighbours[0]
+    assert peer.seen_messages.accepted == 2
+
+    # Packets from a peer which isn't a neighbour are not even counted.
+    peer._handle_message_packet(PacketFactory.new_message_packet("Hi", origin, (origin, 3)))
+    assert len(peer.stream.queued) == 2 and peer.seen_messages.accepted == 2
@@ -0,0 +1,494 @@
+import time
+from array import array
+from collections.abc import Mapping
+
+from tools.NetworkGraph import MAX_CHILDREN, PLACEMENT_SHALLOWEST, PLACEMENT_BALANCED, PLACEMENTS
+
+NO_NODE = -1
+
+
+def pack_address(address: tuple) -> int:
+    """
+    ('192.168.001.001', '05335') => one integer holding 4 bytes of IP and 2 bytes of port.
+    """
+    ip, port = address
+    a, b, c, d = map(int, ip.split('.'))
+    return (((a << 24) | (b << 16) | (c << 8) | d) << 16) | int(port)
+
+
+def unpack_address(packed: int) -> tuple:
+    ip = packed >> 16
+    return '%03d.%03d.%03d.%03d' % (ip >> 24, (ip >> 16) & 0xff, (ip >> 8) & 0xff, ip & 0xff), '%05d' % (packed & 0xffff)
+
+
+class CompactGraphNode:
+    __slots__ = ('_graph', 'index')
+
+    def __init__(self, graph: 'CompactNetworkGraph', index: int):
+        """
+        A light handle to a node of CompactNetworkGraph with the same attributes as GraphNode; the node data lives
+        in the arrays of the graph.
+
+        :param graph: The graph which the node belongs to.
+        :param index: Index of the node in the graph arrays.
+        """
+        self._graph = graph
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, CompactGraphNode) and other._graph is self._graph and other.index == self.index
+
+    def __hash__(self):
+        return hash(self.index)
+
+    @property
+    def address(self):
+        graph = self._graph
+        return unpack_address((graph.ips[self.index] << 16) | graph.ports[self.index])
+
+    @property
+    def parent(self):
+        parent = self._graph.parents[self.index]
+        return CompactGraphNode(self._graph, parent) if parent != NO_NODE else None
+
+    @property
+    def children(self):
+        return [CompactGraphNode(self._graph, child) for child in self._graph.iter_children(self.index)]
+
+    @property
+    def depth(self):
+        return self._graph.depths[self.index]
+
+    @property
+    def subtree_size(self):
+        return self._graph.subtree_sizes[self.index]
+
+    @property
+    def last_seen(self):
+        return self._graph.last_seens[self.index]
+
+    @property
+    def alive(self):
+        return bool(self._graph.alives[self.index])
+
+    def update_last_seen(self):
+        self._graph.update_last_seen(self.index)
+
+    def is_in_subtree_of(self, node: 'CompactGraphNode') -> bool:
+        return self._graph.is_in_subtree_of(self.index, node.index)
+
+    def iter_subtree(self):
+        return (CompactGraphNode(self._graph, index) for index in self._graph.iter_subtree(self.index))
+
+
+class AddressToNodeMap(Mapping):
+    def __init__(self, graph: 'CompactNetworkGraph'):
+        """
+        Read only view of the nodes of a CompactNetworkGraph by address; a lookup packs the address and reads the
+        index of the graph, nothing is copied.
+        """
+        self._graph = graph
+
+    def __getitem__(self, address):
+        try:
+            index = self._graph._address_to_index[pack_address(address)]
+        except (ValueError, TypeError):
+            raise KeyError(address)
+
+        return CompactGraphNode(self._graph, index)
+
+    def __iter__(self):
+        return map(unpack_address, self._graph._address_to_index)
+
+    def __len__(self):
+        return len(self._graph._address_to_index)
+
+
+class CompactNetworkGraph:
+    def __init__(self, root_address: tuple, max_children=MAX_CHILDREN, max_depth=None, placement=PLACEMENT_SHALLOWEST):
+        """
+        NetworkGraph with the nodes stored in parallel arrays instead of one object per node.
+
+        A node is an index into the arrays; children are linked with first_child/next_sibling/prev_sibling and the
+        indices of removed nodes are reused through a free list. find_node and the other methods return
+        CompactGraphNode handles, so PeerRoot can use both graphs the same way.
+
+        :param root_address: (ip, port) of the root; it is always index 0.
+        :param max_children: Fan-out of the tree, see NetworkGraph.
+        :param max_depth: New nodes are never placed deeper than it; None means no limit.
+        :param placement: How a parent is chosen for a new node; one of PLACEMENTS.
+        """
+        if max_children < 1:
+            raise ValueError("max_children should be at least 1")
+
+        if placement not in PLACEMENTS:
+            raise ValueError("unknown placement %s" % placement)
+
+        self.max_children = max_children
+        self.max_depth = max_depth
+        self.placement = placement
+
+        self.ips = array('I')
+        self.ports = array('H')
+        self.parents = array('i')
+        self.first_children = array('i')
+        self.next_siblings = array('i')
+        self.prev_siblings = array('i')
+        self.children_counts = array('H')
+        self.depths = array('H')
+        self.subtree_sizes = array('I')
+        self.last_seens = array('d')
+        self.alives = array('b')
+
+        self._free_indices = array('i')
+        self._address_to_index = {}  # key: packed address, value: index
+        self.address_to_node_map = AddressToNodeMap(self)
+
+        # Per depth: [indices which may accept another child, position of the first entry not consumed yet]
+        self._open_slots = []
+        self._first_open_depth = 0  # Levels above it have no open slot.
+
+        # Per second: indices whose last_seen fell into it; an entry is stale if the node was seen later.
+        self._liveness_buckets = {}
+
+        self._new_index(pack_address(root_address), NO_NODE)
+        self.root = CompactGraphNode(self, 0)
+
+    def _new_index(self, packed_address: int, parent: int) -> int:
+        values = (
+            (self.ips, packed_address >> 16),
+            (self.ports, packed_address & 0xffff),
+            (self.parents, parent),
+            (self.first_children, NO_NODE),
+            (self.next_siblings, NO_NODE),
+            (self.prev_siblings, NO_NODE),
+            (self.children_counts, 0),
+            (self.depths, self.depths[parent] + 1 if parent != NO_NODE else 0),
+            (self.subtree_sizes, 1),
+            (self.last_seens, time.time()),
+            (self.alives, 1),
+        )
+
+        if self._free_indices:
+            index = self._free_indices.pop()
+            for values_array, value in values:
+                values_array[index] = value
+        else:
+            index = len(self.ips)
+            for values_array, value in values:
+                values_array.append(value)
+
+        self._address_to_index[packed_address] = index
+
+        if parent != NO_NODE:
+            self._link_child(parent, index)
+
+        self._add_open_slot(index)
+        self._add_liveness(index)
+
+        return index
+
+    def _link_child(self, parent: int, child: int):
+        first_child = self.first_children[parent]
+
+        self.parents[child] = parent
+        self.prev_siblings[child] = NO_NODE
+        self.next_siblings[child] = first_child
+
+        if first_child != NO_NODE:
+            self.prev_siblings[first_child] = child
+
+        self.first_children[parent] = child
+        self.children_counts[parent] += 1
+
+    def _unlink_child(self, child: int):
+        parent = self.parents[child]
+        prev_sibling = self.prev_siblings[child]
+        next_sibling = self.next_siblings[child]
+
+        if prev_sibling != NO_NODE:
+            self.next_siblings[prev_sibling] = next_sibling
+        else:
+            self.first_children[parent] = next_sibling
+
+        if next_sibling != NO_NODE:
+            self.prev_siblings[next_sibling] = prev_sibling
+
+        self.parents[child] = NO_NODE
+        self.children_counts[parent] -= 1
+        self._add_open_slot(parent)
+
+    def _add_to_subtree_sizes(self, index: int, delta: int):
+        while index != NO_NODE:
+            self.subtree_sizes[index] += delta
+            index = self.parents[index]
+
+    def _has_open_slot(self, index: int) -> bool:
+        return (self.alives[index] and self.children_counts[index] < self.max_children and
+                not self._is_at_max_depth(self.depths[index]))
+
+    def _is_at_max_depth(self, depth: int) -> bool:
+        return self.max_depth is not None and depth >= self.max_depth
+
+    def _add_open_slot(self, index: int):
+        depth = self.depths[index]
+
+        while len(self._open_slots) <= depth:
+            self._open_slots.append([array('i'), 0])
+
+        self._open_slots[depth][0].append(index)
+        self._first_open_depth = min(self._first_open_depth, depth)
+
+    def _add_liveness(self, index: int):
+        second = int(self.last_seens[index])
+        bucket = self._liveness_buckets.get(second)
+
+        if bucket is None:
+            bucket = self._liveness_buckets[second] = array('i')
+
+        bucket.append(index)
+
+    def iter_children(self, index: int):
+        child = self.first_children[index]
+
+        while child != NO_NODE:
+            yield child
+            child = self.next_siblings[child]
+
+    def iter_subtree(self, index: int):
+        to_visit = [index]
+
+        while to_visit:
+            index = to_visit.pop()
+            yield index
+            to_visit.extend(self.iter_children(index))
+
+    def is_in_subtree_of(self, index: int, ancestor: int) -> bool:
+        while index != NO_NODE:
+            if index == ancestor:
+                return True
+            index = self.parents[index]
+
+        return False
+
+    def update_last_seen(self, index: int):
+        previous_second = int(self.last_seens[index])
+        self.last_seens[index] = time.time()
+
+        if int(self.last_seens[index]) != previous_second:
+            self._add_liveness(index)
+
+    def find_parent_for_new_node(self, sender):
+        """
+        A node chosen by the placement of the graph among the ones with less than max_children children and above
+        max_depth; it is not in the sub-tree of sender.
+
+        :param sender: The node address we want to find best neighbour for it.
+        :type sender: tuple
+
+        :return: Best neighbour for sender; None if there is no free slot.
+        :rtype: CompactGraphNode
+        """
+        index = self._find_parent_index(self._address_to_index.get(pack_address(sender), NO_NODE))
+        return CompactGraphNode(self, index) if index != NO_NODE else None
+
+    def _find_parent_index(self, sender_index: int) -> int:
+        if self.placement == PLACEMENT_BALANCED:
+            return self._find_balanced_parent_index(sender_index)
+
+        for depth in range(self._first_open_depth, len(self._open_slots)):
+            if self._is_at_max_depth(depth):
+                break
+
+            slots = self._open_slots[depth]
+            indices, position = slots
+
+            for i in range(position, len(indices)):
+                index = indices[i]
+                valid = self._has_open_slot(index) and self.depths[index] == depth
+
+                if not valid:
+                    if i == slots[1]:
+                        slots[1] += 1
+                    continue
+
+                if sender_index != NO_NODE and self.is_in_subtree_of(index, sender_index):
+                    continue
+
+                return index
+
+            if slots[1] == len(indices):
+                slots[0] = array('i')
+                slots[1] = 0
+
+                if depth == self._first_open_depth:
+                    self._first_open_depth += 1
+            elif slots[1] > len(indices) // 2:
+                del indices[:slots[1]]
+                slots[1] = 0
+
+        return NO_NODE
+
+    def _find_balanced_parent_index(self, sender_index: int) -> int:
+        to_visit = [0]
+
+        while to_visit:
+            index = to_visit.pop()
+
+            if index == sender_index:
+                continue
+
+            if self._has_open_slot(index):
+                return index
+
+            if not self._is_at_max_depth(self.depths[index] + 1):
+                # The smallest sub-tree is visited first.
+                to_visit.extend(sorted(self.iter_children(index), key=self.subtree_sizes.__getitem__, reverse=True))
+
+        return NO_NODE
+
+    def _fits_under(self, index: int, new_parent: int) -> bool:
+        if self.max_depth is None:
+            return True
+
+        height = max(self.depths[descendant] for descendant in self.iter_subtree(index)) - self.depths[index]
+        return self.depths[new_parent] + 1 + height <= self.max_depth
+
+    def find_node(self, address: tuple) -> CompactGraphNode:
+        index = self._address_to_index.get(pack_address(address))
+        return CompactGraphNode(self, index) if index is not None else None
+
+    def remove_node(self, node: CompactGraphNode, keep_children=False):
+        """
+        Remove the node with its sub-tree; their indices are reused by the next inserted nodes.
+
+        :param node: The node should be deleted with its subtree
+        :param keep_children: Move every child with its sub-tree under a new parent instead, see NetworkGraph.
+        :return: The moved children.
+        :rtype: list
+        """
+        index = node.index
+
+        if index == 0:
+            raise ValueError("root can not be removed")
+
+        if not self.alives[index]:
+            return []
+
+        moved_children = []
+
+        if keep_children:
+            for child in list(self.iter_children(index)):
+                # Nothing in the removed sub-tree, e.g. a sibling, may become the new parent.
+                new_parent = self._find_parent_index(index)
+
+                if new_parent != NO_NODE and self._fits_under(child, new_parent):
+                    self.reparent(CompactGraphNode(self, child), CompactGraphNode(self, new_parent))
+                    moved_children.append(child)
+
+        self._add_to_subtree_sizes(self.parents[index], -self.subtree_sizes[index])
+        self._unlink_child(index)
+
+        for removed in list(self.iter_subtree(index)):
+            self.alives[removed] = 0
+            self.first_children[removed] = NO_NODE
+            self.children_counts[removed] = 0
+            del self._address_to_index[(self.ips[removed] << 16) | self.ports[removed]]
+            self._free_indices.append(removed)
+
+        return [CompactGraphNode(self, child) for child in moved_children]
+
+    def insert_node(self, address: tuple) -> tuple:
+        """
+        Search for a parent to this new node
+        :param address:
+        :return: address of parent; if address is already in the graph, its current parent. None if the graph is
+                 full because of max_depth.
+        """
+        packed_address = pack_address(address)
+        index = self._address_to_index.get(packed_address)
+
+        if index is not None:
+            parent = self.parents[index]
+        else:
+            parent = self._find_parent_index(NO_NODE)
+            if parent != NO_NODE:
+                self._new_index(packed_address, parent)
+                self._add_to_subtree_sizes(parent, 1)
+
+        return CompactGraphNode(self, parent).address if parent != NO_NODE else None
+
+    def reparent(self, node: CompactGraphNode, new_parent: CompactGraphNode):
+        """
+        Move node with its whole sub-tree under new_parent.
+
+        :param node: The node to move; it can not be the root.
+        :param new_parent: It can not be in the sub-tree of node.
+        """
+        index, parent = node.index, new_parent.index
+
+        if index == 0 or not self.alives[index] or not self.alives[parent]:
+            raise ValueError("invalid node for reparenting")
+
+        if self.is_in_subtree_of(parent, index):
+            raise ValueError("new parent is in the sub-tree of node")
+
+        size = self.subtree_sizes[index]
+        self._add_to_subtree_sizes(self.parents[index], -size)
+        self._unlink_child(index)
+
+        self._link_child(parent, index)
+        self._add_to_subtree_sizes(parent, size)
+
+        shift = self.depths[parent] + 1 - self.depths[index]
+        if shift:
+            for moved in self.iter_subtree(index):
+                self.depths[moved] += shift
+
+                if self._has_open_slot(moved):
+                    self._add_open_slot(moved)
+
+    def get_inactive_nodes(self, active_threshold):
+        """
+        Only the buckets older than active_threshold are visited.
+
+        :param active_threshold: Nodes which are not seen since this time are inactive.
+
+        :return: Inactive nodes of the graph, the root is never inactive.
+        :rtype: list
+        """
+        inactive_indices = set()
+
+        for second in [second for second in self._liveness_buckets if second <= active_threshold]:
+            kept = array('i')
+
+            for index in self._liveness_buckets[second]:
+                last_seen = self.last_seens[index]
+
+                if not self.alives[index] or int(last_seen) != second or index == 0:
+                    continue
+
+                kept.append(index)
+                if last_seen < active_threshold:
+                    inactive_indices.add(index)
+
+            if kept:
+                self._liveness_buckets[second] = kept
+            else:
+                del self._liveness_buckets[second]
+
+        return [CompactGraphNode(self, index) for index in inactive_indices]
+
+    def print(self):
+        to_visit_nodes = [0]
+
+        print("Network Graph")
+        while to_visit_nodes:
+            index = to_visit_nodes.pop(0)
+
+            print("Node: " + str(CompactGraphNode(self, index).address))
+
+            for child in self.iter_children(index):
+                to_visit_nodes.append(child)
+                print("Children")
+                print("   " + str(CompactGraphNode(self, child).address))
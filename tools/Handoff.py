@@ -0,0 +1,50 @@
+from collections import deque
+
+
+class Handoff:
+    def __init__(self, wakeup=None):
+        """
+        Hands items over from producer threads to the main loop without a lock; append and popleft of a deque are
+        atomic, so nothing is lost when the main loop drains while a producer puts.
+
+        :param wakeup: threading.Event which is set whenever new items are put.
+        """
+        self._items = deque()
+        self._wakeup = wakeup
+
+    def put(self, item):
+        self._items.append(item)
+
+        if self._wakeup:
+            self._wakeup.set()
+
+    def put_many(self, items):
+        """
+        :param items: Items to hand over, in their order.
+        """
+        items = list(items)
+        self._items.extend(items)
+
+        if items and self._wakeup:
+            self._wakeup.set()
+
+    def drain(self, max_items=None) -> list:
+        """
+        :param max_items: Take at most this many items; None takes all of them.
+
+        :return: The oldest items, removed from the handoff.
+        :rtype: list
+        """
+        items = []
+        pop = self._items.popleft
+
+        while max_items is None or len(items) < max_items:
+            try:
+                items.append(pop())
+            except IndexError:
+                break
+
+        return items
+
+    def __len__(self):
+        return len(self._items)
@@ -1,5 +1,12 @@
 import time
-import copy
+from heapq import heappush, heappop
+from itertools import count
+
+MAX_CHILDREN = 2
+
+PLACEMENT_SHALLOWEST = 'shallowest'
+PLACEMENT_BALANCED = 'balanced'
+PLACEMENTS = (PLACEMENT_SHALLOWEST, PLACEMENT_BALANCED)
 
 
 class GraphNode:
@@ -13,37 +20,99 @@ class GraphNode:
         self.last_seen = time.time()
         self.children = []
         self.parent = parent
+        self.depth = parent.depth + 1 if parent else 0
+        self.subtree_size = 1  # this node and all of its descendants
+        self.alive = True
 
     def add_child(self, child: 'GraphNode'):
         self.children.append(child)
 
+    def is_in_subtree_of(self, node: 'GraphNode') -> bool:
+        """
+        :return: Whether node is this node or one of its ancestors.
+        """
+        ancestor = self
+        while ancestor:
+            if ancestor is node:
+                return True
+            ancestor = ancestor.parent
+
+        return False
+
     def update_last_seen(self):
         self.last_seen = time.time()
 
-    def get_subtree_children(self) -> list:
-        if not self.children:
-            return []
-        else:
-            _nodes = copy.copy(self.children)
-            for child in self.children:  # type: GraphNode
-                _nodes += child.get_subtree_children()
+    def iter_subtree(self):
+        """
+        :return: This node and all of its descendants; without recursion or copying children lists.
+        """
+        to_visit_nodes = [self]
 
-            return _nodes
+        while to_visit_nodes:
+            node = to_visit_nodes.pop()
+            yield node
+            to_visit_nodes.extend(node.children)
 
 
 class NetworkGraph:
-    def __init__(self, root_address: tuple):
+    def __init__(self, root_address: tuple, max_children=MAX_CHILDREN, max_depth=None, placement=PLACEMENT_SHALLOWEST):
+        """
+        :param root_address: (ip, port) of the root.
+        :param max_children: Fan-out of the tree; a higher one makes the tree shallower, so broadcasts and reunion
+                             paths take less hops, but every peer relays to more neighbours.
+        :param max_depth: New nodes are never placed deeper than it; None means no limit.
+        :param placement: How a parent is chosen for a new node; one of PLACEMENTS.
+                          PLACEMENT_SHALLOWEST: the node nearest to the root with a free slot (BFS order).
+                          PLACEMENT_BALANCED: walk down from the root into the smallest sub-trees, so every branch
+                          carries about the same number of peers.
+        """
+        if max_children < 1:
+            raise ValueError("max_children should be at least 1")
+
+        if placement not in PLACEMENTS:
+            raise ValueError("unknown placement %s" % placement)
+
+        self.max_children = max_children
+        self.max_depth = max_depth
+        self.placement = placement
+
         self.root = GraphNode(root_address)
         self.root.alive = True
-        self.address_to_node_map = {}
+        self.address_to_node_map = {root_address: self.root}
+
+        # Nodes which may accept another child, ordered by (depth, insertion order). Entries are not removed when
+        # a node gets full or leaves the graph; they are skipped when they reach the top.
+        self._open_slots = []
+        self._open_slots_counter = count()
+        self._add_open_slot(self.root)
+
+        # Nodes ordered by the last_seen they had when they were pushed. update_last_seen doesn't touch it; an entry
+        # whose node has been seen since is pushed again with the new time when it reaches the top.
+        self._liveness = []
+        self._liveness_counter = count()
+
+    def _add_open_slot(self, node: GraphNode):
+        heappush(self._open_slots, (node.depth, next(self._open_slots_counter), node))
+
+    def _add_liveness(self, node: GraphNode):
+        heappush(self._liveness, (node.last_seen, next(self._liveness_counter), node))
+
+    def _has_open_slot(self, node: GraphNode) -> bool:
+        return node.alive and len(node.children) < self.max_children and not self._is_at_max_depth(node.depth)
+
+    def _is_at_max_depth(self, depth: int) -> bool:
+        return self.max_depth is not None and depth >= self.max_depth
 
     def find_parent_for_new_node(self, sender):
         """
         Here we should find a neighbour for the sender.
-        Best neighbour is the node who is nearest the root and has not more than one child.
+        Best neighbour is chosen by the placement of the graph among the nodes with less than max_children children
+        and above max_depth.
 
         Code design suggestion:
             1. Do a BFS algorithm to find the target.
+               The first valid entry of the open slots index is the node that BFS would find, so we take it
+               instead of walking the tree.
 
         Warnings:
             1. Check whether there is sender node in our NetworkGraph or not; if exist do not return sender node or
@@ -52,61 +121,210 @@ class NetworkGraph:
         :param sender: The node address we want to find best neighbour for it.
         :type sender: tuple
 
-        :return: Best neighbour for sender.
+        :return: Best neighbour for sender; None if there is no free slot.
         :rtype: GraphNode
         """
 
+        return self._find_parent(self.find_node(sender))
+
+    def _find_parent(self, excluded_node: GraphNode) -> GraphNode:
+        """
+        :param excluded_node: Neither it nor any node in its sub-tree is chosen; None excludes nothing.
+        """
+        if self.placement == PLACEMENT_BALANCED:
+            return self._find_balanced_parent(excluded_node)
+
+        return self._find_shallowest_parent(excluded_node)
+
+    def _find_shallowest_parent(self, sender_node: GraphNode) -> GraphNode:
+        skipped = []
+        parent = None
+
+        while self._open_slots:
+            entry = self._open_slots[0]
+            node = entry[2]  # type: GraphNode
+
+            if not self._has_open_slot(node):
+                heappop(self._open_slots)
+                continue
+
+            if entry[0] != node.depth:
+                # The node has moved with a reparented sub-tree.
+                heappop(self._open_slots)
+                self._add_open_slot(node)
+                continue
+
+            if sender_node and node.is_in_subtree_of(sender_node):
+                skipped.append(heappop(self._open_slots))
+                continue
+
+            parent = node
+            break
+
+        for entry in skipped:
+            heappush(self._open_slots, entry)
+
+        return parent
+
+    def _find_balanced_parent(self, sender_node: GraphNode) -> GraphNode:
         to_visit_nodes = [self.root]
 
         while to_visit_nodes:
-            node = to_visit_nodes[0]  # type: GraphNode
-            to_visit_nodes = to_visit_nodes[1:]
+            node = to_visit_nodes.pop()
+
+            if node is sender_node:
+                continue
 
-            if len(node.children) < 2:
+            if self._has_open_slot(node):
                 return node
-            else:
-                for c in node.children:
-                    to_visit_nodes.append(c)
+
+            if not self._is_at_max_depth(node.depth + 1):
+                # The smallest sub-tree is visited first.
+                to_visit_nodes.extend(sorted(node.children, key=lambda child: child.subtree_size, reverse=True))
+
+        return None
+
+    def _fits_under(self, node: GraphNode, new_parent: GraphNode) -> bool:
+        if self.max_depth is None:
+            return True
+
+        height = max(descendant.depth for descendant in node.iter_subtree()) - node.depth
+        return new_parent.depth + 1 + height <= self.max_depth
 
     def find_node(self, address: tuple) -> GraphNode:
         return self.address_to_node_map.get(address)
 
-    def remove_node(self, node: GraphNode):
+    def _add_to_subtree_sizes(self, node: GraphNode, delta: int):
+        while node:
+            node.subtree_size += delta
+            node = node.parent
+
+    def remove_node(self, node: GraphNode, keep_children=False):
         """
         We remove the node and its children from graph. Because parent is more updated than its children
         :param node: The node should be deleted with its subtree
-        :return:
+        :param keep_children: Move every child with its sub-tree under a new parent instead; children which find no
+                              place above max_depth are removed.
+        :return: The moved children.
+        :rtype: list
         """
+        if node is self.root:
+            raise ValueError("root can not be removed")
+
+        if not node.alive:
+            return []
+
+        moved_children = []
+
+        if keep_children:
+            for child in list(node.children):
+                # Nothing in the removed sub-tree, e.g. a sibling, may become the new parent.
+                new_parent = self._find_parent(node)
+
+                if new_parent and self._fits_under(child, new_parent):
+                    self.reparent(child, new_parent)
+                    moved_children.append(child)
 
         if node.parent:
             if node in node.parent.children:
                 node.parent.children.remove(node)
+                self._add_open_slot(node.parent)
+                self._add_to_subtree_sizes(node.parent, -node.subtree_size)
 
             node.parent = None
 
-        if node.address in self.address_to_node_map:
-            del self.address_to_node_map[node.address]
+        for removed in node.iter_subtree():
+            removed.alive = False
+
+            if self.address_to_node_map.get(removed.address) is removed:
+                del self.address_to_node_map[removed.address]
+
+        return moved_children
 
     def insert_node(self, address: tuple) -> tuple:
         """
         Search for a parent to this new node
         :param address:
-        :return: address of parent
+        :return: address of parent; if address is already in the graph, its current parent. None if the graph is
+                 full because of max_depth.
         """
+        node = self.find_node(address)
+        if node:
+            return node.parent.address if node.parent else None
+
         parent = self.find_parent_for_new_node(address)
+        if parent is None:
+            return None
+
         node = GraphNode(address, parent)
         parent.add_child(node)
+        self.address_to_node_map[address] = node
+        self._add_to_subtree_sizes(parent, 1)
+        self._add_open_slot(node)
+        self._add_liveness(node)
 
         return parent.address
 
+    def reparent(self, node: GraphNode, new_parent: GraphNode):
+        """
+        Move node with its whole sub-tree under new_parent.
+
+        :param node: The node to move; it can not be the root.
+        :param new_parent: It can not be in the sub-tree of node.
+        """
+        if node is self.root or not node.alive or not new_parent.alive:
+            raise ValueError("invalid node for reparenting")
+
+        if new_parent.is_in_subtree_of(node):
+            raise ValueError("new parent is in the sub-tree of node")
+
+        old_parent = node.parent
+        old_parent.children.remove(node)
+        self._add_open_slot(old_parent)
+        self._add_to_subtree_sizes(old_parent, -node.subtree_size)
+
+        node.parent = new_parent
+        new_parent.add_child(node)
+        self._add_to_subtree_sizes(new_parent, node.subtree_size)
+
+        shift = new_parent.depth + 1 - node.depth
+        if shift:
+            for moved in node.iter_subtree():
+                moved.depth += shift
+
+                if self._has_open_slot(moved):
+                    self._add_open_slot(moved)
+
     def get_inactive_nodes(self, active_threshold):
-        inactive_nodes = []
+        """
+        Only the entries older than active_threshold are visited, so it costs O(expired * log n) instead of a walk
+        over the whole tree.
+
+        :param active_threshold: Nodes which are not seen since this time are inactive.
+
+        :return: Inactive nodes of the graph, the root is never inactive.
+        :rtype: list
+        """
+        inactive_entries = []
+
+        while self._liveness and self._liveness[0][0] < active_threshold:
+            entry = heappop(self._liveness)
+            last_seen, _, node = entry
+
+            if not node.alive:
+                continue
+
+            if node.last_seen != last_seen:
+                self._add_liveness(node)
+                continue
+
+            inactive_entries.append(entry)
 
-        for node in self.root.get_subtree_children():
-            if node.last_seen < active_threshold:
-                inactive_nodes.append(node)
+        # Keep them until they are removed from the graph or seen again.
+        for entry in inactive_entries:
+            heappush(self._liveness, entry)
 
-        return inactive_nodes
+        return [node for _, _, node in inactive_entries]
 
     def print(self):
         to_visit_nodes = [self.root]
@@ -1,59 +1,285 @@
+import logging
+import threading
+from collections import deque
+
 from tools.simpletcp.clientsocket import ClientSocket
 
+logger = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT = 5  # seconds a new connection may take before the node is given up
+MAX_BATCH_BYTES = 64 * 1024  # packets written with one call of the client
+MAX_BATCH_PACKETS = 512  # below IOV_MAX of sendmsg
+HIGH_WATER_MARK = 1024 * 1024  # queued bytes from which the producer has to flush the node
+MAX_QUEUE_BYTES = 4 * 1024 * 1024
+MAX_QUEUE_PACKETS = 10000
+
+# What happens to a packet for a node whose out_buff is full.
+QUEUE_BLOCK = 'block'  # the producer waits a little for the queued packets to be sent, then drops the packet
+QUEUE_DROP_OLDEST = 'drop-oldest'
+QUEUE_DROP_NEWEST = 'drop-newest'
+QUEUE_DISCONNECT = 'disconnect'  # the slow neighbour is removed
+QUEUE_POLICIES = (QUEUE_BLOCK, QUEUE_DROP_OLDEST, QUEUE_DROP_NEWEST, QUEUE_DISCONNECT)
+
+SENDER_JOIN_TIMEOUT = 1
+BLOCK_TIMEOUT = 0.1  # seconds a producer waits for room in out_buff under QUEUE_BLOCK
+
 
 class Node:
-    def __init__(self, server_address, set_root=False, set_register=False):
+    def __init__(self, server_address, set_root=False, set_register=False, pipelined=False,
+                 connect_timeout=CONNECT_TIMEOUT, on_connect=None, max_queue_bytes=MAX_QUEUE_BYTES,
+                 max_queue_packets=MAX_QUEUE_PACKETS, queue_policy=QUEUE_BLOCK, sender_thread=False):
         """
         The Node object constructor.
 
         This object is our low-level abstraction for other peers in the network.
         Every node has a ClientSocket that should bind to the Node TCPServer address.
 
+        The connection is made in the background, so a dead peer doesn't block the caller; packets wait in out_buff
+        until it is ready. With a sender thread, out_buff is written by that thread too, so a slow peer doesn't block
+        the caller of send_message either.
+
         Warnings:
-            1. Insert an exception handler when initializing the ClientSocket; when a socket closed here we will face to
-               an exception and we should detach this Node and clear its output buffer.
+            1. send_message raises OSError when the connection failed or is closed; then we should detach this Node and
+               clear its output buffer.
 
         :param server_address:
         :param set_root:
         :param set_register:
+        :param pipelined: Write packets back to back instead of waiting for an ACK after each one.
+        :param connect_timeout: Seconds the connection may take.
+        :param on_connect: Called from another thread when the connection is made or has failed, and when the sender
+                           thread fails to send.
+        :param max_queue_bytes: Limit of out_buff in bytes.
+        :param max_queue_packets: Limit of out_buff in packets.
+        :param queue_policy: What to do with a packet when out_buff is full; one of QUEUE_POLICIES. The node applies
+                             the drop policies itself, the others are up to the owner of the node, see has_room_for.
+        :param sender_thread: Send out_buff from a thread of this node instead of the caller of send_message.
         """
+        if queue_policy not in QUEUE_POLICIES:
+            raise ValueError("unknown queue policy %s" % queue_policy)
+
         self.server_ip = Node.parse_ip(server_address[0])
         self.server_port = Node.parse_port(server_address[1])
 
-        print("Server Address: ", server_address)
+        logger.debug("Server Address: %s", server_address)
 
-        self.out_buff = []
+        self.out_buff = deque()  # FIFO, so packets go out in the order they were added
+        # Guards out_buff and its counters; the sender thread waits on it for packets.
+        self._out_buff_condition = threading.Condition()
+        self.out_buff_bytes = 0
+        self.max_queue_bytes = max_queue_bytes
+        self.max_queue_packets = max_queue_packets
+        self.queue_policy = queue_policy
+
+        # Queue metrics of this neighbour.
+        self.peak_out_buff_bytes = 0
+        self.sent_packets = 0
+        self.dropped_packets = 0
+
+        # register_connection flags this connection is used for; a Stream shares one connection to a peer between
+        # its register connection and its neighbour connection.
+        self.channels = {set_register}
+
+        self._on_connect = on_connect
+        self._closing = False
+        self.send_error = None
+        # A producer waited for room in vain; it doesn't wait again until the connection makes progress.
+        self._stalled = False
 
         server_real_address = self.real_address(server_address)
-        self.client = ClientSocket(*server_real_address, single_use=False)
+        self.client = self._create_client(server_real_address, pipelined, connect_timeout, self._on_client_connect)
+
+        self._sender = None
+        if sender_thread:
+            self._sender = threading.Thread(target=self._run_sender, daemon=True)
+            self._sender.start()
+
+    def _create_client(self, server_real_address, pipelined, connect_timeout, on_connect):
+        """
+        :param server_real_address: Address of the Node TCPServer in the socket format.
+        :param pipelined: Whether the client should wait for an ACK after every packet or not.
+        :param connect_timeout: Seconds the connection may take.
+        :param on_connect: Called when the connection is made or has failed.
+
+        :return: Client with 'send' and 'close' methods and 'pending', 'connect_error' and 'closed' attributes; it
+                 connects in the background.
+        """
+        return ClientSocket(*server_real_address, single_use=False, pipelined=pipelined,
+                            connect_timeout=connect_timeout, background_connect=True, connect_callback=on_connect)
+
+    def _on_client_connect(self):
+        with self._out_buff_condition:
+            self._stalled = False
+            self._out_buff_condition.notify_all()
 
-    def send_message(self):
+        if self._on_connect:
+            self._on_connect()
+
+    def send_message(self, room_for=None, timeout=BLOCK_TIMEOUT):
         """
         Final function to send buffer to the client's socket.
 
+        Packets are sent in their order, coalesced into batches of at most MAX_BATCH_BYTES which the client writes
+        with one call. While the client is still connecting, the buffer is kept for a later call.
+
+        With a sender thread, the thread is only woken up to send the buffer.
+
+        :param room_for: With a sender thread, wait until this packet fits into out_buff, the connection fails or
+                         timeout passes. After a wait in vain the node is stalled and later calls don't wait until
+                         the sender thread has sent a batch, so a slow peer holds the caller back only once.
+        :param timeout: Seconds to wait for room.
         :return:
         """
+        self._raise_connection_error()
+
+        if self._sender is not None:
+            with self._out_buff_condition:
+                self._out_buff_condition.notify_all()
+
+                if room_for is not None and not self._stalled:
+                    self._stalled = not self._out_buff_condition.wait_for(
+                        lambda: self.has_room_for(room_for) or not self._is_sendable(), timeout)
+
+            self._raise_connection_error()
+            return
+
+        if self.client.pending:
+            return
 
         while self.out_buff:
-            buf = self.out_buff.pop()
-            self.client.send(buf)
+            with self._out_buff_condition:
+                batch = self._pop_batch()
+            self.client.send_many(batch)
+            self.sent_packets += len(batch)
+
+    def _raise_connection_error(self):
+        if self.client.connect_error is not None:
+            raise self.client.connect_error
+
+        if self.send_error is not None:
+            raise self.send_error
+
+        if self.client.closed:
+            raise ConnectionError("connection is closed")
+
+    def _is_sendable(self) -> bool:
+        return not self._closing and self.client.connect_error is None and self.send_error is None
+
+    def _run_sender(self):
+        """
+        Body of the sender thread: send batches of out_buff until the node is closed or sending fails.
+        """
+        while True:
+            with self._out_buff_condition:
+                while self._is_sendable() and (self.client.pending or not self.out_buff):
+                    self._out_buff_condition.wait()
+
+                if not self._is_sendable():
+                    return
+
+                batch = self._pop_batch()
+                # Its packets left room in out_buff.
+                self._out_buff_condition.notify_all()
+
+            try:
+                self.client.send_many(batch)
+                self.sent_packets += len(batch)
+                self._stalled = False
+            except OSError as e:
+                if not self._closing:
+                    self.send_error = e
+
+            if self.send_error is not None:
+                with self._out_buff_condition:
+                    # A producer may wait for the buffer to be sent.
+                    self._out_buff_condition.notify_all()
+
+                if self._on_connect:
+                    self._on_connect()
+                return
+
+    def _pop_batch(self) -> list:
+        """
+        :return: The oldest packets of out_buff, at least one.
+        """
+        batch = []
+        size = 0
+
+        while self.out_buff and len(batch) < MAX_BATCH_PACKETS:
+            if batch and size + len(self.out_buff[0]) > MAX_BATCH_BYTES:
+                break
+
+            buf = self.out_buff.popleft()
+            batch.append(buf)
+            size += len(buf)
+
+        self.out_buff_bytes -= size
+        return batch
 
     def add_message_to_out_buff(self, message):
         """
         Here we will add a new message to the server out_buff, then in 'send_message' will send them.
 
+        If out_buff is full, the oldest packets make room under QUEUE_DROP_OLDEST; under any other policy message is
+        dropped. A message which is bigger than the whole out_buff is always dropped.
+
         :param message: The message we want to add to out_buff
-        :return:
+        :return: Whether message is queued.
+        :rtype: bool
+        """
+        if self.is_oversized(message):
+            self.dropped_packets += 1
+            return False
+
+        if not self.has_room_for(message):
+            if self.queue_policy != QUEUE_DROP_OLDEST:
+                self.dropped_packets += 1
+                return False
+
+            with self._out_buff_condition:
+                while self.out_buff and not self.has_room_for(message):
+                    self.out_buff_bytes -= len(self.out_buff.popleft())
+                    self.dropped_packets += 1
+
+        with self._out_buff_condition:
+            self.out_buff.append(message)
+            self.out_buff_bytes += len(message)
+            self.peak_out_buff_bytes = max(self.peak_out_buff_bytes, self.out_buff_bytes)
+
+        return True
+
+    def has_room_for(self, message) -> bool:
+        return (len(self.out_buff) < self.max_queue_packets and
+                self.out_buff_bytes + len(message) <= self.max_queue_bytes)
+
+    def is_oversized(self, message) -> bool:
+        """
+        :return: Whether message doesn't fit even into an empty out_buff.
         """
-        self.out_buff.append(message)
+        return len(message) > self.max_queue_bytes
+
+    def is_over_high_water(self) -> bool:
+        """
+        :return: Whether out_buff has reached HIGH_WATER_MARK; then it should be sent before adding more.
+        """
+        return self.out_buff_bytes >= HIGH_WATER_MARK
 
     def close(self):
         """
-        Closing client's object.
+        Closing client's object; packets which are not sent yet are dropped and the sender thread stops.
         :return:
         """
+        self._closing = True
         self.client.close()
 
+        with self._out_buff_condition:
+            self.out_buff.clear()
+            self.out_buff_bytes = 0
+            self._out_buff_condition.notify_all()
+
+        if self._sender is not None and self._sender is not threading.current_thread():
+            self._sender.join(SENDER_JOIN_TIMEOUT)
+
     def get_server_address(self):
         """
 
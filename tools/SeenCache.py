@@ -0,0 +1,57 @@
+import time
+from collections import OrderedDict
+
+
+class SeenCache:
+    def __init__(self, max_size=4096, ttl=120):
+        """
+        A bounded set of recently seen keys; keys are forgotten after 'ttl' seconds or when more than 'max_size'
+        keys are stored, oldest first.
+
+        :param max_size: Maximum number of stored keys.
+        :param ttl: Seconds to remember a key.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key: seen key, value: time it was first seen
+
+        self.accepted = 0
+        self.suppressed = 0
+
+    def add(self, key) -> bool:
+        """
+        :param key: The key which has just been seen.
+
+        :return: False if key is already seen, otherwise remember it and return True.
+        :rtype: bool
+        """
+        now = time.time()
+        self._evict(now - self.ttl)
+
+        if key in self._entries:
+            self.suppressed += 1
+            return False
+
+        self._entries[key] = now
+        self.accepted += 1
+
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+        return True
+
+    def _evict(self, threshold):
+        entries = self._entries
+
+        while entries:
+            key, seen_time = next(iter(entries.items()))
+            if seen_time >= threshold:
+                break
+
+            del entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
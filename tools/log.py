@@ -0,0 +1,38 @@
+import logging
+import logging.handlers
+import queue
+import sys
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+LOG_LEVELS = ('debug', 'info', 'warning', 'error')
+DEFAULT_LOG_LEVEL = 'warning'  # quiet; only problems are shown
+
+
+def setup_logging(level=DEFAULT_LOG_LEVEL, stream=None):
+    """
+    Write the records of every logger to stream from a background thread, so logging never waits for the terminal.
+
+    Records below level are dropped by the loggers before their message is formatted; the hot paths log with lazy
+    arguments, e.g. logger.debug("Packet received: %s", packet), so disabled records cost almost nothing.
+
+    :param level: One of LOG_LEVELS.
+    :param stream: Where the records are written; sys.stderr if not set.
+
+    :return: The listener of the queue; stop it on exit to write the records which are still queued.
+    :rtype: logging.handlers.QueueListener
+    """
+    records = queue.SimpleQueue()
+
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    root_logger = logging.getLogger()
+    for old_handler in list(root_logger.handlers):
+        root_logger.removeHandler(old_handler)
+    root_logger.addHandler(logging.handlers.QueueHandler(records))
+    root_logger.setLevel(level.upper())
+
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+
+    return listener
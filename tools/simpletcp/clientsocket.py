@@ -1,9 +1,11 @@
 import sys
 import socket
+import threading
 
 
 class ClientSocket:
-    def __init__(self, mode, port, received_bytes=2048, single_use=True):
+    def __init__(self, mode, port, received_bytes=2048, single_use=True, pipelined=False, connect_timeout=None,
+                 background_connect=False, connect_callback=None):
         """
 
         Handle the socket's mode.
@@ -12,6 +14,10 @@ class ClientSocket:
         localhost -> (127.0.0.1)
         public ->    (0.0.0.0)
         otherwise, mode is interpreted as an IP address.
+
+        A socket which isn't single-use may connect in a background thread;
+        it is pending until the connection is made or connect_error is set,
+        then connect_callback is called from that thread.
         """
 
         if mode == "localhost":
@@ -31,15 +37,40 @@ class ClientSocket:
         self.received_bytes = received_bytes
         # Save whether this socket is single-use or not.
         self.single_use = single_use
+        # In pipelined mode send() does not wait for the response; responses
+        # are drained without blocking on later sends.
+        self.pipelined = pipelined and not single_use
+        self.sent_count = 0
+        self.response_bytes = 0
+        self.pending = False
+        self.connect_error = None
         # If this isn't a single-use socket, connect right away.
         if not self.single_use:
-            self._socket.connect((self.connect_ip, self.connect_port))
             # Keep track of whether this socket has been closed.
             self.closed = False
+            if background_connect:
+                self.pending = True
+                threading.Thread(target=self._connect, args=(connect_timeout, connect_callback),
+                                 daemon=True).start()
+            else:
+                self._socket.settimeout(connect_timeout)
+                self._socket.connect((self.connect_ip, self.connect_port))
+                self._socket.settimeout(None)
         # Keep track of whether this socket has been used, so we can
         # warn single-use sockets not to send data twice.
         self.used = False
 
+    def _connect(self, timeout, callback):
+        try:
+            self._socket.settimeout(timeout)
+            self._socket.connect((self.connect_ip, self.connect_port))
+            self._socket.settimeout(None)
+        except OSError as e:
+            self.connect_error = e
+        self.pending = False
+        if callback:
+            callback()
+
     def get_port(self):
         return self.connect_port
 
@@ -85,11 +116,17 @@ class ClientSocket:
             print("data must be a string or bytes", file=sys.stderr)
             raise ValueError
         # Everything is setup, now we must send the data.
-        self._socket.send(data)
+        self._socket.sendall(data)
         # Keep track of the fact that we've sent data (or attempted to).
         self.used = True
+        self.sent_count += 1
+        if self.pipelined:
+            # Don't wait for the response, only consume what has arrived.
+            self.drain_responses()
+            return b""
         # Now read the response:
         response = self._socket.recv(self.received_bytes)
+        self.response_bytes += len(response)
         # If this socket is single-use, destroy the connection.
         if self.single_use:
             self._socket.close()
@@ -98,8 +135,61 @@ class ClientSocket:
         # Return the response
         return response
 
+    def send_many(self, buffers):
+        """
+
+        Send a batch of buffers, which must be bytes.
+        In pipelined mode the whole batch goes out with one scatter-gather
+        sendmsg call per partial write; otherwise every buffer is sent and
+        acknowledged on its own.
+
+        """
+        if not self.pipelined:
+            for data in buffers:
+                self.send(data)
+            return
+
+        buffers = list(buffers)
+        first = 0
+        while first < len(buffers):
+            sent = self._socket.sendmsg(buffers[first:] if first else buffers)
+            # Skip the buffers which were written completely, keep the rest of a partial one.
+            while first < len(buffers) and sent >= len(buffers[first]):
+                sent -= len(buffers[first])
+                first += 1
+            if sent:
+                buffers[first] = memoryview(buffers[first])[sent:]
+        self.used = True
+        self.sent_count += len(buffers)
+        self.drain_responses()
+
+    def drain_responses(self):
+        """
+
+        Read every response which is already waiting on the socket without
+        blocking and return the number of bytes consumed.
+        Raises ConnectionError if the server has closed the connection.
+
+        """
+        drained = 0
+        while True:
+            try:
+                response = self._socket.recv(self.received_bytes, socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                break
+            if not response:
+                raise ConnectionError("connection closed by server")
+            drained += len(response)
+        self.response_bytes += drained
+        return drained
+
     def close(self):
         # If the connection isn't already closed, close it.
         if not self.closed:
+            # Wake up a send which is blocked in another thread.
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             self._socket.close()
             self.closed = True
@@ -1,13 +1,31 @@
-import errno
 import queue
-import select
+import selectors
 import socket
 import sys
 
 
+class _Connection:
+    """
+    State of one accepted client socket; it is stored as the data of its
+    selector key.
+    """
+
+    __slots__ = ('sock', 'ip', 'queue', 'pending', 'writing')
+
+    def __init__(self, sock, ip):
+        self.sock = sock
+        self.ip = ip
+        # Responses put by the callback.
+        self.queue = queue.Queue()
+        # Bytes taken from the queue but not sent yet.
+        self.pending = b""
+        # Whether the socket is registered for write events.
+        self.writing = False
+
+
 class ServerSocket:
 
-    def __init__(self, mode, port, read_callback, max_connections, received_bytes):
+    def __init__(self, mode, port, read_callback, max_connections, received_bytes, close_callback=None):
         """
         Handle the socket's mode.
         The socket's mode determines the IP address it binds to.
@@ -33,10 +51,14 @@ class ServerSocket:
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # Make it non-blocking.
         self._socket.setblocking(0)
+        # Connections of a previous server on this port may still be in
+        # TIME_WAIT; they must not keep a restarted peer from binding it.
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         # Bind the socket, so it can listen.
         self._socket.bind((self.ip, self.port))
         # Save the callback
         self.callback = read_callback
+        self.close_callback = close_callback
         # Save the number of maximum connections.
         self._max_connections = max_connections
         if type(self._max_connections) != int:
@@ -45,85 +67,129 @@ class ServerSocket:
         # Save the number of bytes to be received each time we read from
         # a socket
         self.received_bytes = received_bytes
+        # Selector of the running loop and a socket pair to wake it up on close.
+        self._selector = None
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._closing = False
 
     def run(self):
         # Start listening
         self._socket.listen(self._max_connections)
-        # Create a list of readers (sockets that will be read from) and a list
-        # of writers (sockets that will be written to).
-        readers = [self._socket]
-        writers = []
-        # Create a dictionary of queue.Queues for data to be sent.
-        # This dictionary maps sockets to queue.Queue objects
-        queues = dict()
-        # Create a similar dictionary that stores IP addresses.
-        # This dictionary maps sockets to IP addresses
-        IPs = dict()
-        # Now, the main loop.
-        while readers:
+        # Every socket is registered once; the key data tells what it is.
+        # None for the listening socket, _Connection for clients.
+        selector = selectors.DefaultSelector()
+        selector.register(self._socket, selectors.EVENT_READ, None)
+        selector.register(self._wakeup_reader, selectors.EVENT_READ, self._wakeup_reader)
+        self._selector = selector
+        # Now, the main loop. A close before it starts leaves its wakeup
+        # byte in the socket pair, so the first select returns at once.
+        while not self._closing:
             # Block until a socket is ready for processing.
-            read, write, err = select.select(readers, writers, readers)
-            # Deal with sockets that need to be read from.
-            for sock in read:
-                if sock is self._socket:
-                    # We have a viable connection!
-                    client_socket, client_ip = self._socket.accept()
-                    # Make it a non-blocking connection.
-                    client_socket.setblocking(0)
-                    # Add it to our readers.
-                    readers.append(client_socket)
-                    # Make a queue for it.
-                    queues[client_socket] = queue.Queue()
-                    # Store its IP address.
-                    IPs[client_socket] = client_ip
+            for key, events in selector.select():
+                connection = key.data
+                if connection is None:
+                    self._accept(selector)
+                elif connection is self._wakeup_reader:
+                    self._wakeup_reader.recv(1)
                 else:
-                    # Someone sent us something! Let's receive it.
-                    try:
-                        data = sock.recv(self.received_bytes)
-                    except socket.error as e:
-                        if e.errno is errno.ECONNRESET:
-                            # Consider 'Connection reset by peer'
-                            # the same as reading zero bytes
-                            data = None
-                        else:
-                            raise e
-                    if data:
-                        # Call the callback
-                        self.callback(IPs[sock], queues[sock], data)
-                        # Put the client socket in writers so we can write to it
-                        # later.
-                        if sock not in writers:
-                            writers.append(sock)
-                    else:
-                        # We received zero bytes, so we should close the stream
-                        # Stop writing to it.
-                        if sock in writers:
-                            writers.remove(sock)
-                        # Stop reading from it.
-                        readers.remove(sock)
-                        # Close the connection.
-                        sock.close()
-                        # Destroy is queue
-                        del queues[sock]
-            # Deal with sockets that need to be written to.
-            for sock in write:
-                try:
-                    # Get the next chunk of data in the queue, but don't wait.
-                    data = queues[sock].get_nowait()
-                except queue.Empty:
-                    # The queue is empty -> nothing needs to be written.
-                    writers.remove(sock)
-                else:
-                    # The queue wasn't empty; we did, in fact, get something.
-                    # So send it.
-                    sock.send(data)
-            # Deal with errors in sockets.
-            for sock in err:
-                # Remove the socket from every list.
-                readers.remove(sock)
-                if sock in writers:
-                    writers.remove(sock)
-                # Close the connection.
-                sock.close()
-                # Destroy its queue.
-                del queues[sock]
+                    if events & selectors.EVENT_READ:
+                        self._read(selector, connection)
+                    if events & selectors.EVENT_WRITE and connection.sock.fileno() != -1:
+                        self._write(selector, connection)
+        # Release every client socket.
+        for key in list(selector.get_map().values()):
+            if isinstance(key.data, _Connection):
+                self._close_connection(selector, key.data)
+        selector.close()
+        self._selector = None
+        # The server can't be run again.
+        self._socket.close()
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
+
+    def close(self):
+        """
+        Make the loop return and release the sockets of the server; the
+        loop may be running or not started yet.
+        """
+        self._closing = True
+        try:
+            self._wakeup_writer.send(b"\0")
+        except OSError:
+            # The loop has already returned.
+            pass
+
+    def _accept(self, selector):
+        try:
+            # We have a viable connection!
+            client_socket, client_ip = self._socket.accept()
+        except BlockingIOError:
+            return
+        # Make it a non-blocking connection.
+        client_socket.setblocking(0)
+        selector.register(client_socket, selectors.EVENT_READ, _Connection(client_socket, client_ip))
+
+    def _read(self, selector, connection):
+        # Someone sent us something! Let's receive it.
+        try:
+            data = connection.sock.recv(self.received_bytes)
+        except (BlockingIOError, InterruptedError):
+            return
+        except ConnectionError:
+            # Consider 'Connection reset by peer'
+            # the same as reading zero bytes
+            data = None
+        if not data:
+            # We received zero bytes, so we should close the stream
+            self._close_connection(selector, connection)
+            return
+        # Call the callback; it raises ConnectionError to drop the connection.
+        try:
+            self.callback(connection.ip, connection.queue, data)
+        except ConnectionError:
+            self._close_connection(selector, connection)
+            return
+        # Write the responses right away; write events are only needed
+        # when the socket buffer is full.
+        if not connection.writing and not connection.queue.empty():
+            self._write(selector, connection)
+
+    def _write(self, selector, connection):
+        if not connection.pending:
+            chunks = []
+            try:
+                while True:
+                    # Get the queued chunks of data, but don't wait.
+                    chunks.append(connection.queue.get_nowait())
+            except queue.Empty:
+                pass
+            connection.pending = b"".join(chunks)
+        if connection.pending:
+            try:
+                sent = connection.sock.send(connection.pending)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                # The client has gone away without reading its
+                # responses, handle it like a socket error.
+                self._close_connection(selector, connection)
+                return
+            connection.pending = connection.pending[sent:]
+        # Only ask for write events while there is something left to write.
+        writing = bool(connection.pending) or not connection.queue.empty()
+        if writing != connection.writing:
+            connection.writing = writing
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if writing else selectors.EVENT_READ
+            selector.modify(connection.sock, events, connection)
+
+    def _close_connection(self, selector, connection):
+        # Stop reading from and writing to it.
+        selector.unregister(connection.sock)
+        # Close the connection.
+        connection.sock.close()
+        self._closed(connection.ip)
+
+    def _closed(self, ip):
+        # Let the owner release any per-connection state.
+        if self.close_callback:
+            self.close_callback(ip)
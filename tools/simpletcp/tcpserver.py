@@ -17,17 +17,24 @@ class TCPServer:
      is a tunnel of data to send to the socket that it received from.
      The third argument must be data, which is a string of bytes
      that the server received.
+     read_callback may raise ConnectionError to close the connection
+     that data was received from.
+     close_callback is optional and is called with the same address
+     argument when a client connection is closed.
     """
 
     def __init__(self, mode, port, read_callback,
-                 maximum_connections=5, receive_bytes=2048):
+                 maximum_connections=5, receive_bytes=2048, close_callback=None):
         self.server_socket = ServerSocket(
-            mode, port, read_callback, maximum_connections, receive_bytes
+            mode, port, read_callback, maximum_connections, receive_bytes, close_callback
         )
 
     def run(self):
         self.server_socket.run()
 
+    def close(self):
+        self.server_socket.close()
+
     @property
     def ip(self):
         return self.server_socket.ip
@@ -1,5 +0,0 @@
-from datetime import datetime
-
-
-def print_time():
-    print("Time: " + datetime.now().strftime('%H:%M:%S'))